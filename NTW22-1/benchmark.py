@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+from __future__ import annotations
+
+import argparse
+import gc
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List
+
+from http.header import HttpHeader
+from http.request import HttpRequest
+from http.response import HttpResponse
+from http.stream import SocketReader
+from replay import read_response_status
+import server as server_module
+from server import Server
+from settings import VHOSTS_FILE
+from utils.vhosts import Vhost
+
+# Measures the memory allocated by the server to answer each request, with tracemalloc. A server is started in this
+# same process (on a free port), and a keep-alive client sends the same requests over and over. For every request,
+# it reports the peak of memory allocated while it was being answered, and the memory still allocated at the end
+# (which should not grow with the number of requests). Note that the small allocations of the client are included.
+# It also counts the objects allocated for each request (the ones tracked by the garbage collector, e.g. instances
+# and dictionaries) which are alive when its response starts to be sent. With --no-reuse, the server allocates new
+# request and response objects for every request instead of reusing the ones of the connection, as a baseline.
+
+# Number of times each request is sent to count its objects (each one lists all the objects twice)
+OBJECT_SAMPLES = 50
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_object_size(obj) -> int:
+    """
+    Gets the size of an object, including its instance dictionary (if it has one).
+    :param obj: object to be measured
+    :return: size in bytes
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def build_requests(hostname: str) -> Dict[str, bytes]:
+    """
+    Generates the requests to be sent, for a given host.
+    :param hostname: host of the requests
+    :return: dictionary of requests by name
+    """
+    headers = "Host: {}\r\nUser-Agent: benchmark\r\nAccept: */*\r\n\r\n".format(hostname)
+    return {
+        "GET index": "GET / HTTP/1.1\r\n{}".format(headers).encode(),
+        "GET missing": "GET /missing.html HTTP/1.1\r\n{}".format(headers).encode(),
+        "NTW22INFO": "NTW22INFO / HTTP/1.1\r\n{}".format(headers).encode(),
+    }
+
+
+def run(requests: Dict[str, bytes], count: int, warmup: int, reuse_objects: bool = True) -> Dict[str, dict]:
+    """
+    Starts a server, and sends every request count times through a single keep-alive connection.
+    :param requests: requests to be sent, by name
+    :param count: number of times each request is measured
+    :param warmup: number of times each request is sent before measuring (so caches are filled)
+    :param reuse_objects: whether the server reuses the request and response objects of the connection
+    :return: results by request name
+    """
+    # Objects are counted right before the response is sent, when whatever was allocated to answer it is still alive.
+    # They are the ones whose id was not in known_ids before sending the request
+    counted = []
+    known_ids = None
+    generate_stream = server_module.generate_stream
+
+    def counting_generate_stream(request, response):
+        if known_ids is not None:
+            counted.append(sum(1 for obj in gc.get_objects() if id(obj) not in known_ids))
+        return generate_stream(request, response)
+
+    server_module.generate_stream = counting_generate_stream
+    port = get_free_port()
+    server = Server(port=port, reuse_objects=reuse_objects)
+    thread = threading.Thread(target=server.listen, daemon=True)
+    thread.start()
+    # Do not measure while the files are being preloaded
+    server.wait_ready()
+
+    sock = socket.create_connection(('127.0.0.1', port))
+    reader = SocketReader(sock)
+    results = {}
+    try:
+        for raw in requests.values():
+            for _ in range(warmup):
+                sock.sendall(raw)
+                read_response_status(reader)
+
+        gc.collect()
+        tracemalloc.start()
+        for name, raw in requests.items():
+            peaks, elapsed = [], 0.0
+            gc.collect()
+            baseline = tracemalloc.get_traced_memory()[0]
+            for _ in range(count):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+                sock.sendall(raw)
+                status = read_response_status(reader)
+                elapsed += time.perf_counter() - start
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            gc.collect()
+            results[name] = {
+                "status": status,
+                "peak": sum(peaks) / len(peaks),
+                "retained": (tracemalloc.get_traced_memory()[0] - baseline) / count,
+                "time": elapsed / count * 1000,
+            }
+
+        tracemalloc.stop()
+
+        # Apart, as listing the objects would be included in the peaks
+        for name, raw in requests.items():
+            for _ in range(OBJECT_SAMPLES):
+                # Keep the existing objects alive, so their ids are not taken by the new ones
+                existing = gc.get_objects()
+                known_ids = set(map(id, existing))
+                sock.sendall(raw)
+                read_response_status(reader)
+                known_ids, existing = None, None
+            results[name]["objects"] = sum(counted) / len(counted)
+            counted.clear()
+    finally:
+        server_module.generate_stream = generate_stream
+        sock.close()
+        server.shutdown()
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures the memory allocated by the server per request, with tracemalloc.")
+    parser.add_argument("-n", "--count",
+                        help="number of times each request is measured",
+                        type=int,
+                        default=1000)
+    parser.add_argument("--warmup",
+                        help="number of times each request is sent before measuring",
+                        type=int,
+                        default=50)
+    parser.add_argument("--no-reuse",
+                        help="allocate new request and response objects for every request, as a baseline",
+                        action="store_true")
+    args = parser.parse_args()
+
+    hosts = Vhost.parse_file(VHOSTS_FILE)
+    if not hosts:
+        parser.error("{} does not contain any valid host".format(VHOSTS_FILE))
+    hostname = next(iter(hosts))
+
+    sample = HttpRequest("GET / HTTP/1.1\r\nHost: {}\r\n\r\n".format(hostname).encode())
+    sizes: List[tuple] = [("HttpRequest", sample), ("HttpResponse", HttpResponse()),
+                          ("HttpHeader", HttpHeader("Host", hostname)), ("Vhost", hosts[hostname])]
+    print("Object sizes (including the instance dictionary, if any)")
+    for name, obj in sizes:
+        print("  {:<14} {:>6} bytes".format(name, get_object_size(obj)))
+
+    print("Per request ({} times each, host {}, objects {})".format(
+        args.count, hostname, "allocated per request" if args.no_reuse else "reused per connection"))
+    print("  {:<14} {:>6} {:>8} {:>12} {:>12} {:>10}".format("request", "status", "objects", "peak", "retained",
+                                                            "time"))
+    for name, result in run(build_requests(hostname), args.count, args.warmup, not args.no_reuse).items():
+        print("  {:<14} {:>6} {:>8.1f} {:>8.0f} B {:>10.1f} B {:>7.3f} ms".format(
+            name, result["status"], result["objects"], result["peak"], result["retained"], result["time"]))
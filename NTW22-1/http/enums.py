@@ -40,9 +40,14 @@ class HttpResponseCode(Enum):
     """
     HTTP response codes used by the server.
     """
+    CONTINUE = 100, "Continue"
+    SWITCHING_PROTOCOLS = 101, "Switching Protocols"
+
     OK = 200, "OK"
     CREATED = 201, "Created"
 
+    NOT_MODIFIED = 304, "Not Modified"
+
     BAD_REQUEST = 400, "Bad Request"
     FORBIDDEN = 403, "Forbidden"
     NOT_FOUND = 404, "Not Found"
@@ -51,6 +56,9 @@ class HttpResponseCode(Enum):
 
     INTERNAL_SERVER_ERROR = 500, "Internal Server Error"
     NOT_IMPLEMENTED = 501, "Not Implemented"
+    BAD_GATEWAY = 502, "Bad Gateway"
+    SERVICE_UNAVAILABLE = 503, "Service Unavailable"
+    GATEWAY_TIMEOUT = 504, "Gateway Timeout"
     HTTP_VERSION_NOT_SUPPORTED = 505, "HTTP Version Not Supported"
 
     def get_code(self) -> int:
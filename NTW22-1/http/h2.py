@@ -0,0 +1,684 @@
+from __future__ import annotations
+
+import queue
+import select
+import struct
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from http.hpack import HpackDecoder, HpackEncoder, HpackError
+from http.response import BaseHttpResponse, HttpResponseBadRequest, HttpResponseError
+from http.stream import SocketReader, HttpBodyStream, PREFACE, is_decimal
+from settings import H2_INITIAL_WINDOW_SIZE, H2_MAX_CONCURRENT_STREAMS, HTTP_ENCODING, MAX_HEADER_SIZE, \
+    POLL_INTERVAL
+
+# This file implements HTTP/2 over cleartext TCP (h2c, RFC 9113), either started with prior knowledge (the client
+# sends the connection preface right away) or by upgrading an HTTP/1.1 connection. Every stream carries a request,
+# which is translated into the equivalent HTTP/1.1 request head so it is handled as any other request, and each one
+# is answered from its own thread, so slow responses do not block the rest of streams of the connection.
+
+# Frame header: length (24 bits, as 8 + 16) | type | flags | stream id (the highest bit is reserved)
+FRAME_HEADER = struct.Struct(">BHBBI")
+
+FRAME_DATA = 0x0
+FRAME_HEADERS = 0x1
+FRAME_PRIORITY = 0x2
+FRAME_RST_STREAM = 0x3
+FRAME_SETTINGS = 0x4
+FRAME_PUSH_PROMISE = 0x5
+FRAME_PING = 0x6
+FRAME_GOAWAY = 0x7
+FRAME_WINDOW_UPDATE = 0x8
+FRAME_CONTINUATION = 0x9
+
+FLAG_END_STREAM = 0x1
+FLAG_ACK = 0x1
+FLAG_END_HEADERS = 0x4
+FLAG_PADDED = 0x8
+FLAG_PRIORITY = 0x20
+
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+ERROR_NO_ERROR = 0x0
+ERROR_PROTOCOL_ERROR = 0x1
+ERROR_INTERNAL_ERROR = 0x2
+ERROR_FLOW_CONTROL_ERROR = 0x3
+ERROR_STREAM_CLOSED = 0x5
+ERROR_FRAME_SIZE_ERROR = 0x6
+ERROR_REFUSED_STREAM = 0x7
+ERROR_COMPRESSION_ERROR = 0x9
+ERROR_ENHANCE_YOUR_CALM = 0xb
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+DEFAULT_MAX_FRAME_SIZE = 16384
+MAX_FRAME_SIZE = 2 ** 24 - 1
+
+# Headers which are specific to an HTTP/1.1 connection, so they are not allowed in HTTP/2
+CONNECTION_HEADERS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade",
+                      "http2-settings"}
+# Pseudo-headers of a request, and the ones which are required
+REQUEST_PSEUDO_HEADERS = {":method", ":scheme", ":authority", ":path"}
+REQUIRED_PSEUDO_HEADERS = {":method", ":scheme", ":path"}
+
+
+class H2Error(Exception):
+    """
+    Error in an HTTP/2 connection. A connection error (stream id 0) closes the whole connection with GOAWAY, while
+    a stream error only resets that stream.
+    """
+    def __init__(self, code: int, message: str, stream_id: int = 0):
+        super(H2Error, self).__init__(message)
+        self.code = code
+        self.stream_id = stream_id
+
+
+class H2BodyStream(HttpBodyStream):
+    """
+    Body of a request received in DATA frames. The connection thread feeds the blocks while the handler reads them
+    from the stream thread. Every block read is notified, so the client is allowed to send more data.
+    """
+    __blocks = None
+    __on_read = None
+    __reset = False
+
+    def __init__(self, on_read: Callable[[int], None]):
+        super(H2BodyStream, self).__init__(None)
+        self.__blocks = queue.Queue()
+        self.__on_read = on_read
+        self.__reset = False
+
+    def feed(self, data: bytes):
+        self.__blocks.put(data)
+
+    def end(self, reset: bool = False):
+        """
+        Marks the end of the body.
+        :param reset: whether the body is incomplete because the stream (or the connection) was reset
+        """
+        self.__reset = reset
+        self.__blocks.put(None)
+
+    def read_block(self) -> bytes:
+        if self._finished:
+            return b''
+        block = self.__blocks.get()
+        if block is None:
+            self._finished = True
+            if self.__reset:
+                raise HttpResponseBadRequest(content="Stream was reset before receiving the whole body")
+            return b''
+        self.__on_read(len(block))
+        return block
+
+
+class H2Stream:
+    """
+    State of a stream of an HTTP/2 connection.
+    """
+    stream_id = 0
+    body = None
+    send_window = DEFAULT_WINDOW_SIZE
+    recv_window = H2_INITIAL_WINDOW_SIZE
+    remote_closed = False
+    local_closed = False
+    reset = False
+    # Length of the body given in the content-length header (if any), and bytes of the body received so far
+    content_length = None
+    received = 0
+
+    def __init__(self, stream_id: int, send_window: int, content_length: int | None = None):
+        self.stream_id = stream_id
+        self.body = None
+        self.send_window = send_window
+        self.recv_window = H2_INITIAL_WINDOW_SIZE
+        self.remote_closed = False
+        self.local_closed = False
+        self.reset = False
+        self.content_length = content_length
+        self.received = 0
+
+
+def build_request_head(headers: List[Tuple[bytes, bytes]]) -> Tuple[bytes, int | None]:
+    """
+    Given the header fields of an HTTP/2 request, generates the equivalent HTTP/1.1 request head. The body is given
+    apart, but the content-length header (if any) is kept, so the request can be forwarded with it.
+    :param headers: decoded header fields, in order
+    :return: request head, and the value of the content-length header (None if not given)
+    """
+    pseudo: Dict[str, str] = {}
+    lines, cookies = [], []
+    host, content_length = None, None
+    for raw_name, raw_value in headers:
+        try:
+            name, value = raw_name.decode(HTTP_ENCODING), raw_value.decode(HTTP_ENCODING)
+        except UnicodeDecodeError:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Header field is not valid {}".format(HTTP_ENCODING))
+        if not name or name != name.lower() or any(c in name + value for c in "\r\n\0"):
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid header field {}".format(name))
+
+        if name.startswith(":"):
+            # Pseudo-headers go first, only once each
+            if lines or cookies or host is not None or name not in REQUEST_PSEUDO_HEADERS or name in pseudo:
+                raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid pseudo-header {}".format(name))
+            pseudo[name] = value
+        elif name in CONNECTION_HEADERS or (name == "te" and value != "trailers"):
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Connection-specific header {}".format(name))
+        elif name == "cookie":
+            # Cookies may be split in several fields, which are joined again for HTTP/1.1
+            cookies.append(value)
+        elif name == "host":
+            host = value
+        else:
+            if name == "content-length":
+                # Checked against the DATA frames received, so it must be given only once
+                if content_length is not None or not is_decimal(value):
+                    raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid content-length")
+                content_length = int(value)
+            lines.append("{}: {}".format(name, value))
+
+    if not REQUIRED_PSEUDO_HEADERS <= set(pseudo) or not pseudo[":path"].startswith("/"):
+        raise H2Error(ERROR_PROTOCOL_ERROR, "Missing or invalid pseudo-headers")
+    # :authority replaces the Host header
+    host = pseudo.get(":authority", host)
+    if host is not None:
+        lines.insert(0, "host: {}".format(host))
+    if cookies:
+        lines.append("cookie: {}".format("; ".join(cookies)))
+    lines.insert(0, "{} {} HTTP/1.1".format(pseudo[":method"], pseudo[":path"]))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode(HTTP_ENCODING), content_length
+
+
+class H2Connection:
+    """
+    Server side of an HTTP/2 connection. The connection thread reads and processes the frames, while the response
+    of each stream is generated and sent from its own thread.
+    The handler is given the equivalent HTTP/1.1 request head and the body stream (None if there is no body), and
+    returns the response to be sent, with its headers already generated.
+    """
+    __conn = None
+    __reader = None
+    __handler = None
+    __draining = None
+    __decoder = None
+    __encoder = None
+    __streams = None
+    __last_stream_id = 0
+    # Protects the streams and the flow-control windows, and notifies when any window is increased
+    __lock = None
+    # Serializes the frames sent, as header blocks must be encoded in the same order they are sent
+    __write_lock = None
+    __send_window = DEFAULT_WINDOW_SIZE
+    __peer_initial_window = DEFAULT_WINDOW_SIZE
+    __peer_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+    __header_block = None
+    __goaway_sent = False
+    __goaway_received = False
+    __closed = False
+
+    def __init__(self, conn, reader: SocketReader, handler: Callable[[bytes, HttpBodyStream | None], BaseHttpResponse],
+                 draining: threading.Event):
+        self.__conn = conn
+        self.__reader = reader
+        self.__handler = handler
+        self.__draining = draining
+        # The decoded headers are limited as the ones of HTTP/1.1 requests
+        self.__decoder = HpackDecoder(max_list_size=MAX_HEADER_SIZE)
+        self.__encoder = HpackEncoder()
+        self.__streams: Dict[int, H2Stream] = {}
+        self.__last_stream_id = 0
+        self.__lock = threading.Condition()
+        self.__write_lock = threading.Lock()
+        self.__send_window = DEFAULT_WINDOW_SIZE
+        self.__peer_initial_window = DEFAULT_WINDOW_SIZE
+        self.__peer_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        # Header block being received in HEADERS and CONTINUATION frames: [stream id, fragments, end of stream]
+        self.__header_block = None
+        self.__goaway_sent = False
+        self.__goaway_received = False
+        self.__closed = False
+
+    def run(self, preface: bytes = b'', upgrade_head: bytes | None = None, upgrade_settings: bytes | None = None):
+        """
+        Serves the connection until it is closed by the client, or until the server is shutting down and there are
+        no active streams.
+        :param preface: part of the connection preface already read from the connection
+        :param upgrade_head: head of the HTTP/1.1 request which upgraded the connection, to be answered in stream 1
+        :param upgrade_settings: SETTINGS payload sent in the HTTP2-Settings header of the upgrade request
+        """
+        try:
+            if upgrade_settings is not None:
+                self.__apply_settings(upgrade_settings)
+            self.__send_settings()
+            if upgrade_head is not None:
+                # The upgrade request is the first stream, whose request was already completely sent
+                self.__last_stream_id = 1
+                self.__start_stream(1, upgrade_head, end_stream=True)
+
+            if not PREFACE.startswith(preface) or \
+                    self.__reader.read_exact(len(PREFACE) - len(preface)) != PREFACE[len(preface):]:
+                raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid connection preface")
+            while self.__wait_for_frame():
+                self.__handle_frame(*self.__read_frame())
+        except H2Error as e:
+            try:
+                self.__send_goaway(e.code)
+            except OSError:
+                pass
+        except (OSError, HttpResponseError):
+            # Connection closed by the client, or in the middle of a frame
+            pass
+        finally:
+            self.__close()
+
+    def __wait_for_frame(self) -> bool:
+        """
+        Waits until there is data to be read. While waiting, checks whether the connection must be closed.
+        :return: False if the connection was closed, or must be closed
+        """
+        while not self.__reader.has_buffered_data():
+            if self.__draining.is_set() or self.__goaway_received:
+                # Let the client know that no new streams will be processed, and finish the active ones
+                self.__send_goaway(ERROR_NO_ERROR)
+                with self.__lock:
+                    if not self.__streams:
+                        return False
+            readable, _, _ = select.select([self.__conn], [], [], POLL_INTERVAL)
+            if readable and not self.__reader.fill():
+                return False
+        return True
+
+    def __read_frame(self) -> Tuple[int, int, int, bytes]:
+        length_high, length_low, frame_type, flags, stream_id = \
+            FRAME_HEADER.unpack(self.__reader.read_exact(FRAME_HEADER.size))
+        length = (length_high << 16) | length_low
+        if length > DEFAULT_MAX_FRAME_SIZE:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Frame larger than the maximum frame size")
+        return frame_type, flags, stream_id & 0x7fffffff, self.__reader.read_exact(length)
+
+    def __handle_frame(self, frame_type: int, flags: int, stream_id: int, payload: bytes):
+        if self.__header_block is not None and (frame_type != FRAME_CONTINUATION
+                                                or stream_id != self.__header_block[0]):
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Expected a CONTINUATION frame")
+        handlers = {
+            FRAME_DATA: self.__on_data,
+            FRAME_HEADERS: self.__on_headers,
+            FRAME_PRIORITY: self.__on_priority,
+            FRAME_RST_STREAM: self.__on_rst_stream,
+            FRAME_SETTINGS: self.__on_settings,
+            FRAME_PUSH_PROMISE: self.__on_push_promise,
+            FRAME_PING: self.__on_ping,
+            FRAME_GOAWAY: self.__on_goaway,
+            FRAME_WINDOW_UPDATE: self.__on_window_update,
+            FRAME_CONTINUATION: self.__on_continuation,
+        }
+        # Frames of unknown types are ignored
+        if frame_type in handlers:
+            try:
+                handlers[frame_type](flags, stream_id, payload)
+            except H2Error as e:
+                if not e.stream_id:
+                    raise
+                self.__reset_stream(e.stream_id, e.code)
+
+    @staticmethod
+    def __remove_padding(flags: int, payload: bytes) -> bytes:
+        if not flags & FLAG_PADDED:
+            return payload
+        if not payload or payload[0] >= len(payload):
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid padding")
+        return payload[1:len(payload) - payload[0]]
+
+    def __on_data(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id == 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "DATA frame without stream")
+        if payload:
+            # The connection window is restored right away: each stream limits how much of its body is buffered
+            self.__send_window_update(0, len(payload))
+        with self.__lock:
+            stream = self.__streams.get(stream_id)
+            if stream is None or stream.remote_closed:
+                if stream_id > self.__last_stream_id:
+                    raise H2Error(ERROR_PROTOCOL_ERROR, "DATA frame on an idle stream")
+                raise H2Error(ERROR_STREAM_CLOSED, "DATA frame on a closed stream", stream_id)
+            stream.recv_window -= len(payload)
+            if stream.recv_window < 0:
+                raise H2Error(ERROR_FLOW_CONTROL_ERROR, "Stream flow-control window exceeded", stream_id)
+
+        data = self.__remove_padding(flags, payload)
+        if len(data) < len(payload):
+            # Padding is not read by the handler, so restore its window now
+            self.__send_window_update(stream_id, len(payload) - len(data))
+        # The body must match its content-length, as it may be forwarded with it (see utils/proxy.py)
+        stream.received += len(data)
+        if stream.content_length is not None and (stream.received > stream.content_length or (
+                flags & FLAG_END_STREAM and stream.received != stream.content_length)):
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Body differs from the content-length", stream_id)
+        if data and stream.body is not None:
+            stream.body.feed(data)
+        if flags & FLAG_END_STREAM:
+            self.__end_remote(stream)
+
+    def __on_headers(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id == 0 or stream_id % 2 == 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid stream id {}".format(stream_id))
+        payload = self.__remove_padding(flags, payload)
+        if flags & FLAG_PRIORITY:
+            # Priorities are not used
+            payload = payload[5:]
+        self.__header_block = [stream_id, bytearray(payload), bool(flags & FLAG_END_STREAM)]
+        if flags & FLAG_END_HEADERS:
+            self.__end_header_block()
+
+    def __on_continuation(self, flags: int, stream_id: int, payload: bytes):
+        if self.__header_block is None:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Unexpected CONTINUATION frame")
+        self.__header_block[1] += payload
+        if len(self.__header_block[1]) > MAX_HEADER_SIZE:
+            raise H2Error(ERROR_ENHANCE_YOUR_CALM, "Header block is too large")
+        if flags & FLAG_END_HEADERS:
+            self.__end_header_block()
+
+    def __end_header_block(self):
+        stream_id, block, end_stream = self.__header_block
+        self.__header_block = None
+        try:
+            # Always decoded, even if the stream is going to be refused, to keep the decoder table in sync
+            headers = self.__decoder.decode(bytes(block))
+        except HpackError as e:
+            raise H2Error(ERROR_COMPRESSION_ERROR, str(e))
+
+        with self.__lock:
+            stream = self.__streams.get(stream_id)
+        if stream is not None:
+            # Trailers, which are ignored, but they have to end the stream
+            if stream.remote_closed or not end_stream:
+                raise H2Error(ERROR_PROTOCOL_ERROR, "Unexpected HEADERS frame", stream_id)
+            if stream.content_length is not None and stream.received != stream.content_length:
+                raise H2Error(ERROR_PROTOCOL_ERROR, "Body differs from the content-length", stream_id)
+            self.__end_remote(stream)
+            return
+        if stream_id <= self.__last_stream_id:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "Stream id {} was already used".format(stream_id))
+        if self.__goaway_sent:
+            # Streams started after GOAWAY are not processed
+            return
+        self.__last_stream_id = stream_id
+        with self.__lock:
+            if len(self.__streams) >= H2_MAX_CONCURRENT_STREAMS:
+                raise H2Error(ERROR_REFUSED_STREAM, "Too many concurrent streams", stream_id)
+        try:
+            head, content_length = build_request_head(headers)
+        except H2Error as e:
+            raise H2Error(e.code, str(e), stream_id)
+        self.__start_stream(stream_id, head, end_stream, content_length)
+
+    def __start_stream(self, stream_id: int, head: bytes, end_stream: bool, content_length: int | None = None):
+        stream = H2Stream(stream_id, self.__peer_initial_window, content_length)
+        stream.remote_closed = end_stream
+        if not end_stream:
+            stream.body = H2BodyStream(lambda size: self.__on_body_read(stream, size))
+        with self.__lock:
+            self.__streams[stream_id] = stream
+        thread = threading.Thread(target=self.__serve_stream, args=(stream, head), daemon=True)
+        thread.start()
+
+    def __on_priority(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id == 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "PRIORITY frame without stream")
+        if len(payload) != 5:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Invalid PRIORITY frame", stream_id)
+
+    def __on_rst_stream(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id == 0 or stream_id > self.__last_stream_id:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "RST_STREAM frame on an idle stream")
+        if len(payload) != 4:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Invalid RST_STREAM frame")
+        self.__remove_stream(stream_id, reset=True)
+
+    def __on_settings(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id != 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "SETTINGS frame on a stream")
+        if flags & FLAG_ACK:
+            if payload:
+                raise H2Error(ERROR_FRAME_SIZE_ERROR, "SETTINGS acknowledgement with payload")
+            return
+        self.__apply_settings(payload)
+        self.__send_frame(FRAME_SETTINGS, FLAG_ACK, 0)
+
+    def __apply_settings(self, payload: bytes):
+        if len(payload) % 6:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Invalid SETTINGS frame")
+        for setting, value in struct.iter_unpack(">HI", payload):
+            if setting == SETTINGS_HEADER_TABLE_SIZE:
+                with self.__write_lock:
+                    self.__encoder.resize(value)
+            elif setting == SETTINGS_ENABLE_PUSH and value > 1:
+                raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid SETTINGS_ENABLE_PUSH value")
+            elif setting == SETTINGS_INITIAL_WINDOW_SIZE:
+                if value > MAX_WINDOW_SIZE:
+                    raise H2Error(ERROR_FLOW_CONTROL_ERROR, "Invalid SETTINGS_INITIAL_WINDOW_SIZE value")
+                with self.__lock:
+                    # The change applies to the windows of all the open streams (which may become negative)
+                    delta = value - self.__peer_initial_window
+                    self.__peer_initial_window = value
+                    for stream in self.__streams.values():
+                        stream.send_window += delta
+                    self.__lock.notify_all()
+            elif setting == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_MAX_FRAME_SIZE <= value <= MAX_FRAME_SIZE:
+                    raise H2Error(ERROR_PROTOCOL_ERROR, "Invalid SETTINGS_MAX_FRAME_SIZE value")
+                self.__peer_max_frame_size = value
+            # Other settings (e.g. the limit of concurrent streams) only apply to streams started by the server
+
+    def __on_push_promise(self, flags: int, stream_id: int, payload: bytes):
+        raise H2Error(ERROR_PROTOCOL_ERROR, "Clients cannot push streams")
+
+    def __on_ping(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id != 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "PING frame on a stream")
+        if len(payload) != 8:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Invalid PING frame")
+        if not flags & FLAG_ACK:
+            self.__send_frame(FRAME_PING, FLAG_ACK, 0, payload)
+
+    def __on_goaway(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id != 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "GOAWAY frame on a stream")
+        # The client will not start new streams, so close the connection once the active ones finish
+        self.__goaway_received = True
+
+    def __on_window_update(self, flags: int, stream_id: int, payload: bytes):
+        if len(payload) != 4:
+            raise H2Error(ERROR_FRAME_SIZE_ERROR, "Invalid WINDOW_UPDATE frame")
+        increment = struct.unpack(">I", payload)[0] & 0x7fffffff
+        if increment == 0:
+            raise H2Error(ERROR_PROTOCOL_ERROR, "WINDOW_UPDATE with zero increment", stream_id)
+        with self.__lock:
+            if stream_id == 0:
+                self.__send_window += increment
+                if self.__send_window > MAX_WINDOW_SIZE:
+                    raise H2Error(ERROR_FLOW_CONTROL_ERROR, "Connection flow-control window too large")
+            else:
+                stream = self.__streams.get(stream_id)
+                if stream is None:
+                    # The stream may have been closed in the meantime
+                    return
+                stream.send_window += increment
+                if stream.send_window > MAX_WINDOW_SIZE:
+                    raise H2Error(ERROR_FLOW_CONTROL_ERROR, "Stream flow-control window too large", stream_id)
+            self.__lock.notify_all()
+
+    def __on_body_read(self, stream: H2Stream, size: int):
+        # The handler read part of the body, so the client can send that much more
+        with self.__lock:
+            if stream.remote_closed or stream.reset:
+                return
+            stream.recv_window += size
+        self.__send_window_update(stream.stream_id, size)
+
+    def __end_remote(self, stream: H2Stream):
+        """
+        The client finished sending its request in the stream.
+        """
+        if stream.body is not None:
+            stream.body.end()
+        with self.__lock:
+            stream.remote_closed = True
+            if stream.local_closed:
+                self.__streams.pop(stream.stream_id, None)
+
+    def __remove_stream(self, stream_id: int, reset: bool):
+        with self.__lock:
+            stream = self.__streams.pop(stream_id, None)
+            if stream is None:
+                return
+            stream.reset = reset
+            # Wake up the stream thread in case it is waiting to send data
+            self.__lock.notify_all()
+        if stream.body is not None and not stream.remote_closed:
+            stream.body.end(reset=True)
+
+    def __reset_stream(self, stream_id: int, code: int):
+        self.__remove_stream(stream_id, reset=True)
+        self.__send_frame(FRAME_RST_STREAM, 0, stream_id, struct.pack(">I", code))
+
+    def __serve_stream(self, stream: H2Stream, head: bytes):
+        """
+        Generates and sends the response of a stream, in its own thread.
+        """
+        response = None
+        try:
+            response = self.__handler(head, stream.body)
+            self.__send_response(stream, response)
+        except (OSError, HttpResponseError):
+            # The stream was reset, the connection was closed, or the response could not be completely generated
+            if not stream.reset and not self.__closed:
+                try:
+                    self.__reset_stream(stream.stream_id, ERROR_INTERNAL_ERROR)
+                except OSError:
+                    pass
+            return
+        finally:
+            # Let a content which was not completely sent release its resources
+            close = getattr(response.get_content(), "close", None) if response is not None else None
+            if close is not None:
+                close()
+
+        with self.__lock:
+            stream.local_closed = True
+            remote_closed = stream.remote_closed
+            if remote_closed:
+                self.__streams.pop(stream.stream_id, None)
+        if not remote_closed:
+            # The response is complete, so the rest of the request body is not needed
+            try:
+                self.__reset_stream(stream.stream_id, ERROR_NO_ERROR)
+            except OSError:
+                pass
+
+    def __send_response(self, stream: H2Stream, response: BaseHttpResponse):
+        headers = [(b":status", str(response.get_status_code().get_code()).encode(HTTP_ENCODING))]
+        for header in response.get_headers():
+            if header.name.lower() not in CONNECTION_HEADERS:
+                headers.append((header.name.lower().encode(HTTP_ENCODING), str(header.value).encode(HTTP_ENCODING)))
+
+        content = response.get_content()
+        if isinstance(content, str):
+            content = content.encode(HTTP_ENCODING)
+        if not content:
+            self.__send_headers(stream, headers, end_stream=True)
+        elif isinstance(content, bytes):
+            self.__send_headers(stream, headers, end_stream=False)
+            self.__send_data(stream, content, end_stream=True)
+        else:
+            self.__send_headers(stream, headers, end_stream=False)
+            for block in content:
+                if isinstance(block, str):
+                    block = block.encode(HTTP_ENCODING)
+                if block:
+                    self.__send_data(stream, block, end_stream=False)
+            self.__send_data(stream, b'', end_stream=True)
+
+    def __send_headers(self, stream: H2Stream, headers: List[Tuple[bytes, bytes]], end_stream: bool):
+        with self.__write_lock:
+            # Encoding the block changes the dynamic table of the encoder, so once it is encoded it has to be sent
+            # (even if the stream is reset meanwhile), otherwise the decoder of the client gets out of sync
+            self.__check_stream(stream)
+            # The header block is encoded and sent at once, as its frames cannot be interleaved with others
+            block = self.__encoder.encode(headers)
+            size = self.__peer_max_frame_size
+            fragments = [block[i:i + size] for i in range(0, len(block), size)] or [b'']
+            frames = []
+            for i, fragment in enumerate(fragments):
+                flags = FLAG_END_HEADERS if i == len(fragments) - 1 else 0
+                if i == 0:
+                    flags |= FLAG_END_STREAM if end_stream else 0
+                frames.append(self.__frame(FRAME_HEADERS if i == 0 else FRAME_CONTINUATION, flags,
+                                           stream.stream_id, fragment))
+            self.__conn.sendall(b''.join(frames))
+
+    def __send_data(self, stream: H2Stream, data: bytes, end_stream: bool):
+        """
+        Sends data of a stream in DATA frames, waiting for the client to open the flow-control windows if needed.
+        """
+        view = memoryview(data)
+        while True:
+            with self.__lock:
+                while view and (stream.send_window <= 0 or self.__send_window <= 0):
+                    self.__check_stream(stream)
+                    self.__lock.wait()
+                self.__check_stream(stream)
+                size = min(len(view), stream.send_window, self.__send_window, self.__peer_max_frame_size)
+                stream.send_window -= size
+                self.__send_window -= size
+            chunk, view = view[:size], view[size:]
+            self.__send_frame(FRAME_DATA, FLAG_END_STREAM if end_stream and not view else 0, stream.stream_id,
+                              bytes(chunk))
+            if not view:
+                return
+
+    def __check_stream(self, stream: H2Stream):
+        if stream.reset or self.__closed:
+            raise ConnectionAbortedError("Stream {} was reset".format(stream.stream_id))
+
+    def __send_settings(self):
+        payload = struct.pack(">HIHIHI", SETTINGS_MAX_CONCURRENT_STREAMS, H2_MAX_CONCURRENT_STREAMS,
+                              SETTINGS_INITIAL_WINDOW_SIZE, H2_INITIAL_WINDOW_SIZE,
+                              SETTINGS_MAX_HEADER_LIST_SIZE, MAX_HEADER_SIZE)
+        self.__send_frame(FRAME_SETTINGS, 0, 0, payload)
+        if H2_INITIAL_WINDOW_SIZE > DEFAULT_WINDOW_SIZE:
+            # The connection window can only be changed with WINDOW_UPDATE
+            self.__send_window_update(0, H2_INITIAL_WINDOW_SIZE - DEFAULT_WINDOW_SIZE)
+
+    def __send_window_update(self, stream_id: int, increment: int):
+        self.__send_frame(FRAME_WINDOW_UPDATE, 0, stream_id, struct.pack(">I", increment))
+
+    def __send_goaway(self, code: int):
+        if self.__goaway_sent:
+            return
+        self.__goaway_sent = True
+        self.__send_frame(FRAME_GOAWAY, 0, 0, struct.pack(">II", self.__last_stream_id, code))
+
+    def __send_frame(self, frame_type: int, flags: int, stream_id: int, payload: bytes = b''):
+        frame = self.__frame(frame_type, flags, stream_id, payload)
+        with self.__write_lock:
+            self.__conn.sendall(frame)
+
+    @staticmethod
+    def __frame(frame_type: int, flags: int, stream_id: int, payload: bytes) -> bytes:
+        return FRAME_HEADER.pack(len(payload) >> 16, len(payload) & 0xffff, frame_type, flags, stream_id) + payload
+
+    def __close(self):
+        with self.__lock:
+            self.__closed = True
+            streams, self.__streams = list(self.__streams.values()), {}
+            self.__lock.notify_all()
+        for stream in streams:
+            if stream.body is not None and not stream.remote_closed:
+                stream.body.end(reset=True)
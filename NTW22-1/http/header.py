@@ -1,20 +1,31 @@
 HEADER_HOST = 'Host'
 HEADER_CONNECTION = 'Connection'
 HEADER_CONNECTION_CLOSE = 'close'
+HEADER_CONNECTION_UPGRADE = 'Upgrade'
 HEADER_CONTENT_LENGTH = 'Content-Length'
 HEADER_CONTENT_LOCATION = 'Content-Location'
 HEADER_CONTENT_TYPE = 'Content-Type'
 HEADER_CONTENT_TYPE_TEXT_PLAIN = 'text/plain'
+HEADER_CONTENT_TYPE_TEXT_HTML = 'text/html'
+HEADER_CONTENT_TYPE_APPLICATION_JSON = 'application/json'
 HEADER_DATE = 'Date'
+HEADER_ETAG = 'ETag'
+HEADER_EXPECT = 'Expect'
+HEADER_EXPECT_100_CONTINUE = '100-continue'
+HEADER_HTTP2_SETTINGS = 'HTTP2-Settings'
+HEADER_IF_NONE_MATCH = 'If-None-Match'
 HEADER_SERVER = 'Server'
+HEADER_TRANSFER_ENCODING = 'Transfer-Encoding'
+HEADER_TRANSFER_ENCODING_CHUNKED = 'chunked'
+HEADER_UPGRADE = 'Upgrade'
+HEADER_UPGRADE_H2C = 'h2c'
 
 
 class HttpHeader:
     """
     Defines a new HTTP header, with the given name and value.
     """
-    name = None
-    value = None
+    __slots__ = ("name", "value")
 
     def __init__(self, name: str, value: str):
         self.name = name
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+from typing import Dict, List, Tuple
+
+# This file implements HPACK (RFC 7541), the compression of header fields used by HTTP/2. Both the decoder and the
+# encoder keep a dynamic table of recently used header fields, which must be kept in sync with the other endpoint.
+
+# Static table (RFC 7541, Appendix A). Index 0 is not used
+STATIC_TABLE = [
+    (b"", b""),
+    (b":authority", b""),
+    (b":method", b"GET"),
+    (b":method", b"POST"),
+    (b":path", b"/"),
+    (b":path", b"/index.html"),
+    (b":scheme", b"http"),
+    (b":scheme", b"https"),
+    (b":status", b"200"),
+    (b":status", b"204"),
+    (b":status", b"206"),
+    (b":status", b"304"),
+    (b":status", b"400"),
+    (b":status", b"404"),
+    (b":status", b"500"),
+    (b"accept-charset", b""),
+    (b"accept-encoding", b"gzip, deflate"),
+    (b"accept-language", b""),
+    (b"accept-ranges", b""),
+    (b"accept", b""),
+    (b"access-control-allow-origin", b""),
+    (b"age", b""),
+    (b"allow", b""),
+    (b"authorization", b""),
+    (b"cache-control", b""),
+    (b"content-disposition", b""),
+    (b"content-encoding", b""),
+    (b"content-language", b""),
+    (b"content-length", b""),
+    (b"content-location", b""),
+    (b"content-range", b""),
+    (b"content-type", b""),
+    (b"cookie", b""),
+    (b"date", b""),
+    (b"etag", b""),
+    (b"expect", b""),
+    (b"expires", b""),
+    (b"from", b""),
+    (b"host", b""),
+    (b"if-match", b""),
+    (b"if-modified-since", b""),
+    (b"if-none-match", b""),
+    (b"if-range", b""),
+    (b"if-unmodified-since", b""),
+    (b"last-modified", b""),
+    (b"link", b""),
+    (b"location", b""),
+    (b"max-forwards", b""),
+    (b"proxy-authenticate", b""),
+    (b"proxy-authorization", b""),
+    (b"range", b""),
+    (b"referer", b""),
+    (b"refresh", b""),
+    (b"retry-after", b""),
+    (b"server", b""),
+    (b"set-cookie", b""),
+    (b"strict-transport-security", b""),
+    (b"transfer-encoding", b""),
+    (b"user-agent", b""),
+    (b"vary", b""),
+    (b"via", b""),
+    (b"www-authenticate", b""),
+]
+
+# Lengths of the Huffman codes of every symbol (RFC 7541, Appendix B), the last one being EOS. The code is canonical:
+# codes are assigned in order of length and then of symbol, so the codes themselves can be generated from the lengths
+HUFFMAN_CODE_LENGTHS = [
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+    30,
+]
+HUFFMAN_EOS = 256
+
+# Size overhead of every entry of the dynamic table (RFC 7541, section 4.1)
+ENTRY_OVERHEAD = 32
+DEFAULT_TABLE_SIZE = 4096
+
+
+class HpackError(ValueError):
+    """
+    Raised when a header block cannot be decoded. It is a connection error (COMPRESSION_ERROR) in HTTP/2.
+    """
+    pass
+
+
+def __build_huffman_codes() -> List[Tuple[int, int]]:
+    codes = [(0, 0)] * len(HUFFMAN_CODE_LENGTHS)
+    code, previous_length = 0, 0
+    for symbol in sorted(range(len(HUFFMAN_CODE_LENGTHS)), key=lambda s: (HUFFMAN_CODE_LENGTHS[s], s)):
+        length = HUFFMAN_CODE_LENGTHS[symbol]
+        code <<= length - previous_length
+        codes[symbol] = (code, length)
+        code += 1
+        previous_length = length
+    return codes
+
+
+# Code and length of every symbol, and the symbol of every (length, code) for decoding
+HUFFMAN_CODES = __build_huffman_codes()
+HUFFMAN_SYMBOLS: Dict[Tuple[int, int], int] = {(length, code): symbol
+                                               for symbol, (code, length) in enumerate(HUFFMAN_CODES)}
+del __build_huffman_codes
+
+
+def huffman_encode(data: bytes) -> bytes:
+    value, bits = 0, 0
+    for byte in data:
+        code, length = HUFFMAN_CODES[byte]
+        value = (value << length) | code
+        bits += length
+    # Pad with the most significant bits of EOS (all ones) up to a whole byte
+    padding = -bits % 8
+    value = (value << padding) | ((1 << padding) - 1)
+    return value.to_bytes((bits + padding) // 8, "big")
+
+
+def huffman_decode(data: bytes) -> bytes:
+    out = bytearray()
+    code, length = 0, 0
+    for byte in data:
+        for shift in range(7, -1, -1):
+            code = (code << 1) | ((byte >> shift) & 1)
+            length += 1
+            symbol = HUFFMAN_SYMBOLS.get((length, code))
+            if symbol is not None:
+                if symbol == HUFFMAN_EOS:
+                    raise HpackError("EOS symbol found in a Huffman string")
+                out.append(symbol)
+                code, length = 0, 0
+            elif length > 30:
+                raise HpackError("Invalid Huffman code")
+    # The padding has to be shorter than a byte, and made of the most significant bits of EOS (all ones)
+    if length > 7 or code != (1 << length) - 1:
+        raise HpackError("Invalid Huffman padding")
+    return bytes(out)
+
+
+def encode_integer(value: int, prefix_bits: int, first_byte: int = 0) -> bytes:
+    """
+    Encodes an integer with a prefix of N bits (RFC 7541, section 5.1).
+    :param value: integer to be encoded
+    :param prefix_bits: number of bits of the prefix
+    :param first_byte: flags set in the first byte, outside the prefix
+    :return: encoded bytes
+    """
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes([first_byte | value])
+    out = bytearray([first_byte | limit])
+    value -= limit
+    while value >= 128:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_integer(data: bytes, pos: int, prefix_bits: int) -> Tuple[int, int]:
+    """
+    Decodes an integer with a prefix of N bits (RFC 7541, section 5.1).
+    :param data: header block
+    :param pos: position of the first byte of the integer
+    :param prefix_bits: number of bits of the prefix
+    :return: decoded integer, and position after it
+    """
+    if pos >= len(data):
+        raise HpackError("Truncated integer")
+    limit = (1 << prefix_bits) - 1
+    value = data[pos] & limit
+    pos += 1
+    if value < limit:
+        return value, pos
+    shift = 0
+    while True:
+        if pos >= len(data) or shift > 28:
+            raise HpackError("Truncated or too large integer")
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+class HpackTable:
+    """
+    Dynamic table of header fields, where the most recent entry has the lowest index.
+    """
+    __entries = None
+    __size = 0
+    __max_size = DEFAULT_TABLE_SIZE
+
+    def __init__(self, max_size: int = DEFAULT_TABLE_SIZE):
+        self.__entries: List[Tuple[bytes, bytes]] = []
+        self.__size = 0
+        self.__max_size = max_size
+
+    def get(self, index: int) -> Tuple[bytes, bytes]:
+        """
+        Gets an entry given its index in the address space shared by the static and the dynamic tables.
+        :param index: index, starting at 1
+        :return: tuple (name, value)
+        """
+        if 0 < index < len(STATIC_TABLE):
+            return STATIC_TABLE[index]
+        index -= len(STATIC_TABLE)
+        if 0 <= index < len(self.__entries):
+            return self.__entries[index]
+        raise HpackError("Invalid header table index {}".format(index + len(STATIC_TABLE)))
+
+    def find(self, name: bytes, value: bytes) -> Tuple[int, bool]:
+        """
+        Looks for a header field in both tables.
+        :param name: header name
+        :param value: header value
+        :return: index of the best entry (0 if none), and whether the value matches too
+        """
+        name_index = 0
+        for i, (n, v) in enumerate(STATIC_TABLE[1:], start=1):
+            if n == name:
+                if v == value:
+                    return i, True
+                name_index = name_index or i
+        for i, (n, v) in enumerate(self.__entries, start=len(STATIC_TABLE)):
+            if n == name:
+                if v == value:
+                    return i, True
+                name_index = name_index or i
+        return name_index, False
+
+    def add(self, name: bytes, value: bytes):
+        size = len(name) + len(value) + ENTRY_OVERHEAD
+        self.__entries.insert(0, (name, value))
+        self.__size += size
+        self.__evict()
+
+    def resize(self, max_size: int):
+        self.__max_size = max_size
+        self.__evict()
+
+    def get_max_size(self) -> int:
+        return self.__max_size
+
+    def __evict(self):
+        # Remove the oldest entries until the table fits (an entry larger than the table just empties it)
+        while self.__size > self.__max_size and self.__entries:
+            name, value = self.__entries.pop()
+            self.__size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+
+class HpackDecoder:
+    """
+    Decodes the header blocks received in a connection.
+    """
+    __table = None
+    __max_table_size = DEFAULT_TABLE_SIZE
+    __max_list_size = None
+
+    def __init__(self, max_table_size: int = DEFAULT_TABLE_SIZE, max_list_size: int | None = None):
+        """
+        :param max_table_size: maximum size of the dynamic table
+        :param max_list_size: maximum size of the decoded header list (as defined for SETTINGS_MAX_HEADER_LIST_SIZE:
+                              the length of every name and value, plus 32 bytes per field), or None for no limit
+        """
+        self.__table = HpackTable(max_table_size)
+        self.__max_table_size = max_table_size
+        self.__max_list_size = max_list_size
+
+    def decode(self, data: bytes) -> List[Tuple[bytes, bytes]]:
+        """
+        Decodes a whole header block. Decoding stops as soon as the header list exceeds its maximum size, as a small
+        block can reference large entries of the dynamic table many times.
+        :param data: header block
+        :return: list of (name, value) header fields, in order
+        """
+        headers = []
+        list_size = 0
+        pos = 0
+        while pos < len(data):
+            byte = data[pos]
+            if byte & 0x80:
+                # Indexed header field
+                index, pos = decode_integer(data, pos, 7)
+                name, value = self.__table.get(index)
+            elif byte & 0x40:
+                # Literal header field with incremental indexing
+                name, value, pos = self.__decode_literal(data, pos, 6)
+                self.__table.add(name, value)
+            elif byte & 0x20:
+                # Dynamic table size update
+                size, pos = decode_integer(data, pos, 5)
+                if size > self.__max_table_size:
+                    raise HpackError("Dynamic table size update above the allowed maximum")
+                self.__table.resize(size)
+                continue
+            else:
+                # Literal header field without indexing, or never indexed
+                name, value, pos = self.__decode_literal(data, pos, 4)
+            list_size += len(name) + len(value) + ENTRY_OVERHEAD
+            if self.__max_list_size is not None and list_size > self.__max_list_size:
+                raise HpackError("Header list is larger than {} bytes".format(self.__max_list_size))
+            headers.append((name, value))
+        return headers
+
+    def __decode_literal(self, data: bytes, pos: int, prefix_bits: int) -> Tuple[bytes, bytes, int]:
+        index, pos = decode_integer(data, pos, prefix_bits)
+        if index:
+            name = self.__table.get(index)[0]
+        else:
+            name, pos = self.__decode_string(data, pos)
+        value, pos = self.__decode_string(data, pos)
+        return name, value, pos
+
+    @staticmethod
+    def __decode_string(data: bytes, pos: int) -> Tuple[bytes, int]:
+        if pos >= len(data):
+            raise HpackError("Truncated string")
+        huffman = data[pos] & 0x80
+        length, pos = decode_integer(data, pos, 7)
+        if pos + length > len(data):
+            raise HpackError("Truncated string")
+        value = data[pos:pos + length]
+        return (huffman_decode(value) if huffman else value), pos + length
+
+
+class HpackEncoder:
+    """
+    Encodes the header blocks sent in a connection. Header fields whose values change in every response are not
+    added to the dynamic table.
+    """
+    __table = None
+    __pending_size_update = None
+
+    # Headers not worth (or not safe) to be added to the dynamic table
+    NOT_INDEXED = {b":path", b"content-length", b"date", b"etag", b"last-modified", b"content-location",
+                   b"set-cookie", b"authorization", b"cookie"}
+
+    def __init__(self):
+        self.__table = HpackTable()
+        self.__pending_size_update = None
+
+    def resize(self, max_size: int):
+        """
+        Applies the maximum table size allowed by the decoder of the other endpoint. The next header block will
+        signal the new size.
+        :param max_size: maximum size of the dynamic table
+        """
+        max_size = min(max_size, DEFAULT_TABLE_SIZE)
+        if max_size != self.__table.get_max_size():
+            self.__table.resize(max_size)
+            self.__pending_size_update = max_size
+
+    def encode(self, headers: List[Tuple[bytes, bytes]]) -> bytes:
+        """
+        Encodes a whole header block.
+        :param headers: list of (name, value) header fields, with lowercase names
+        :return: header block
+        """
+        out = bytearray()
+        if self.__pending_size_update is not None:
+            out += encode_integer(self.__pending_size_update, 5, 0x20)
+            self.__pending_size_update = None
+
+        for name, value in headers:
+            index, exact = self.__table.find(name, value)
+            if exact:
+                # Indexed header field
+                out += encode_integer(index, 7, 0x80)
+                continue
+            if name in self.NOT_INDEXED:
+                # Literal header field without indexing
+                out += encode_integer(index, 4, 0x00)
+            else:
+                # Literal header field with incremental indexing
+                out += encode_integer(index, 6, 0x40)
+                self.__table.add(name, value)
+            if not index:
+                out += self.__encode_string(name)
+            out += self.__encode_string(value)
+        return bytes(out)
+
+    @staticmethod
+    def __encode_string(value: bytes) -> bytes:
+        # Use the Huffman code only if it is shorter
+        encoded = huffman_encode(value)
+        if len(encoded) < len(value):
+            return encode_integer(len(encoded), 7, 0x80) + encoded
+        return encode_integer(len(value), 7, 0x00) + value
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 from typing import List, Dict
+from urllib.parse import parse_qsl, unquote
 
 from http.enums import HttpMethod, HttpVersion
-from http.header import HttpHeader, HEADER_CONTENT_LENGTH, HEADER_HOST
+from http.header import HttpHeader, HEADER_CONTENT_LENGTH, HEADER_HOST, HEADER_TRANSFER_ENCODING, \
+    HEADER_TRANSFER_ENCODING_CHUNKED
 from http.response import HttpResponseBadRequest, HttpResponseNotImplemented, HttpResponseHttpVersionNotSupported, \
     HttpResponseForbidden, HttpResponseNotFound
+from http.stream import SocketReader, HttpBodyStream, FixedLengthBodyStream, ChunkedBodyStream, END_OF_HEAD, \
+    is_decimal
 from settings import HTTP_ENCODING
 from utils.vhosts import Vhost
 
@@ -17,22 +21,56 @@ class HttpRequest:
     Constructing the class will throw HttpResponseError with further information on why the request is not
     valid.
     """
-    # Note this lines variable is only used internally
-    __lines = None
-    __method, __path, __http_version = None, None, None
-    __headers = {}
-    __body = None
-    __vhost = None
-
-    def __init__(self, raw_bytes: bytes):
+    __slots__ = ("__lines", "__method", "__path", "__query", "__target", "__http_version", "__headers", "__body",
+                 "__body_stream", "__pending", "__framed", "__vhost")
+
+    def __init__(self, raw_bytes: bytes | None = None):
         """
         Given an array of bytes, tries to parse the request.
-        :param raw_bytes:
+        :param raw_bytes: request head, optionally followed by the whole request body. If not given, the object is
+                          created empty, to be filled later with reset()
+        """
+        self.__headers = {}
+        self.__clear()
+        if raw_bytes is not None:
+            self.__parse_head(raw_bytes)
+
+    def reset(self, raw_bytes: bytes):
         """
+        Reuses this object for a new request (e.g. the next one of the same connection), parsing it as the
+        constructor does. The dictionary of headers is kept, to avoid allocating it again.
+        :param raw_bytes: request head, optionally followed by the whole request body
+        """
+        self.__headers.clear()
+        self.__clear()
+        self.__parse_head(raw_bytes)
+
+    def __clear(self):
+        # Note this lines variable is only used internally
+        self.__lines = None
+        self.__method, self.__path, self.__query, self.__target, self.__http_version = None, None, None, None, None
+        self.__body = None
+        self.__body_stream = None
+        self.__pending = None
+        self.__framed = False
+        self.__vhost = None
+
+    def __parse_head(self, raw_bytes: bytes):
         if not raw_bytes:
             raise HttpResponseBadRequest(content="No data found to be parsed")
 
-        raw_data = raw_bytes.decode(HTTP_ENCODING)
+        # Split the head (request-line and headers) from the body bytes received along with it (if any)
+        head_end = raw_bytes.find(END_OF_HEAD)
+        if head_end != -1:
+            head_end += len(END_OF_HEAD)
+            raw_bytes, self.__pending = raw_bytes[:head_end], raw_bytes[head_end:]
+        else:
+            self.__pending = b''
+
+        try:
+            raw_data = raw_bytes.decode(HTTP_ENCODING)
+        except UnicodeDecodeError:
+            raise HttpResponseBadRequest(content="Request head is not valid {}".format(HTTP_ENCODING))
         self.__lines = raw_data.split("\r\n")
         if len(self.__lines) == 0:
             raise HttpResponseBadRequest(content="No data found")
@@ -45,11 +83,6 @@ class HttpRequest:
         #       This is done as such so, in case of errors in the headers or when generating the response,
         #       we can appropiately indicate headers and other HTTP data at a later stage.
 
-        # Reset the rest of the fields
-        self.__headers = {}
-        self.__body = None
-        self.__vhost = None
-
     def __init_parse_requestline(self, lines):
         """
         Given an array of lines, get the first one and parse it with the request-line format
@@ -76,11 +109,21 @@ class HttpRequest:
         # Check that path is an absolute URL (proxy-URL is not supported)
         if path[0] != "/":
             raise HttpResponseBadRequest(content="Path must be absolute, starting with /")
+        # Keep the original request-target, as it is needed to forward the request
+        self.__target = path
+        # Split the query string from the path, and decode the percent-encoded characters of the path
+        path, _, query = path.partition("?")
+        path = unquote(path)
+        # A decoded NUL (or any other control character) cannot be part of a file name, e.g. open() fails with it
+        if any(c < " " or c == "\x7f" for c in path):
+            raise HttpResponseBadRequest(content="Path contains control characters")
         # Confirm that path is secure (does not try to access outside of host's folder scope)
         if not Vhost.is_secure_path(path):
             raise HttpResponseForbidden(content="Trying to access a folder outside the host root")
-        # Remove the starting /, and remove the query string as well
-        self.__path = path[1:].split("?")[0]
+        # Remove the starting /, and keep the query string parameters apart (including flags without value, such as
+        # ?metrics, which parse_qsl drops by default)
+        self.__path = path[1:]
+        self.__query = dict(parse_qsl(query, keep_blank_values=True))
 
         # Now, try to parse the HTTP version
         http = http_version.split("/")
@@ -110,12 +153,17 @@ class HttpRequest:
             raise HttpResponseHttpVersionNotSupported(content="HTTP version {} is not available".format(http_version))
         self.__http_version = http_version
 
-    def parse_request(self, hosts: Dict[str, Vhost]):
+    def parse_request(self, hosts: Dict[str, Vhost], reader: SocketReader | None = None,
+                      body_stream: HttpBodyStream | None = None):
         """
         Method that finishes parsing the raw request. Can only be invoked once, and must be invoked right after
         constructing the object. It will get the remaining lines to be parsed, and extract both headers and
         request body.
         :param hosts: dictionary of available hosts in the server
+        :param reader: connection reader from where the body will be streamed. If not given, the whole body must
+                       have been given when constructing the object
+        :param body_stream: stream of the body, when it is not delimited in the request head but received apart
+                            (e.g. in HTTP/2 DATA frames)
         """
         # If lines is None, we have already parsed the request
         if self.__lines is None:
@@ -124,6 +172,11 @@ class HttpRequest:
         # Then we parse the header lines (which follow right after the request-line)
         c_headers = self.__init_parse_headers(self.__lines[1:])
 
+        # Then we parse the body (or we make sure that such body is not present). It is done before checking the
+        # host so, even if the request fails, its body can be skipped and the connection reused
+        self.__init_parse_body(self.__lines[(1 + c_headers + 1):], reader, body_stream)
+        self.__framed = True
+
         # For HTTP/1.0, if no Host header is present, add it with the first entry (dictionaries in Python 3.6+
         # are ordered)
         if self.__http_version == HttpVersion.HTTP_10 and not self.has_header(HEADER_HOST):
@@ -146,9 +199,6 @@ class HttpRequest:
             raise HttpResponseNotFound(content='Host {} is not found'.format(host.value))
         self.__vhost = hosts[host.value.lower()]
 
-        # And finally, we parse the body (or we make sure that such body is not present)
-        self.__init_parse_body(self.__lines[(1 + c_headers + 1):])
-
         # And indicate that request has been parsed already
         self.__lines = None
 
@@ -179,40 +229,60 @@ class HttpRequest:
             raise HttpResponseBadRequest(content="Could not find CRLF after headers parsing")
         return count
 
-    def __init_parse_body(self, lines):
+    def __init_parse_body(self, lines, reader: SocketReader | None, body_stream: HttpBodyStream | None):
         """
-        Function that given the remaining lines of the request, will check for the body if needed.
-        :param lines: "body" part
+        Function that given the remaining lines of the request head, will check for the body if needed. The body
+        is not read here: a body stream is prepared, so the handler can read it while it is being received.
+        :param lines: remaining lines of the head, after the headers
+        :param reader: connection reader from where the body will be read (None if given at construction)
+        :param body_stream: stream of the body, if it is received apart (its length is already checked)
         :return:
         """
-        if not self.has_header(HEADER_CONTENT_LENGTH):
-            # If no Content-Length header is present, it means that we can NOT receive any body. Thus, the remaining
-            # lines has to be an empty one (the CRLF that ends the request)
-            if len(lines) != 1 or lines[0] != '':
-                raise HttpResponseBadRequest(content="Expecting no request body, but found")
+        # The head has to end right after the headers, with the CRLF that ends the request head
+        if len(lines) != 1 or lines[0] != '':
+            raise HttpResponseBadRequest(content="Expecting no request body, but found")
+
+        if body_stream is not None:
+            self.__pending = None
+            self.__body_stream = body_stream
             return
 
         # Note that PUT method does not strictly require to have a body, nor GET or DELETE are forbidden to
         # contain such body.
         # https://stackoverflow.com/questions/1233372/is-an-http-put-request-required-to-include-a-body
 
-        # If Content-Length is present, we check if the length of the remaining data matches the specified
-        # Content-Length value
-        body = "\r\n".join(lines)
-        actual_length = len(body)
-        try:
-            val = self.get_header(HEADER_CONTENT_LENGTH)
-            if val is None:
-                raise ValueError
-            # If the value of the header is not an integer, then it is malformed
-            expected_length = int(val.value)
-        except ValueError:
-            raise HttpResponseBadRequest(content="Could not parse Content-Length")
-
-        if expected_length != actual_length:
-            raise HttpResponseBadRequest(content="Request body differs from the specified Content-Length value")
-        # And save the body data
-        self.__body = body
+        in_memory = reader is None
+        if in_memory:
+            # The body (if any) was received along with the head
+            reader = SocketReader(data=self.__pending)
+        self.__pending = None
+
+        if self.has_header(HEADER_TRANSFER_ENCODING):
+            # Only the chunked transfer coding is supported, without any other coding applied before
+            codings = [c.strip().lower() for c in self.get_header(HEADER_TRANSFER_ENCODING).value.split(",")]
+            if codings != [HEADER_TRANSFER_ENCODING_CHUNKED]:
+                raise HttpResponseNotImplemented(content="Transfer-Encoding {} is not supported".format(
+                    self.get_header(HEADER_TRANSFER_ENCODING).value))
+            # A message with both headers could be used to smuggle requests, so reject it
+            if self.has_header(HEADER_CONTENT_LENGTH):
+                raise HttpResponseBadRequest(content="Both Content-Length and Transfer-Encoding are present")
+            self.__body_stream = ChunkedBodyStream(reader)
+
+        elif self.has_header(HEADER_CONTENT_LENGTH):
+            # Only plain decimal digits: int() would also take signs, underscores or spaces, which other servers
+            # (e.g. a proxy in front of this one) may read differently
+            value = self.get_header(HEADER_CONTENT_LENGTH).value
+            if not is_decimal(value):
+                raise HttpResponseBadRequest(content="Could not parse Content-Length")
+            self.__body_stream = FixedLengthBodyStream(reader, int(value))
+
+        if in_memory:
+            # If no Content-Length nor Transfer-Encoding header is present, it means that we can NOT receive any
+            # body. Otherwise, the given data has to match the body exactly
+            if self.__body_stream is not None:
+                self.__body = self.__body_stream.read()
+            if reader.has_buffered_data():
+                raise HttpResponseBadRequest(content="Request body differs from the specified Content-Length value")
 
     def get_method(self) -> HttpMethod:
         return self.__method
@@ -220,6 +290,12 @@ class HttpRequest:
     def get_path(self) -> str:
         return self.__path
 
+    def get_target(self) -> str:
+        return self.__target
+
+    def get_query(self) -> Dict[str, str]:
+        return self.__query
+
     def get_http_version(self) -> HttpVersion:
         return self.__http_version
 
@@ -229,9 +305,20 @@ class HttpRequest:
     def get_vhost(self) -> Vhost:
         return self.__vhost
 
-    def get_body(self) -> str | None:
+    def get_body(self) -> bytes | None:
+        # Reads the whole body, if it is still being streamed
+        if self.__body is None and self.__body_stream is not None:
+            self.__body = self.__body_stream.read()
         return self.__body
 
+    def get_body_stream(self) -> HttpBodyStream | None:
+        return self.__body_stream
+
+    def is_framed(self) -> bool:
+        # Whether the end of the request is known (its body, if any, is delimited), so the bytes that follow it in
+        # the connection can be read as the next request
+        return self.__framed
+
     def has_header(self, name: str):
         return name.lower() in self.__headers
 
@@ -1,43 +1,64 @@
 from __future__ import annotations
 
+from typing import Iterable, List
+
 from http.enums import HttpResponseCode
 from http.header import HttpHeader
 from settings import HTTP_ENCODING
 
 
-class HttpResponse:
+class BaseHttpResponse:
     """
     Base class for a HTTP response object. Contains the response code (status), the headers and the content
     (if any).
     This class can be treated as a dictionary, where the keys are header names and the values are HttpHeader
     objects.
+    The content can also be an iterable (e.g. a generator) of strings or bytes, in which case the body is streamed
+    while it is being generated.
+    The fields are not declared here: HttpResponse keeps them in slots, while HttpResponseError cannot have slots
+    (as it also extends RuntimeError), so it keeps them in its instance dictionary.
     """
-    __status = None
-    __headers = {}
-    __content = None
+    __slots__ = ()
 
     def __init__(self,
                  status: HttpResponseCode = HttpResponseCode.OK,
-                 content: str | bytes | None = None):
-        # Saves the basic data (inmutable) to the class attributes
-        self.__status = status
-        self.__content = content
-        self.__headers = {}
+                 content: str | bytes | Iterable[str | bytes] | None = None):
+        # Saves the basic data (inmutable) to the instance attributes
+        self._status = status
+        self._content = content
+        self._headers = {}
+
+    def reset(self,
+              status: HttpResponseCode = HttpResponseCode.OK,
+              content: str | bytes | Iterable[str | bytes] | None = None):
+        """
+        Reuses this object for a new response, as if it was just constructed. The dictionary of headers is kept, to
+        avoid allocating it again.
+        """
+        self._status = status
+        self._content = content
+        self._headers.clear()
+
+    def set_status(self, status: HttpResponseCode):
+        self._status = status
+
+    def set_content(self, content: str | bytes | Iterable[str | bytes] | None):
+        self._content = content
 
     def get_status_code(self):
         # Returns the status code
-        return self.__status
+        return self._status
 
     def has_header(self, name: str):
         # Check if a given header is present
-        return name.lower() in self.__headers
+        return name.lower() in self._headers
 
     # Treats the "in" keyword as has_header function with objects of HttpResponse
     __contains__ = has_header
 
     def add_header(self, key: str, header: HttpHeader):
         # Saves the specified header into the dictionary of headers
-        self.__headers[key.lower()] = header
+        self._headers[key.lower()] = header
 
     # Treats the HttpResponse[HEADER] = VALUE as add_header function with objects of HttpResponse
     __setitem__ = add_header
@@ -47,49 +68,68 @@ class HttpResponse:
         if not self.has_header(name):
             return None
         # Else return the HttpHeader object
-        return self.__headers[name.lower()]
+        return self._headers[name.lower()]
 
     # Treats the HttpResponse[HEADER] as get_header function with objects of HttpResponse
     __getitem__ = get_header
 
+    def get_headers(self) -> List[HttpHeader]:
+        return list(self._headers.values())
+
     def del_header(self, name: str):
         # Do nothing if the header is not present
         if not self.has_header(name):
             return
         # Else delete the header
-        self.__headers.pop(name.lower())
+        self._headers.pop(name.lower())
 
     # Treats the "del" keyword as has_header function with objects of HttpResponse
     __delitem__ = del_header
 
-    def get_content(self) -> str | bytes | None:
-        return self.__content
+    def get_content(self) -> str | bytes | Iterable[str | bytes] | None:
+        return self._content
+
+    def is_streamed(self) -> bool:
+        # Content is streamed if it is neither a string nor bytes (and there is content)
+        return self._content is not None and not isinstance(self._content, (str, bytes))
+
+    def is_relayed(self) -> bool:
+        # Whether the response comes from another server (see utils/proxy.py), so its headers are sent as received
+        return False
 
     def serialize_headers(self):
-        if len(self.__headers) == 0:
+        headers = self.get_headers()
+        if len(headers) == 0:
             # If no headers are present, just return an empty string
             return ''
         # Else, concatenate all of them with the HTTP format and append \r\n to the last one (join only adds it
         # in between)
-        return '\r\n'.join("{}: {}".format(h.name, h.value) for h in self.__headers.values()) + '\r\n'
+        return '\r\n'.join("{}: {}".format(h.name, h.value) for h in headers) + '\r\n'
 
     def serialize(self):
         # Convert to string headers with content (if present)
-        return self.serialize_headers() + '\r\n' + (str(self.__content) if self.__content is not None else '')
+        return self.serialize_headers() + '\r\n' + (str(self._content) if self._content is not None else '')
 
     def __bytes__(self):
         out = (self.serialize_headers() + '\r\n').encode(HTTP_ENCODING)
-        if self.__content is not None:
-            content = self.__content
-            if isinstance(self.__content, str):
+        if self._content is not None:
+            content = self._content
+            if isinstance(self._content, str):
                 content = content.encode(HTTP_ENCODING)
             out += content
         return out
 
 
-class HttpResponseError(HttpResponse, RuntimeError):
+class HttpResponse(BaseHttpResponse):
+    """
+    HTTP response object, with its fields kept in slots so it is compact and cheap to allocate.
+    """
+    __slots__ = ("_status", "_headers", "_content")
+
+
+class HttpResponseError(BaseHttpResponse, RuntimeError):
     """
-    Specific subclass of HttpResponse which indicates an error has been catched. It extends RuntimeError,
+    Specific kind of response which indicates an error has been catched. It extends RuntimeError,
     so it can be thrown (specifically during the HttpRequest object construction while parsing the
     request).
     Then other sub-classes are defined for other response codes.
@@ -146,6 +186,27 @@ class HttpResponseNotImplemented(HttpResponseError):
                                                          *args, **kwargs)
 
 
+# 502
+class HttpResponseBadGateway(HttpResponseError):
+    def __init__(self, *args, **kwargs):
+        super(HttpResponseBadGateway, self).__init__(status=HttpResponseCode.BAD_GATEWAY,
+                                                     *args, **kwargs)
+
+
+# 503
+class HttpResponseServiceUnavailable(HttpResponseError):
+    def __init__(self, *args, **kwargs):
+        super(HttpResponseServiceUnavailable, self).__init__(status=HttpResponseCode.SERVICE_UNAVAILABLE,
+                                                             *args, **kwargs)
+
+
+# 504
+class HttpResponseGatewayTimeout(HttpResponseError):
+    def __init__(self, *args, **kwargs):
+        super(HttpResponseGatewayTimeout, self).__init__(status=HttpResponseCode.GATEWAY_TIMEOUT,
+                                                         *args, **kwargs)
+
+
 # 505
 class HttpResponseHttpVersionNotSupported(HttpResponseError):
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+from typing import Callable, Iterable, Iterator
+
+from http.response import HttpResponseBadRequest
+from settings import HTTP_ENCODING, MAX_HEADER_SIZE, RECV_BUFFER_SIZE
+
+# This file defines the classes used to read data from a connection. Requests are not received in a single recv()
+# call, so a buffered reader is used to get the request head, and then body streams which read (only) the body bytes
+# of the request, either delimited by Content-Length or by the chunked transfer coding.
+
+CRLF = b"\r\n"
+END_OF_HEAD = b"\r\n\r\n"
+# HTTP/2 connection preface sent by the client. The first part is what read_head() returns, so HTTP/2 connections
+# can be detected without loading the HTTP/2 implementation (see http/h2.py)
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+PREFACE_HEAD = b"PRI * HTTP/2.0\r\n\r\n"
+DECIMAL_DIGITS = frozenset("0123456789")
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+
+
+def is_decimal(value: str) -> bool:
+    # Unlike str.isdigit(), only ASCII digits
+    return value != "" and all(c in DECIMAL_DIGITS for c in value)
+
+
+def is_hex(value: bytes) -> bool:
+    return value != b"" and all(c in HEX_DIGITS for c in value)
+
+
+class SocketReader:
+    """
+    Buffered reader over a socket. Bytes received but not yet consumed (e.g. a pipelined request) are kept in the
+    buffer for the following reads.
+    If no socket is given, it reads only from the initial data. If a recorder is given, it is called with every
+    block of bytes received from the socket.
+    Data is received into a block of RECV_BUFFER_SIZE bytes which is reused for every recv() call of the connection,
+    instead of allocating one per call.
+    """
+    __slots__ = ("__conn", "__buffer", "__recorder", "__recv_buffer")
+
+    def __init__(self, conn=None, data: bytes = b'', recorder: Callable[[bytes], None] | None = None):
+        self.__conn = conn
+        self.__buffer = bytearray(data)
+        self.__recorder = recorder
+        # Allocated on the first recv() call
+        self.__recv_buffer = None
+
+    def fill(self) -> bool:
+        """
+        Receives more data from the socket into the buffer.
+        :return: False if the connection was closed (or there is no socket)
+        """
+        if self.__conn is None:
+            return False
+        if self.__recv_buffer is None:
+            self.__recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        size = self.__conn.recv_into(self.__recv_buffer)
+        if not size:
+            return False
+        with memoryview(self.__recv_buffer) as view:
+            if self.__recorder is not None:
+                self.__recorder(bytes(view[:size]))
+            self.__buffer += view[:size]
+        return True
+
+    def has_buffered_data(self) -> bool:
+        return len(self.__buffer) > 0
+
+    def get_buffered_size(self) -> int:
+        return len(self.__buffer)
+
+    def read_head(self, max_size: int = MAX_HEADER_SIZE) -> bytes:
+        """
+        Reads the request head (request-line and headers), up to and including the empty line that ends it.
+        If the connection is closed before that, returns whatever was received.
+        :param max_size: maximum allowed size of the head
+        :return: head bytes
+        """
+        start = 0
+        while True:
+            # Only look again at the last bytes already checked, in case the CRLFCRLF was split between recv() calls
+            end = self.__buffer.find(END_OF_HEAD, start)
+            if end != -1:
+                return self.__take(end + len(END_OF_HEAD))
+            if len(self.__buffer) > max_size:
+                raise HttpResponseBadRequest(content="Request head is too large")
+            start = max(0, len(self.__buffer) - len(END_OF_HEAD) + 1)
+            if not self.fill():
+                return self.__take(len(self.__buffer))
+
+    def readline(self, max_size: int = MAX_HEADER_SIZE) -> bytes:
+        """
+        Reads a line ended by CRLF, which is not included in the returned value.
+        :param max_size: maximum allowed size of the line
+        :return: line bytes
+        """
+        start = 0
+        while True:
+            end = self.__buffer.find(CRLF, start)
+            if end != -1:
+                line = self.__take(end + len(CRLF))
+                return line[:-len(CRLF)]
+            if len(self.__buffer) > max_size:
+                raise HttpResponseBadRequest(content="Line is too large")
+            start = max(0, len(self.__buffer) - 1)
+            if not self.fill():
+                raise HttpResponseBadRequest(content="Connection closed in the middle of a line")
+
+    def read(self, size: int) -> bytes:
+        """
+        Reads up to size bytes, waiting for data only if the buffer is empty.
+        :param size: maximum number of bytes to be read
+        :return: read bytes (empty if the connection was closed)
+        """
+        if not self.__buffer and not self.fill():
+            return b''
+        return self.__take(min(size, len(self.__buffer)))
+
+    def read_exact(self, size: int) -> bytes:
+        """
+        Reads exactly size bytes.
+        :param size: number of bytes to be read
+        :return: read bytes
+        """
+        while len(self.__buffer) < size:
+            if not self.fill():
+                raise HttpResponseBadRequest(content="Connection closed before receiving the whole body")
+        return self.__take(size)
+
+    def __take(self, size: int) -> bytes:
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+
+class HttpBodyStream:
+    """
+    Base class for a request body which is read from the connection on demand. It can be iterated to get the body
+    in blocks, so handlers do not need to keep the whole body in memory.
+    """
+    _reader = None
+    _finished = False
+
+    def __init__(self, reader: SocketReader):
+        self._reader = reader
+        self._finished = False
+
+    def read_block(self) -> bytes:
+        """
+        Reads the next block of the body.
+        :return: block of bytes, or empty bytes once the whole body has been read
+        """
+        raise NotImplementedError()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            block = self.read_block()
+            if not block:
+                return
+            yield block
+
+    def read(self) -> bytes:
+        """
+        Reads the rest of the body.
+        :return: body bytes
+        """
+        return b''.join(self)
+
+    def discard(self):
+        """
+        Skips the rest of the body, so the next request in the connection can be read.
+        """
+        for _ in self:
+            pass
+
+    def is_finished(self) -> bool:
+        return self._finished
+
+
+class FixedLengthBodyStream(HttpBodyStream):
+    """
+    Body whose length is given by the Content-Length header.
+    """
+    __remaining = 0
+
+    def __init__(self, reader: SocketReader, length: int):
+        super(FixedLengthBodyStream, self).__init__(reader)
+        self.__remaining = length
+        self._finished = length == 0
+
+    def read_block(self) -> bytes:
+        if self.__remaining == 0:
+            self._finished = True
+            return b''
+        block = self._reader.read(min(self.__remaining, RECV_BUFFER_SIZE))
+        if not block:
+            raise HttpResponseBadRequest(content="Request body differs from the specified Content-Length value")
+        self.__remaining -= len(block)
+        return block
+
+
+class ChunkedBodyStream(HttpBodyStream):
+    """
+    Body sent with "Transfer-Encoding: chunked". Each block returned is (part of) a chunk, without the chunk framing.
+    """
+    __remaining = 0
+
+    def __init__(self, reader: SocketReader):
+        super(ChunkedBodyStream, self).__init__(reader)
+        self.__remaining = 0
+
+    def read_block(self) -> bytes:
+        if self._finished:
+            return b''
+        if self.__remaining == 0:
+            # Get the size of the next chunk, ignoring any chunk extension (which may be preceded by whitespace)
+            size_line = self._reader.readline().split(b";")[0].rstrip(b" \t")
+            # Only hexadecimal digits: int() would also take signs, underscores, spaces or a 0x prefix
+            if not is_hex(size_line):
+                raise HttpResponseBadRequest(content="Could not parse chunk size")
+            self.__remaining = int(size_line, 16)
+
+            if self.__remaining == 0:
+                # Last chunk: skip the trailer section, until the empty line that ends the body. The whole section is
+                # limited as the request head is, so a client cannot keep sending trailer lines forever
+                trailer_size = 0
+                while True:
+                    line = self._reader.readline(MAX_HEADER_SIZE - trailer_size)
+                    trailer_size += len(line) + len(CRLF)
+                    if trailer_size > MAX_HEADER_SIZE:
+                        raise HttpResponseBadRequest(content="Trailer section is too large")
+                    if line == b'':
+                        break
+                self._finished = True
+                return b''
+
+        block = self._reader.read(min(self.__remaining, RECV_BUFFER_SIZE))
+        if not block:
+            raise HttpResponseBadRequest(content="Connection closed in the middle of a chunk")
+        self.__remaining -= len(block)
+        if self.__remaining == 0 and self._reader.read_exact(len(CRLF)) != CRLF:
+            raise HttpResponseBadRequest(content="Chunk data is not followed by CRLF")
+        return block
+
+
+def encode_chunked(content: Iterable[str | bytes]) -> Iterator[bytes]:
+    """
+    Given an iterable of blocks, generates the body with the chunked transfer coding.
+    :param content: blocks of the body, as strings or bytes
+    :return: iterator of chunks, ended by the last (empty) chunk
+    """
+    for block in content:
+        if isinstance(block, str):
+            block = block.encode(HTTP_ENCODING)
+        # An empty chunk would indicate the end of the body, so skip them
+        if not block:
+            continue
+        yield b"%X\r\n" % len(block) + block + CRLF
+    yield b"0\r\n\r\n"
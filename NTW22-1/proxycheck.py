@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+
+from __future__ import annotations
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from http.h2 import FLAG_END_HEADERS, FLAG_END_STREAM, FRAME_CONTINUATION, FRAME_DATA, FRAME_HEADER, \
+    FRAME_HEADERS, FRAME_SETTINGS
+from http.hpack import HpackDecoder, HpackEncoder
+from http.stream import SocketReader, ChunkedBodyStream, FixedLengthBodyStream, PREFACE
+from replay import parse_head_headers
+from settings import UPSTREAM_MAX_CONNECTIONS
+
+# Checks the reverse proxy (vhosts with the upstream option) against a local stand-in backend. The backend is started
+# in this process, and a server in another process (on free ports, in a temporary folder with its own vhosts.conf)
+# forwards the requests of its only vhost to it. Each check sends a request through the server, and compares what the
+# client gets with what the backend sent (or what the backend gets with what the client sent).
+
+# Host of the vhost forwarded to the backend
+HOSTNAME = "backend.local"
+# Value of the Server and Date headers of the backend, which must reach the client unchanged
+BACKEND_SERVER = "stub-backend"
+BACKEND_DATE = "Mon, 01 Jan 2024 00:00:00 GMT"
+# Seconds to wait for the responses of the server
+RESPONSE_TIMEOUT = 10
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def backend_response(method: str, path: str, headers: Dict[str, str], body: bytes) -> bytes:
+    """
+    Generates the response of the backend to a request.
+    :param method: method of the request
+    :param path: request-target of the request
+    :param headers: headers of the request, by lowercase name
+    :param body: body of the request
+    :return: raw response
+    """
+    common = "Server: {}\r\nDate: {}\r\n".format(BACKEND_SERVER, BACKEND_DATE)
+    if path == "/hello":
+        # X-Hop only applies to this connection, as listed in the Connection header
+        return ("HTTP/1.1 200 OK\r\n{}Connection: X-Hop\r\nX-Hop: secret\r\nKeep-Alive: timeout=5\r\n"
+                "Content-Length: 5\r\n\r\nhello".format(common)).encode()
+    if path == "/not-modified":
+        # The Content-Length of a 304 response is the one of the file the client already has
+        return "HTTP/1.1 304 Not Modified\r\n{}Content-Length: 42\r\n\r\n".format(common).encode()
+    if path == "/cookies":
+        # Repeated headers, which must reach the client apart (Set-Cookie values cannot be merged)
+        return ("HTTP/1.1 200 OK\r\n{}Set-Cookie: a=1\r\nSet-Cookie: b=2\r\nContent-Length: 2\r\n\r\n"
+                "ok".format(common)).encode()
+    if path == "/chunked":
+        return ("HTTP/1.1 200 OK\r\n{}Transfer-Encoding: chunked\r\n\r\n"
+                "5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n".format(common)).encode()
+    if path == "/latin1":
+        # Header value which is not valid UTF-8
+        return "HTTP/1.1 200 OK\r\n{}X-Name: caf\xe9\r\nContent-Length: 2\r\n\r\nok".format(common).encode("latin-1")
+    if path == "/headers":
+        # The names of the headers received, so the client can check which ones were forwarded
+        names = ",".join(sorted(headers)).encode()
+        return "HTTP/1.1 200 OK\r\n{}Content-Length: {}\r\n\r\n".format(common, len(names)).encode() + names
+    if method == "PUT":
+        size = str(len(body)).encode()
+        return "HTTP/1.1 201 Created\r\n{}Content-Length: {}\r\n\r\n".format(common, len(size)).encode() + size
+    return "HTTP/1.1 404 Not Found\r\n{}Content-Length: 0\r\n\r\n".format(common).encode()
+
+
+class Backend:
+    """
+    Minimal HTTP/1.1 server used as upstream server, with keep-alive connections.
+    """
+    __socket = None
+
+    def __init__(self, port: int):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(('127.0.0.1', port))
+        self.__socket.listen(64)
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def close(self):
+        self.__socket.close()
+
+    def __accept(self):
+        while True:
+            try:
+                conn, _ = self.__socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def __serve(conn: socket.socket):
+        reader = SocketReader(conn)
+        with conn:
+            while True:
+                head = reader.read_head()
+                if not head:
+                    return
+                request_line, headers = parse_head_headers(head)
+                method, path = request_line.split(" ")[:2]
+                if headers.get("transfer-encoding", "").lower() == "chunked":
+                    body = ChunkedBodyStream(reader).read()
+                else:
+                    body = FixedLengthBodyStream(reader, int(headers.get("content-length", "0"))).read()
+                conn.sendall(backend_response(method, path, headers, body))
+
+
+def start_server(port: int, backend_port: int, folder: str) -> subprocess.Popen:
+    """
+    Starts server.py in another process, with a single vhost forwarded to the backend, and waits until it accepts
+    connections.
+    :param port: port of the server
+    :param backend_port: port of the backend
+    :param folder: working folder of the server, where its vhosts.conf is written
+    :return: server process
+    """
+    with open(os.path.join(folder, "vhosts.conf"), mode='w') as f:
+        f.write("{},-,Proxy Check,check@usi.ch,upstream=127.0.0.1:{}\n".format(HOSTNAME, backend_port))
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+               "-p", str(port), "--preload", "off"]
+    process = subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start on port {}".format(port))
+
+
+def send(port: int, method: str, path: str, extra_headers: str = "", body: bytes = b"") \
+        -> Tuple[int, Dict[str, str], bytes]:
+    """
+    Sends a request to the server, in its own connection.
+    :return: status code, headers (by lowercase name) and body of the response
+    """
+    head = "{} {} HTTP/1.1\r\nHost: {}\r\n{}".format(method, path, HOSTNAME, extra_headers)
+    if body:
+        head += "Content-Length: {}\r\n".format(len(body))
+    with socket.create_connection(('127.0.0.1', port), timeout=RESPONSE_TIMEOUT) as sock:
+        sock.sendall(head.encode() + b"\r\n" + body)
+        reader = SocketReader(sock)
+        head = reader.read_head()
+        if not head:
+            raise ConnectionError("connection closed without a response")
+        status_line, headers = parse_head_headers(head)
+        status = int(status_line.split(" ")[1])
+        if status == 304:
+            content = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            content = ChunkedBodyStream(reader).read()
+        else:
+            content = FixedLengthBodyStream(reader, int(headers.get("content-length", "0"))).read()
+    return status, headers, content
+
+
+def h2_frame(frame_type: int, flags: int, stream_id: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload) >> 16, len(payload) & 0xffff, frame_type, flags, stream_id) + payload
+
+
+def send_h2(port: int, method: str, path: str, body: bytes, content_length: bool) -> Tuple[int, bytes]:
+    """
+    Sends a request to the server over HTTP/2 (with prior knowledge), in its own connection, with its body in a
+    single DATA frame.
+    :param content_length: whether to send the content-length header
+    :return: status code and body of the response
+    """
+    headers = [(b":method", method.encode()), (b":scheme", b"http"), (b":path", path.encode()),
+               (b":authority", HOSTNAME.encode())]
+    if content_length:
+        headers.append((b"content-length", str(len(body)).encode()))
+    with socket.create_connection(('127.0.0.1', port), timeout=RESPONSE_TIMEOUT) as sock:
+        sock.sendall(PREFACE + h2_frame(FRAME_SETTINGS, 0, 0, b"")
+                     + h2_frame(FRAME_HEADERS, FLAG_END_HEADERS, 1, HpackEncoder().encode(headers))
+                     + h2_frame(FRAME_DATA, FLAG_END_STREAM, 1, body))
+        reader = SocketReader(sock)
+        block, content, status = b"", b"", None
+        while True:
+            length_high, length_low, frame_type, flags, stream_id = FRAME_HEADER.unpack(
+                reader.read_exact(FRAME_HEADER.size))
+            payload = reader.read_exact((length_high << 16) | length_low)
+            if stream_id != 1:
+                continue
+            if frame_type in (FRAME_HEADERS, FRAME_CONTINUATION):
+                block += payload
+                if flags & FLAG_END_HEADERS:
+                    status = int(dict(HpackDecoder().decode(block))[b":status"])
+            elif frame_type == FRAME_DATA:
+                content += payload
+            else:
+                raise ConnectionError("stream ended with frame type {}".format(frame_type))
+            if flags & FLAG_END_STREAM:
+                return status, content
+
+
+def check_headers_kept(port: int) -> str | None:
+    status, headers, body = send(port, "GET", "/hello")
+    if (status, body) != (200, b"hello"):
+        return "unexpected response {} {!r}".format(status, body)
+    if headers.get("server") != BACKEND_SERVER or headers.get("date") != BACKEND_DATE:
+        return "Server/Date replaced: {!r} {!r}".format(headers.get("server"), headers.get("date"))
+    if "x-hop" in headers or "keep-alive" in headers:
+        return "hop-by-hop headers forwarded: {}".format(sorted(headers))
+    return None
+
+
+def check_not_modified(port: int) -> str | None:
+    status, headers, _ = send(port, "GET", "/not-modified")
+    if status != 304 or headers.get("content-length") != "42":
+        return "got {} with Content-Length {!r}".format(status, headers.get("content-length"))
+    return None
+
+
+def check_put(port: int) -> str | None:
+    status, headers, body = send(port, "PUT", "/upload.txt", body=b"data")
+    if (status, body) != (201, b"4"):
+        return "unexpected response {} {!r}".format(status, body)
+    if "content-location" in headers:
+        return "Content-Location added: {}".format(headers["content-location"])
+    return None
+
+
+def check_chunked(port: int) -> str | None:
+    status, _, body = send(port, "GET", "/chunked")
+    if (status, body) != (200, b"hello world"):
+        return "unexpected response {} {!r}".format(status, body)
+    return None
+
+
+def check_repeated_headers(port: int) -> str | None:
+    # The headers are parsed here, as send() keeps only the last value of each header
+    with socket.create_connection(('127.0.0.1', port), timeout=RESPONSE_TIMEOUT) as sock:
+        sock.sendall("GET /cookies HTTP/1.1\r\nHost: {}\r\n\r\n".format(HOSTNAME).encode())
+        head = SocketReader(sock).read_head().decode("latin-1")
+    cookies = [line.partition(":")[2].strip() for line in head.split("\r\n")
+               if line.lower().startswith("set-cookie:")]
+    if cookies != ["a=1", "b=2"]:
+        return "got Set-Cookie {}".format(cookies)
+    return None
+
+
+def check_request_hop_by_hop(port: int) -> str | None:
+    _, _, body = send(port, "GET", "/headers", "Connection: X-Client-Hop\r\nX-Client-Hop: 1\r\nX-Kept: 1\r\n")
+    names = body.decode().split(",")
+    if "x-client-hop" in names or "x-kept" not in names:
+        return "backend got {}".format(names)
+    return None
+
+
+def check_h2_put(port: int) -> str | None:
+    # With and without content-length, more times than connections in the pool, so a desynchronized connection
+    # would be used again by the next request
+    for i in range(UPSTREAM_MAX_CONNECTIONS + 4):
+        status, body = send_h2(port, "PUT", "/upload.txt", b"h2 data", content_length=i % 2 == 0)
+        if (status, body) != (201, b"7"):
+            return "unexpected response {} {!r}".format(status, body)
+    status, _, body = send(port, "GET", "/hello")
+    if (status, body) != (200, b"hello"):
+        return "unexpected response {} {!r} after the HTTP/2 requests".format(status, body)
+    return None
+
+
+def check_invalid_head(port: int) -> str | None:
+    # More invalid responses than connections in the pool, so leaked connections would block the next request
+    for _ in range(UPSTREAM_MAX_CONNECTIONS + 4):
+        status, _, _ = send(port, "GET", "/latin1")
+        if status != 502:
+            return "got {} instead of 502".format(status)
+    status, _, _ = send(port, "GET", "/hello")
+    if status != 200:
+        return "got {} after the invalid responses".format(status)
+    return None
+
+
+CHECKS: List[Tuple[str, Callable[[int], str | None]]] = [
+    ("upstream headers kept, hop-by-hop ones removed", check_headers_kept),
+    ("304 keeps the upstream Content-Length", check_not_modified),
+    ("PUT response without generated headers", check_put),
+    ("chunked body relayed", check_chunked),
+    ("repeated headers relayed apart", check_repeated_headers),
+    ("request hop-by-hop headers removed", check_request_hop_by_hop),
+    ("HTTP/2 PUT forwarded with its body delimited", check_h2_put),
+    ("invalid upstream head is 502, pool not leaked", check_invalid_head),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks the reverse proxy against a local stand-in backend.")
+    parser.parse_args()
+
+    backend_port, port = get_free_port(), get_free_port()
+    backend = Backend(backend_port)
+    failures = 0
+    with tempfile.TemporaryDirectory() as folder:
+        process = start_server(port, backend_port, folder)
+        try:
+            for name, check in CHECKS:
+                try:
+                    error = check(port)
+                except (OSError, ValueError) as e:
+                    error = "{}: {}".format(type(e).__name__, e)
+                print("  {:<4} {}{}".format("ok" if error is None else "FAIL", name,
+                                            "" if error is None else " ({})".format(error)))
+                failures += error is not None
+        finally:
+            process.terminate()
+            process.wait()
+            backend.close()
+    print("{} of {} checks passed".format(len(CHECKS) - failures, len(CHECKS)))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+from __future__ import annotations
+
+import argparse
+import json
+import socket
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from http.header import HEADER_CONTENT_LENGTH, HEADER_TRANSFER_ENCODING, HEADER_TRANSFER_ENCODING_CHUNKED
+from http.response import HttpResponseError
+from http.stream import SocketReader, ChunkedBodyStream, FixedLengthBodyStream, END_OF_HEAD
+from settings import DEFAULT_PORT, RECV_BUFFER_SIZE
+from utils.capture import CaptureRecord, read_capture
+
+# Replays a capture file (see the --capture flag of server.py) against a running server. Every captured connection
+# is opened again, and its data is sent with the same timing (optionally faster) and split in the same blocks, so
+# pipelined requests are sent pipelined as well. It reports the throughput, the latency percentiles and the response
+# status of each request, which can be saved to compare two runs (e.g. before and after a change).
+
+# Seconds to wait for the responses of a connection
+RESPONSE_TIMEOUT = 10
+
+
+def parse_head_headers(head: bytes) -> Tuple[str, Dict[str, str]]:
+    """
+    Given the head of a request or a response, splits its first line and its headers.
+    :param head: head bytes
+    :return: first line, and dictionary of headers by lowercase name
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def skip_body(reader: SocketReader, headers: Dict[str, str], until_close: bool):
+    """
+    Skips the body of a request or a response.
+    :param reader: reader positioned right after the head
+    :param headers: headers of the message
+    :param until_close: whether a body without Content-Length nor Transfer-Encoding lasts until the connection closes
+    """
+    if headers.get(HEADER_TRANSFER_ENCODING.lower(), "").lower() == HEADER_TRANSFER_ENCODING_CHUNKED:
+        ChunkedBodyStream(reader).discard()
+    elif HEADER_CONTENT_LENGTH.lower() in headers:
+        FixedLengthBodyStream(reader, int(headers[HEADER_CONTENT_LENGTH.lower()])).discard()
+    elif until_close:
+        while reader.read(RECV_BUFFER_SIZE):
+            pass
+
+
+def split_requests(data: bytes) -> List[int]:
+    """
+    Given all the data sent in a connection, finds where each request ends. Malformed requests are split as the
+    server would do, by the end of their head.
+    :param data: captured data of the connection
+    :return: offset of the end of each request
+    """
+    reader = SocketReader(data=data)
+    ends = []
+    while reader.has_buffered_data():
+        head = reader.read_head()
+        if head.endswith(END_OF_HEAD):
+            try:
+                skip_body(reader, parse_head_headers(head)[1], until_close=False)
+            except (HttpResponseError, ValueError):
+                # Malformed body: the server will not read past it anyway
+                ends.append(len(data))
+                break
+        ends.append(len(data) - reader.get_buffered_size())
+    return ends
+
+
+def read_response_status(reader: SocketReader) -> int | None:
+    """
+    Reads a whole response, skipping interim (1xx) responses.
+    :param reader: reader of the connection
+    :return: response status code, or None if the connection was closed
+    """
+    while True:
+        head = reader.read_head()
+        if not head.endswith(END_OF_HEAD):
+            return None
+        status_line, headers = parse_head_headers(head)
+        code = int(status_line.split(" ")[1])
+        if 100 <= code < 200:
+            continue
+        if code not in (204, 304):
+            skip_body(reader, headers, until_close=True)
+        return code
+
+
+def replay_connection(address: Tuple[str, int], records: List[CaptureRecord], origin: float, start: float,
+                      speed: float, results: Dict[str, dict]):
+    """
+    Replays the captured data of a connection, and saves the result of each request.
+    :param address: address of the server
+    :param records: records of the connection, in order
+    :param origin: timestamp of the first record of the capture
+    :param start: time (perf_counter) when the replay started
+    :param speed: replay speed (2 is twice as fast as captured, 0 sends everything without waiting)
+    :param results: dictionary where results are saved, by "connection id:request index"
+    """
+    ends = split_requests(b"".join(r.data for r in records))
+    sent_at: List[float | None] = [None] * len(ends)
+    done_at: List[float | None] = [None] * len(ends)
+    statuses: List[int | None] = [None] * len(ends)
+
+    def wait_until(timestamp):
+        if speed > 0:
+            delay = start + (timestamp - origin) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    wait_until(records[0].timestamp)
+    try:
+        sock = socket.create_connection(address, timeout=RESPONSE_TIMEOUT)
+    except OSError:
+        sock = None
+
+    def receive():
+        reader = SocketReader(sock)
+        try:
+            for i in range(len(ends)):
+                statuses[i] = read_response_status(reader)
+                done_at[i] = time.perf_counter()
+                if statuses[i] is None:
+                    return
+        except (OSError, HttpResponseError, ValueError, IndexError):
+            pass
+
+    if sock is not None:
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        offset, next_request = 0, 0
+        try:
+            for record in records:
+                if not record.data:
+                    continue
+                wait_until(record.timestamp)
+                sock.sendall(record.data)
+                offset += len(record.data)
+                now = time.perf_counter()
+                while next_request < len(ends) and ends[next_request] <= offset:
+                    sent_at[next_request] = now
+                    next_request += 1
+            # Nothing else to be sent, but the responses are still received
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        receiver.join()
+        sock.close()
+
+    conn_id = records[0].conn_id
+    for i in range(len(ends)):
+        latency = None
+        if statuses[i] is not None and sent_at[i] is not None:
+            latency = (done_at[i] - sent_at[i]) * 1000
+        results["{}:{}".format(conn_id, i)] = {"status": statuses[i], "latency": latency}
+
+
+def replay(capture: str, address: Tuple[str, int], speed: float) -> dict:
+    """
+    Replays a capture file against a server.
+    :param capture: capture file
+    :param address: address of the server
+    :param speed: replay speed (2 is twice as fast as captured, 0 sends everything without waiting)
+    :return: dictionary with the summary of the run and the result of every request
+    """
+    connections: Dict[int, List[CaptureRecord]] = {}
+    for record in read_capture(capture):
+        connections.setdefault(record.conn_id, []).append(record)
+    if not connections:
+        raise ValueError("{} does not contain any record".format(capture))
+    origin = min(records[0].timestamp for records in connections.values())
+
+    results: Dict[str, dict] = {}
+    start = time.perf_counter()
+    threads = [threading.Thread(target=replay_connection, args=(address, records, origin, start, speed, results))
+               for records in connections.values() if any(r.data for r in records)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(r["latency"] for r in results.values() if r["latency"] is not None)
+    statuses: Dict[str, int] = {}
+    for result in results.values():
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    summary = {
+        "connections": len(threads),
+        "requests": len(results),
+        "responses": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+        "latency_p50": percentile(50),
+        "latency_p90": percentile(90),
+        "latency_p99": percentile(99),
+        "latency_max": latencies[-1] if latencies else None,
+        "statuses": statuses,
+    }
+    return {"summary": summary, "requests": results}
+
+
+def print_summary(summary: dict):
+    print("Connections: {}".format(summary["connections"]))
+    print("Requests:    {} ({} answered)".format(summary["requests"], summary["responses"]))
+    print("Duration:    {:.3f} s".format(summary["seconds"]))
+    print("Throughput:  {:.1f} requests/s".format(summary["throughput"]))
+    for name in ("p50", "p90", "p99", "max"):
+        value = summary["latency_" + name]
+        print("Latency {:>3}: {}".format(name, "-" if value is None else "{:.3f} ms".format(value)))
+    print("Statuses:    {}".format(", ".join("{}: {}".format(k, v) for k, v in sorted(summary["statuses"].items()))))
+
+
+def compare(first: dict, second: dict):
+    """
+    Prints the differences between two runs of the same capture.
+    :param first: result of the first run
+    :param second: result of the second run
+    """
+    for name in ("throughput", "latency_p50", "latency_p90", "latency_p99", "latency_max"):
+        a, b = first["summary"][name], second["summary"][name]
+        change = "" if not a or b is None else " ({:+.1f}%)".format((b - a) / a * 100)
+        print("{:<12} {:>12} {:>12}{}".format(name, "-" if a is None else "{:.3f}".format(a),
+                                             "-" if b is None else "{:.3f}".format(b), change))
+
+    keys = sorted(set(first["requests"]) | set(second["requests"]))
+    diffs = [(k, first["requests"].get(k, {}).get("status"), second["requests"].get(k, {}).get("status"))
+             for k in keys]
+    diffs = [d for d in diffs if d[1] != d[2]]
+    print("{} of {} requests changed their response status".format(len(diffs), len(keys)))
+    for key, a, b in diffs:
+        print("  {}: {} -> {}".format(key, a, b))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays a traffic capture against a server, or compares the results of two replays.")
+    parser.add_argument("capture",
+                        help="capture file recorded with server.py --capture",
+                        nargs='?')
+    parser.add_argument("-H", "--host",
+                        help="host where the server is running",
+                        default="127.0.0.1")
+    parser.add_argument("-p", "--port",
+                        help="port where the server is running",
+                        type=int,
+                        default=DEFAULT_PORT)
+    parser.add_argument("-s", "--speed",
+                        help="replay speed: 1 as captured, 2 twice as fast, 0 as fast as possible",
+                        type=float,
+                        default=1)
+    parser.add_argument("-o", "--output",
+                        help="save the results of the run to a JSON file")
+    parser.add_argument("--compare",
+                        help="compare the results of two runs, instead of replaying",
+                        nargs=2,
+                        metavar="RESULTS")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f1, open(args.compare[1]) as f2:
+            compare(json.load(f1), json.load(f2))
+    elif args.capture:
+        run = replay(args.capture, (args.host, args.port), args.speed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(run, f)
+        print_summary(run["summary"])
+    else:
+        parser.error("a capture file, or --compare, is required")
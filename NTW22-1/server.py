@@ -1,83 +1,433 @@
 #!/usr/bin/python3
 
-import argparse
+from __future__ import annotations
+
+import base64
+import binascii
+import itertools
+import json
 import logging
-import mimetypes
+import os
+import signal
 import socket
+import sys
 import threading
+import time
+from pathlib import Path
 
-from http.enums import HttpMethod, HttpVersion
-from http.header import HttpHeader, HEADER_CONNECTION, HEADER_CONNECTION_CLOSE, HEADER_CONTENT_TYPE, \
-    HEADER_CONTENT_TYPE_TEXT_PLAIN
+from http.enums import HttpMethod, HttpResponseCode, HttpVersion
+from http.header import HttpHeader, HEADER_CONNECTION, HEADER_CONNECTION_CLOSE, HEADER_CONNECTION_UPGRADE, \
+    HEADER_CONTENT_TYPE, HEADER_CONTENT_TYPE_APPLICATION_JSON, HEADER_CONTENT_TYPE_TEXT_HTML, \
+    HEADER_CONTENT_TYPE_TEXT_PLAIN, HEADER_ETAG, HEADER_EXPECT, HEADER_EXPECT_100_CONTINUE, HEADER_HTTP2_SETTINGS, \
+    HEADER_IF_NONE_MATCH, HEADER_UPGRADE, HEADER_UPGRADE_H2C
 from http.request import HttpRequest
-from http.response import HttpResponse, HttpResponseError, HttpResponseMethodNotAllowed, HttpResponseNotFound, HttpResponseUnsupportedMediaType
-from settings import DEFAULT_PORT, VHOSTS_FILE
-from utils.entity import generate_output
-from utils.mime import CUSTOM_MIMETYPES
+from http.response import HttpResponse, HttpResponseBadRequest, HttpResponseError, HttpResponseMethodNotAllowed, \
+    HttpResponseNotFound, HttpResponseUnsupportedMediaType
+from http.stream import SocketReader, HttpBodyStream, PREFACE_HEAD
+from settings import DEFAULT_PORT, H2_ENABLED, HTTP_ENCODING, LISTEN_BACKLOG, MAX_ACTIVE_REQUESTS, POLL_INTERVAL, \
+    PRELOAD_MAX_BYTES, PRELOAD_MODE, RESTART_TIMEOUT, SHUTDOWN_TIMEOUT, VHOSTS_FILE, VHOSTS_SNAPSHOT_FILE
+from utils.autoindex import generate_listing_html, generate_listing_json, get_listing_page
+from utils.blobs import get_file_hash, record_file_hash
+from utils.capture import CaptureWriter
+from utils.entity import generate_headers, generate_stream
+from utils.mime import guess_type
+from utils.preload import PRELOAD_BACKGROUND, PRELOAD_BLOCKING, PRELOAD_MODES, get_host_paths, \
+    get_manifest_paths, get_store_size, get_stored_file, preload, store_file
+from utils.proxy import forward_request
+from utils.scheduler import FairScheduler
 from utils.vhosts import Vhost
 
 
 class Server:
     __socket = None
     __hosts = None
+    __scheduler = None
+    __draining = None
+    __connections = None
+    __connections_lock = None
+    __capture = None
+    __connection_ids = None
+    __ready = None
+    __ready_fd = None
+    __restarting = False
+    __reuse_objects = True
+
+    def __init__(self, port=DEFAULT_PORT, listen_fd=None, snapshot_file=None, capture_file=None,
+                 preload_mode=PRELOAD_MODE, preload_manifest=None, ready_fd=None, reuse_objects=True):
+        # Parse vhosts.conf file (or load its snapshot, if given and up to date)
+        Server.__hosts = Vhost.load_file(VHOSTS_FILE, snapshot_file)
+        # Shares the processing of requests between the vhosts, with their limits
+        Server.__scheduler = FairScheduler(MAX_ACTIVE_REQUESTS)
+        # Set once the files to be served are loaded in memory (right away if they are not preloaded)
+        self.__ready = threading.Event()
+        if preload_mode not in PRELOAD_MODES:
+            raise ValueError("Unknown preload mode {}".format(preload_mode))
+        preloaded = False
+        if preload_mode == PRELOAD_BLOCKING:
+            # Load the files before the socket starts listening, so no connection is accepted until then
+            preloaded = Server.__preload(preload_manifest)
+        # Set when the server must stop accepting connections and drain the active ones
+        self.__draining = threading.Event()
+        # Active connections, waited for (and closed if still open after SHUTDOWN_TIMEOUT) when draining
+        self.__connections = set()
+        self.__connections_lock = threading.Lock()
+        # If capturing traffic, the raw data received by every connection is recorded. Connection ids include the
+        # process id, so they do not collide with those of other server processes appending to the same file
+        self.__capture = CaptureWriter(capture_file) if capture_file else None
+        self.__connection_ids = itertools.count(os.getpid() << 32)
+        # Pipe to tell the previous server process (during a restart) that this one accepts connections
+        self.__ready_fd = ready_fd
+        self.__restarting = False
+        # Whether the request and response objects of a connection are reused for all its requests. Only disabled
+        # to measure the difference (see benchmark.py)
+        self.__reuse_objects = reuse_objects
 
-    def __init__(self, port=DEFAULT_PORT):
-        # Parse vhosts.conf file
-        Server.__hosts = Vhost.parse_file(VHOSTS_FILE)
-        # Initialize the socket to work with IPv4 TCP
-        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Using the specified port
-        self.__socket.bind(('', port))
-        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        self.__socket.listen(1)
-        logging.info("Server started on port {}".format(port))
+        if listen_fd is None:
+            # Initialize the socket to work with IPv4 TCP
+            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Allow binding again right after a restart, even if old connections are still in TIME_WAIT
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Using the specified port
+            self.__socket.bind(('', port))
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.__socket.listen(LISTEN_BACKLOG)
+            logging.info("Server started on port {}".format(port))
+        else:
+            # Reuse the listening socket handed over by the previous server process (see reexec)
+            self.__socket = socket.socket(fileno=listen_fd)
+            logging.info("Server started on inherited socket {} (port {})".format(
+                listen_fd, self.__socket.getsockname()[1]))
+        # Do not block forever on accept(), so that a shutdown request is noticed
+        self.__socket.settimeout(POLL_INTERVAL)
+
+        if preload_mode == PRELOAD_BACKGROUND:
+            # Serve the first requests from disk while the files are being loaded
+            threading.Thread(target=lambda: self.__set_ready(Server.__preload(preload_manifest)), daemon=True).start()
+        else:
+            self.__set_ready(preloaded)
 
     def listen(self):
         if self.__socket is None:
             # Cannot listen if socket is None (probably because it was closed)
             raise Exception("Socket is not available!")
 
-        while True:
-            # We listen to connections forever and, for each connection, launch a thread
-            conn, addr = self.__socket.accept()
-            thread = threading.Thread(target=Server.__process_connection, args=(conn, addr))
+        if self.__ready_fd is not None:
+            # Let the previous server process know that it can start draining its connections
+            try:
+                os.write(self.__ready_fd, b'\x01')
+                os.close(self.__ready_fd)
+            except OSError:
+                pass
+            self.__ready_fd = None
+
+        while not self.__draining.is_set():
+            # We listen to connections until a shutdown is requested and, for each connection, launch a thread
+            try:
+                conn, addr = self.__socket.accept()
+            except socket.timeout:
+                continue
+            with self.__connections_lock:
+                self.__connections.add(conn)
+            thread = threading.Thread(target=self.__process_connection, args=(conn, addr), daemon=True)
             thread.start()
 
+        # Stop accepting new connections (pending ones stay queued if another process shares the socket)
+        self.close()
+        self.__drain()
+        if self.__capture is not None:
+            self.__capture.close()
+
     def close(self):
         # Close and remove the socket
+        if self.__socket is None:
+            return
         self.__socket.close()
         self.__socket = None
 
+    def shutdown(self):
+        """
+        Requests a graceful shutdown: no new connections are accepted, in-flight requests are allowed to finish
+        and idle keep-alive connections are closed. Safe to be called from a signal handler.
+        """
+        if not self.__draining.is_set():
+            logging.info("Shutdown requested, draining connections")
+        self.__draining.set()
+
+    def reexec(self):
+        """
+        Starts a new server process (running the current code on disk) which inherits the listening socket, and
+        drains this one once the new one is ready. Connections arriving in between wait in the kernel queue, so none
+        is dropped. If the new process fails to start, this one keeps serving.
+        """
+        # Only needed for restarts, so not imported at startup
+        import subprocess
+
+        if self.__socket is None or self.__draining.is_set() or self.__restarting:
+            return
+        fd = self.__socket.fileno()
+        # Drop any --listen-fd and --ready-fd flags coming from a previous generation of the server
+        argv, skip = [], False
+        for arg in sys.argv:
+            if skip:
+                skip = False
+            elif arg in ('--listen-fd', '--ready-fd'):
+                skip = True
+            elif not arg.startswith('--listen-fd=') and not arg.startswith('--ready-fd='):
+                argv.append(arg)
+        # The new process writes a byte to this pipe once it accepts connections
+        ready_read, ready_write = os.pipe()
+        try:
+            command = [sys.executable] + argv + ['--listen-fd', str(fd), '--ready-fd', str(ready_write)]
+            process = subprocess.Popen(command, pass_fds=(fd, ready_write))
+        except OSError as e:
+            os.close(ready_read)
+            logging.error("Could not start a new server process: {}".format(e))
+            return
+        finally:
+            os.close(ready_write)
+        self.__restarting = True
+        logging.info("Started new server process {} with the listening socket".format(process.pid))
+        # Signal handlers must return right away, so wait in another thread
+        threading.Thread(target=self.__wait_restart, args=(process, ready_read), daemon=True).start()
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """
+        Waits until the files to be served are preloaded (if they are preloaded in the background).
+        :param timeout: maximum number of seconds to wait, or None to wait until ready
+        :return: True if the server is ready
+        """
+        return self.__ready.wait(timeout)
+
+    def install_signal_handlers(self):
+        """
+        SIGTERM triggers a graceful shutdown, while SIGUSR2 (where available) triggers a zero-downtime restart.
+        Must be called from the main thread.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.reexec())
+
     @staticmethod
-    def __get_response(request: HttpRequest) -> HttpResponse:
-        response = HttpResponse()
+    def check_startup(snapshot_file=VHOSTS_SNAPSHOT_FILE):
+        """
+        Measures the steps of the server startup, and prints a report with their timings.
+        :param snapshot_file: snapshot file to be written and loaded
+        """
+        steps = []
+
+        def measure(name, function):
+            start = time.perf_counter()
+            result = function()
+            steps.append((name, (time.perf_counter() - start) * 1000))
+            return result
+
+        hosts = measure("Parse {} (checking every host folder)".format(VHOSTS_FILE),
+                        lambda: Vhost.parse_file(VHOSTS_FILE))
+        measure("Write {}".format(snapshot_file), lambda: Vhost.write_snapshot(hosts, snapshot_file, VHOSTS_FILE))
+        measure("Load {}".format(snapshot_file), lambda: Vhost.load_snapshot(snapshot_file, VHOSTS_FILE))
+        measure("Import mimetypes and read the MIME databases (first request)",
+                lambda: guess_type(Path(next(iter(hosts)), "index.html")) if hosts else None)
+        preloaded = measure("Preload the files of the virtual hosts", lambda: preload(get_host_paths(hosts)))
+
+        print("Startup report ({} virtual hosts, {} files preloaded with {} bytes)".format(len(hosts), *preloaded))
+        for name, elapsed in steps:
+            print("  {:>10.3f} ms  {}".format(elapsed, name))
+
+    @staticmethod
+    def __preload(manifest: str | None) -> bool:
+        """
+        Loads the files to be served in memory, either the ones listed in the manifest or all the files of the
+        virtual hosts.
+        :param manifest: manifest of hot paths (or capture file to take them from), or None to walk the host folders
+        :return: True if the files were loaded, False if they will be read from disk when served
+        """
+        start = time.perf_counter()
+        try:
+            paths = get_manifest_paths(Server.__hosts, manifest) if manifest else get_host_paths(Server.__hosts)
+            count, size = preload(paths)
+        except (OSError, ValueError) as e:
+            logging.warning("Could not preload files: {}".format(e))
+            return False
+        logging.info("Preloaded {} files ({} bytes) in {:.0f} ms".format(
+            count, size, (time.perf_counter() - start) * 1000))
+        return True
+
+    def __wait_restart(self, process, ready_fd: int):
+        """
+        Waits up to RESTART_TIMEOUT seconds for the new server process of a restart to accept connections, and then
+        drains this one. If it exits or does not get ready in time, it is stopped and this process keeps serving.
+        :param process: new server process
+        :param ready_fd: read end of the pipe where the new process writes once it is ready
+        """
+        # Only needed for restarts, so not imported at startup
+        import select
+        import subprocess
+
+        deadline = time.monotonic() + RESTART_TIMEOUT
+        ready = False
+        try:
+            while process.poll() is None and time.monotonic() < deadline:
+                readable, _, _ = select.select([ready_fd], [], [], POLL_INTERVAL)
+                if readable:
+                    # Otherwise, the pipe was closed without writing (e.g. the process is exiting)
+                    ready = os.read(ready_fd, 1) == b'\x01'
+                    break
+        finally:
+            os.close(ready_fd)
+
+        if ready:
+            logging.info("New server process {} is ready".format(process.pid))
+            self.shutdown()
+            return
+        try:
+            # If the pipe was closed, the process is probably exiting
+            process.wait(POLL_INTERVAL)
+        except subprocess.TimeoutExpired:
+            # Do not let it start serving later, along with this process
+            process.kill()
+            process.wait()
+            logging.error("New server process {} did not get ready in {} seconds, so it was stopped. "
+                          "Still serving with the current process".format(process.pid, RESTART_TIMEOUT))
+        else:
+            logging.error("New server process {} exited with code {}. Still serving with the current process".format(
+                process.pid, process.returncode))
+        self.__restarting = False
+
+    def __set_ready(self, preloaded: bool):
+        logging.info("Server ready{}".format("" if preloaded else " (files are read from disk when first served)"))
+        self.__ready.set()
+
+    def __drain(self):
+        """
+        Waits up to SHUTDOWN_TIMEOUT seconds for the active connections to finish, and then forcibly closes the
+        remaining ones.
+        """
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while time.monotonic() < deadline:
+            with self.__connections_lock:
+                if not self.__connections:
+                    break
+            time.sleep(POLL_INTERVAL / 10)
+
+        with self.__connections_lock:
+            remaining = list(self.__connections)
+        if remaining:
+            logging.warning("Closing {} connections still active after {} seconds".format(
+                len(remaining), SHUTDOWN_TIMEOUT))
+        for conn in remaining:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        logging.info("Server stopped")
+
+    def __receive_request(self, conn, reader: SocketReader) -> bytes:
+        """
+        Waits for the next request on a connection and reads its head. While the connection is idle, it checks
+        periodically whether the server is shutting down, in which case the wait is abandoned.
+        :param conn: client socket
+        :param reader: buffered reader of the connection
+        :return: request head, or empty bytes if the connection was closed or must be closed
+        """
+        if not reader.has_buffered_data():
+            # No pipelined request already received, so wait for it
+            conn.settimeout(POLL_INTERVAL)
+            try:
+                while True:
+                    try:
+                        if not reader.fill():
+                            return b''
+                        break
+                    except socket.timeout:
+                        if self.__draining.is_set():
+                            return b''
+            finally:
+                conn.settimeout(None)
+        return reader.read_head()
+
+    @staticmethod
+    def __get_response(request: HttpRequest, response: HttpResponse | None = None) -> HttpResponse:
+        """
+        Generates the response to a request.
+        :param request: parsed request
+        :param response: response object to be reset and filled, instead of allocating a new one (optional)
+        :return: response to be sent (which may not be the given one, e.g. for forwarded requests)
+        """
+        if response is None:
+            response = HttpResponse()
+        else:
+            response.reset()
+
+        if request.get_method() == HttpMethod.NTW22INFO and "metrics" in request.get_query():
+            # Scheduling metrics of the vhost (even if it is forwarded to another server), and the files of the
+            # server kept in memory
+            metrics = Server.__scheduler.get_metrics(request.get_vhost())
+            files, size = get_store_size()
+            metrics["preload"] = {"files": files, "bytes": size, "max_bytes": PRELOAD_MAX_BYTES}
+            response.set_content(json.dumps(metrics))
+            response.add_header(HEADER_CONTENT_TYPE,
+                                HttpHeader(HEADER_CONTENT_TYPE, HEADER_CONTENT_TYPE_APPLICATION_JSON))
+            return response
+
+        if request.get_vhost().get_upstream() is not None:
+            # Vhost served by another server, which handles any method
+            return forward_request(request, request.get_vhost().get_upstream())
 
         if request.get_method() == HttpMethod.GET:
             file_path = request.get_vhost().get_host_root_path().joinpath(request.get_path())
             if file_path.exists() and not file_path.is_file():
-                file_path = file_path.joinpath(request.get_vhost().get_index_file())
+                index_path = file_path.joinpath(request.get_vhost().get_index_file())
+                if not index_path.exists() and request.get_vhost().has_autoindex():
+                    return Server.__get_directory_listing(request, file_path, response)
+                file_path = index_path
 
             if not file_path.exists():
                 raise HttpResponseNotFound(content="File not found")
             elif not file_path.is_file():
                 raise HttpResponseMethodNotAllowed()
 
-            content = Vhost.get_file_contents(file_path)
-            response = HttpResponse(content=content)
+            # The hash of the content is its strong ETag, which is known without reading the file once it has been
+            # uploaded or served, so revalidations are answered right away
+            try:
+                file_stat, digest = get_file_hash(file_path)
+            except OSError:
+                raise HttpResponseNotFound(content="File not found")
+            if digest is not None and Server.__matches_etag(request, digest):
+                response.set_status(HttpResponseCode.NOT_MODIFIED)
+                response.add_header(HEADER_ETAG, HttpHeader(HEADER_ETAG, '"{}"'.format(digest)))
+                return response
+
+            # Served from memory if possible, otherwise it is read (and kept in memory if it fits)
+            stored = get_stored_file(file_path) or store_file(file_path)
+            if stored is not None:
+                content, content_type = stored.content, stored.content_type
+            else:
+                content, content_type = Vhost.get_file_contents(file_path), guess_type(file_path)
+            response.set_content(content)
 
-            content_type = mimetypes.guess_type(file_path)[0]
             if content_type is None:
-                extension = file_path.suffix[1:]
-                if extension not in CUSTOM_MIMETYPES:
-                    raise HttpResponseUnsupportedMediaType()
-                content_type = CUSTOM_MIMETYPES[extension]
+                raise HttpResponseUnsupportedMediaType()
 
             content_type_header = HttpHeader(HEADER_CONTENT_TYPE, content_type)
             response.add_header(HEADER_CONTENT_TYPE, content_type_header)
+            if digest is None:
+                digest = record_file_hash(file_stat, content)
+            response.add_header(HEADER_ETAG, HttpHeader(HEADER_ETAG, '"{}"'.format(digest)))
 
         elif request.get_method() == HttpMethod.PUT:
-            # TODO
-            pass
+            file_path = request.get_vhost().get_host_root_path().joinpath(request.get_path())
+            # Only files can be written
+            if request.get_path() == "" or request.get_path().endswith("/"):
+                raise HttpResponseMethodNotAllowed()
+            if file_path.exists() and not file_path.is_file():
+                raise HttpResponseMethodNotAllowed()
+
+            created = not file_path.exists()
+            # The body is written to the file while it is being received
+            digest = Vhost.put_file(file_path, request.get_body_stream())
+            response.set_status(HttpResponseCode.CREATED if created else HttpResponseCode.OK)
+            response.add_header(HEADER_ETAG, HttpHeader(HEADER_ETAG, '"{}"'.format(digest)))
+
         elif request.get_method() == HttpMethod.DELETE:
             file_path = request.get_vhost().get_host_root_path().joinpath(request.get_path())
             if not file_path.exists():
@@ -95,7 +445,7 @@ class Server:
                 request.get_vhost().get_server_admin_email()
             )
 
-            response = HttpResponse(content=ntw)
+            response.set_content(ntw)
 
             content_type_header = HttpHeader(HEADER_CONTENT_TYPE, HEADER_CONTENT_TYPE_TEXT_PLAIN)
             response.add_header(HEADER_CONTENT_TYPE, content_type_header)
@@ -103,39 +453,243 @@ class Server:
         return response
 
     @staticmethod
-    def __process_connection(conn, addr):
+    def __get_directory_listing(request: HttpRequest, dir_path, response: HttpResponse) -> HttpResponse:
+        """
+        Generates the listing of a directory without index file. It is paginated with the "page" query parameter,
+        and generated as JSON instead of HTML with "format=json".
+        :param request: GET request of the directory
+        :param dir_path: path of the directory in the filesystem
+        :param response: empty response to be filled
+        :return: response with the listing being streamed
+        """
+        try:
+            page = int(request.get_query().get("page", "1"))
+        except ValueError:
+            raise HttpResponseBadRequest(content="Could not parse page number")
+        entries, pages = get_listing_page(dir_path, page)
+
+        url_path = "/" + request.get_path().strip("/")
+        url_path = url_path if url_path == "/" else url_path + "/"
+        if request.get_query().get("format") == "json":
+            content, content_type = generate_listing_json(url_path, entries, page, pages), \
+                HEADER_CONTENT_TYPE_APPLICATION_JSON
+        else:
+            content, content_type = generate_listing_html(url_path, entries, page, pages), \
+                HEADER_CONTENT_TYPE_TEXT_HTML
+
+        response.set_content(content)
+        response.add_header(HEADER_CONTENT_TYPE, HttpHeader(HEADER_CONTENT_TYPE, content_type))
+        return response
+
+    def __process_connection(self, conn, addr):
         logging.debug('Serving a connection from host {} on port {}'.format(addr[0], addr[1]))
+        # Responses are written in several blocks, so do not wait to coalesce them
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn_id = next(self.__connection_ids)
+        recorder = None
+        if self.__capture is not None:
+            recorder = lambda data: self.__capture.record(time.time(), conn_id, data)
+        reader = SocketReader(conn, recorder=recorder)
+        first_request = True
+        # The same request and response objects are reset and reused for every request of the connection
+        connection_request, connection_response = None, None
+        if self.__reuse_objects:
+            connection_request, connection_response = HttpRequest(), HttpResponse()
+        # Vhost whose turn is being used by the current request, to be released once its response is sent
+        scheduled = None
 
-        request, response = None, None
         try:
-            # Try to parse the request basic request (if not possible, HttpResponseError will catch it)
-            request = HttpRequest(conn.recv(1024))
-            # Now try with headers and body (but if fails, at least request object will exist)
-            request.parse_request(Server.__hosts)
-            # And generate the response based on the request
+            while True:
+                try:
+                    head = self.__receive_request(conn, reader)
+                except HttpResponseError as e:
+                    # The request head could not even be read, so answer and stop reading from this connection
+                    conn.sendall(b''.join(generate_stream(None, e)))
+                    break
+                if not head:
+                    # Client closed the connection, or it was idle while shutting down
+                    break
+                if H2_ENABLED and head == PREFACE_HEAD and first_request:
+                    # HTTP/2 with prior knowledge: the client sent the connection preface instead of a request.
+                    # Only needed for HTTP/2 connections, so not imported at startup
+                    from http.h2 import H2Connection
+                    H2Connection(conn, reader, Server.__get_h2_response, self.__draining).run(preface=head)
+                    break
+                first_request = False
+
+                request, response, scheduled = None, None, None
+                try:
+                    # Try to parse the request basic request (if not possible, HttpResponseError will catch it)
+                    if connection_request is not None:
+                        connection_request.reset(head)
+                        request = connection_request
+                    else:
+                        request = HttpRequest(head)
+                    # Now try with headers and body (but if fails, at least request object will exist)
+                    request.parse_request(Server.__hosts, reader)
+                    upgrade_settings = self.__get_h2c_upgrade_settings(request)
+                    if upgrade_settings is not None:
+                        # Switch to HTTP/2, where this request is answered in the first stream. Only needed for
+                        # HTTP/2 connections, so not imported at startup
+                        from http.h2 import H2Connection
+                        conn.sendall("{} {}\r\n{}: {}\r\n{}: {}\r\n\r\n".format(
+                            HttpVersion.HTTP_11, HttpResponseCode.SWITCHING_PROTOCOLS,
+                            HEADER_CONNECTION, HEADER_CONNECTION_UPGRADE,
+                            HEADER_UPGRADE, HEADER_UPGRADE_H2C).encode(HTTP_ENCODING))
+                        H2Connection(conn, reader, Server.__get_h2_response, self.__draining).run(
+                            upgrade_head=head, upgrade_settings=upgrade_settings)
+                        break
+                    # Wait for the turn of the vhost, which lasts until the response is sent
+                    Server.__scheduler.acquire(request.get_vhost())
+                    scheduled = request.get_vhost()
+                    if request.get_body_stream() is not None and request.has_header(HEADER_EXPECT) \
+                            and request[HEADER_EXPECT].value.lower() == HEADER_EXPECT_100_CONTINUE:
+                        # The client waits for this interim response before sending the body
+                        conn.sendall("{} {}\r\n\r\n".format(request.get_http_version(),
+                                                             HttpResponseCode.CONTINUE).encode(HTTP_ENCODING))
+                    # And generate the response based on the request
+                    response = Server.__get_response(request, connection_response)
+                except HttpResponseError as e:
+                    response = e
+
+                keep_alive = Server.__keep_alive(request) and not self.__draining.is_set()
+                body = request.get_body_stream() if request else None
+                if body is not None and not body.is_finished():
+                    try:
+                        # Skip what the handler did not read of the body, so the next request can be read
+                        body.discard()
+                    except HttpResponseError:
+                        keep_alive = False
+                if request and not keep_alive and request.get_http_version() == HttpVersion.HTTP_11:
+                    # Let HTTP/1.1 clients know that this connection is not going to be reused
+                    response[HEADER_CONNECTION] = HttpHeader(HEADER_CONNECTION, HEADER_CONNECTION_CLOSE)
+
+                # Generate the output based on the request and the repsonse, and send it while it is generated
+                blocks = generate_stream(request, response)
+                if scheduled is not None:
+                    blocks = Server.__scheduler.throttle(scheduled, blocks)
+                for block in blocks:
+                    conn.sendall(block)
+                if scheduled is not None:
+                    Server.__scheduler.release(scheduled)
+                    scheduled = None
+                if connection_response is not None:
+                    # Do not keep the content alive while the connection is idle
+                    connection_response.reset()
+
+                if not keep_alive:
+                    break
+                # Otherwise, we keep listening for requests in this connection
+        except (OSError, HttpResponseError):
+            # Connection reset by the client, forcibly closed while shutting down, or the response could not be
+            # completely generated after starting to send it
+            pass
+        finally:
+            if scheduled is not None:
+                Server.__scheduler.release(scheduled)
+            conn.close()
+            if recorder is not None:
+                # Empty data marks the end of the connection
+                recorder(b'')
+            with self.__connections_lock:
+                self.__connections.discard(conn)
+
+    @staticmethod
+    def __get_h2_response(head: bytes, body: HttpBodyStream | None) -> HttpResponse:
+        """
+        Handles a request received in an HTTP/2 stream.
+        :param head: equivalent HTTP/1.1 request head
+        :param body: stream of the request body, or None if the request has no body
+        :return: response, with all its headers generated
+        """
+        request, scheduled = None, None
+        try:
+            request = HttpRequest(head)
+            request.parse_request(Server.__hosts, body_stream=body)
+            # Wait for the turn of the vhost, which lasts until the content is sent (or the stream is reset)
+            Server.__scheduler.acquire(request.get_vhost())
+            scheduled = request.get_vhost()
             response = Server.__get_response(request)
         except HttpResponseError as e:
             response = e
+        except BaseException:
+            if scheduled is not None:
+                Server.__scheduler.release(scheduled)
+            raise
+        generate_headers(request, response)
+        if scheduled is not None:
+            response.set_content(Server.__scheduler.schedule_content(scheduled, response.get_content()))
+        return response
 
-        # Generate the output based on the request and the repsonse
-        out = generate_output(request, response)
-        # Encode it as bytes and send it
-        conn.send(bytes(out))
+    def __get_h2c_upgrade_settings(self, request: HttpRequest) -> bytes | None:
+        """
+        Checks if the client asks to upgrade the connection to HTTP/2 (h2c). Requests with a body are not upgraded,
+        as the body would have to be read before switching protocols.
+        :param request: parsed request
+        :return: HTTP/2 settings sent by the client, or None if the connection must not be upgraded
+        """
+        if not H2_ENABLED or self.__draining.is_set() or request.get_http_version() != HttpVersion.HTTP_11 \
+                or request.get_body_stream() is not None:
+            return None
+        if not request.has_header(HEADER_UPGRADE) or not request.has_header(HEADER_HTTP2_SETTINGS) \
+                or not request.has_header(HEADER_CONNECTION):
+            return None
+        upgrade = [token.strip().lower() for token in request[HEADER_UPGRADE].value.split(",")]
+        connection = [token.strip().lower() for token in request[HEADER_CONNECTION].value.split(",")]
+        if HEADER_UPGRADE_H2C not in upgrade or HEADER_UPGRADE.lower() not in connection \
+                or HEADER_HTTP2_SETTINGS.lower() not in connection:
+            return None
+        try:
+            # The settings are encoded with base64url, without padding
+            value = request[HEADER_HTTP2_SETTINGS].value.strip()
+            return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+        except (binascii.Error, ValueError):
+            return None
 
-        if request:
-            # For HTTP/1.0, we always close the connection
-            if request.get_http_version() == HttpVersion.HTTP_10:
-                conn.close()
-                return
-            # For HTTP/1.1, if "Connection: close" header is present, we also close the connection
-            if request.has_header(HEADER_CONNECTION) and request[HEADER_CONNECTION] == HEADER_CONNECTION_CLOSE:
-                conn.close()
-                return
-        # Otherwise, we keep listening for connections
-        Server.__process_connection(conn, addr)
+    @staticmethod
+    def __matches_etag(request: HttpRequest, digest: str) -> bool:
+        """
+        Checks if the If-None-Match header of a request includes the ETag of a file, or is "*". As required for this
+        header, weak ETags sent by the client are compared too.
+        :param request: parsed request
+        :param digest: hash of the file
+        :return: True if the client already has the file
+        """
+        if not request.has_header(HEADER_IF_NONE_MATCH):
+            return False
+        etag = '"{}"'.format(digest)
+        for tag in request[HEADER_IF_NONE_MATCH].value.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == "*" or tag == etag:
+                return True
+        return False
+
+    @staticmethod
+    def __keep_alive(request: HttpRequest | None) -> bool:
+        """
+        Checks if the connection must be kept open after answering the given request.
+        :param request: parsed request, or None if not even the request-line could be parsed
+        :return: True if the connection can be reused
+        """
+        if not request or not request.is_framed():
+            # The request failed before its body was delimited, so the body (if any) cannot be skipped, and it
+            # would be read as the next request
+            return False
+        # For HTTP/1.0, we always close the connection
+        if request.get_http_version() == HttpVersion.HTTP_10:
+            return False
+        # For HTTP/1.1, if "Connection: close" header is present, we also close the connection
+        if request.has_header(HEADER_CONNECTION) and request[HEADER_CONNECTION].value.lower() == HEADER_CONNECTION_CLOSE:
+            return False
+        return True
 
 
 if __name__ == "__main__":
+    # Only needed to start the server, so not imported along with the rest of modules
+    import argparse
+
     # Define logging format
     logging.basicConfig(format='%(asctime)s | %(message)s')
     # And output all logging messages
@@ -151,10 +705,49 @@ if __name__ == "__main__":
                         nargs='?',
                         const=DEFAULT_PORT,
                         default=DEFAULT_PORT)
+    # Listening socket inherited from a previous server process during a zero-downtime restart
+    parser.add_argument("--listen-fd",
+                        help=argparse.SUPPRESS,
+                        type=int,
+                        default=None)
+    # Pipe where the server writes once it accepts connections, so the previous server process can drain
+    parser.add_argument("--ready-fd",
+                        help=argparse.SUPPRESS,
+                        type=int,
+                        default=None)
+    # Load the virtual hosts from a snapshot, to avoid checking every host folder at startup
+    parser.add_argument("--snapshot",
+                        help="load virtual hosts from {} (written again if outdated)".format(VHOSTS_SNAPSHOT_FILE),
+                        action="store_true")
+    parser.add_argument("--capture",
+                        help="append the raw requests received to a capture file, to be replayed with replay.py",
+                        metavar="FILE",
+                        default=None)
+    parser.add_argument("--preload",
+                        help="load the files of the virtual hosts in memory before accepting connections "
+                             "(blocking), while accepting them (background) or not at all (default: {})".format(
+                            PRELOAD_MODE),
+                        choices=PRELOAD_MODES,
+                        default=PRELOAD_MODE)
+    parser.add_argument("--preload-manifest",
+                        help="only preload the paths listed in a manifest, or the ones requested in a capture file",
+                        metavar="FILE",
+                        default=None)
+    parser.add_argument("--check-startup",
+                        help="measure the startup steps, print a report and exit",
+                        action="store_true")
     args = parser.parse_args()
 
+    if args.check_startup:
+        Server.check_startup()
+        sys.exit(0)
+
     # Create the server in the specified port (8080 by default) and start listening for connections
-    server = Server(port=args.port)
+    server = Server(port=args.port, listen_fd=args.listen_fd,
+                    snapshot_file=VHOSTS_SNAPSHOT_FILE if args.snapshot else None,
+                    capture_file=args.capture, preload_mode=args.preload, preload_manifest=args.preload_manifest,
+                    ready_fd=args.ready_fd)
+    server.install_signal_handlers()
     server.listen()
     # Close the server after finishing
     server.close()
@@ -2,3 +2,60 @@ DEFAULT_PORT = 8080
 HTTP_ENCODING = "utf-8"
 SERVER_NAME = "Group AMD Server"
 VHOSTS_FILE = "vhosts.conf"
+
+# Maximum number of pending connections queued by the kernel while no thread is accepting (e.g. during a restart)
+LISTEN_BACKLOG = 128
+# Interval (in seconds) used to check for a shutdown request while blocked on accept() or on an idle connection
+POLL_INTERVAL = 0.5
+# Seconds given to in-flight requests to finish after a shutdown request, before closing them forcibly
+SHUTDOWN_TIMEOUT = 10
+# Seconds given to the new server process of a restart to accept connections, before giving up the restart
+RESTART_TIMEOUT = 30
+# Maximum number of bytes received at once from a connection
+RECV_BUFFER_SIZE = 65536
+# Maximum size of the request-line plus the headers of a request
+MAX_HEADER_SIZE = 65536
+# Number of entries per page in the directory listings (vhosts with the autoindex option)
+AUTOINDEX_PAGE_SIZE = 1000
+# Maximum number of directory entries kept in memory, adding up the cached listings of all the directories
+AUTOINDEX_CACHE_ENTRIES = 262144
+# Binary snapshot of the validated virtual hosts, used with the --snapshot flag to speed up the startup
+VHOSTS_SNAPSHOT_FILE = "vhosts.snapshot"
+# Maximum number of simultaneous connections to each upstream server (vhosts with the upstream option)
+UPSTREAM_MAX_CONNECTIONS = 32
+# Maximum number of idle keep-alive connections kept open to each upstream server
+UPSTREAM_MAX_IDLE = 8
+# Seconds after which an idle connection to an upstream server is closed instead of reused
+UPSTREAM_IDLE_TIMEOUT = 30
+# Seconds to wait for an upstream server to accept a connection, and to send data
+UPSTREAM_CONNECT_TIMEOUT = 5
+UPSTREAM_TIMEOUT = 30
+# After this number of consecutive failed connections, an upstream server is considered down for some seconds
+UPSTREAM_MAX_FAILURES = 3
+UPSTREAM_RETRY_INTERVAL = 5
+# Whether HTTP/2 over cleartext TCP (h2c) is accepted, either with prior knowledge or upgrading from HTTP/1.1
+H2_ENABLED = True
+# Maximum number of simultaneous streams (requests) in an HTTP/2 connection
+H2_MAX_CONCURRENT_STREAMS = 100
+# Bytes of request body that an HTTP/2 client can send ahead in each stream (and in the whole connection)
+H2_INITIAL_WINDOW_SIZE = 1048576
+# Whether the files of the vhosts are loaded in memory at startup: "blocking" (connections are accepted once they are
+# loaded), "background" (connections are accepted while they are loaded) or "off" (only loaded when first served)
+PRELOAD_MODE = "background"
+# Maximum number of bytes of files kept in memory, and size of the largest file kept
+PRELOAD_MAX_BYTES = 67108864
+PRELOAD_MAX_FILE_SIZE = 1048576
+# Number of threads loading files at startup
+PRELOAD_WORKERS = 8
+# Maximum number of requests processed at the same time (in total, see the max_requests option of the vhosts for
+# the limit of each one). Further requests wait in a queue of their vhost
+MAX_ACTIVE_REQUESTS = 128
+# Bytes a vhost with the max_rate option can send at once, before its bandwidth starts to be limited
+VHOST_RATE_BURST = 65536
+# Number of latest queueing delays kept per vhost to compute their percentiles
+SCHEDULER_DELAY_SAMPLES = 1024
+# Folder where the content of the uploaded files is stored once, named after its hash, and hard linked to the vhost
+# files (it must be in the same filesystem as the vhost folders, otherwise uploaded files are not deduplicated)
+BLOB_STORE_DIR = ".blobs"
+# Maximum number of file hashes (used as ETags) kept in memory
+BLOB_HASH_CACHE_SIZE = 65536
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import datetime
+import html
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+from urllib.parse import quote
+
+from http.response import HttpResponseForbidden, HttpResponseNotFound
+from settings import AUTOINDEX_CACHE_ENTRIES, AUTOINDEX_PAGE_SIZE
+
+# This file generates the listings of directories without an index file, for the vhosts with the autoindex option.
+# Scanning a directory is expensive when it has many entries, so the names of the entries are cached per directory,
+# and only scanned again once the directory has been modified (its mtime changed) or explicitly invalidated. The
+# cache is limited by the total number of entries (AUTOINDEX_CACHE_ENTRIES), and only the entries of the requested
+# page are stat'ed (to get their size and modification time), so listing a huge directory does not take memory nor
+# time for the entries which are not shown.
+
+# Number of entries rendered at once while streaming a listing
+LISTING_BLOCK_SIZE = 100
+
+
+class DirectoryEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+
+
+class DirectoryListing(NamedTuple):
+    mtime_ns: int
+    # Names of the entries sorted, with the directories first
+    names: List[str]
+    directories: int
+
+
+# Cached listings, by directory path. Dictionaries keep the insertion order, so the first one is the oldest
+_listings: Dict[str, DirectoryListing] = {}
+# Total number of entries of the cached listings
+_listings_entries = 0
+_listings_lock = threading.Lock()
+
+
+def scan_directory(path: Path) -> Tuple[List[str], int]:
+    """
+    Scans the names of the entries of a directory, skipping hidden entries (which include the temporary files of
+    uploads in progress). The entries are not stat'ed, only the type given by the directory itself is used.
+    :param path: directory to be scanned
+    :return: list of names sorted with directories first, and the number of directories
+    """
+    directories, files = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                # Removed while scanning the directory
+                continue
+            (directories if is_dir else files).append(entry.name)
+    directories.sort()
+    files.sort()
+    return directories + files, len(directories)
+
+
+def get_directory_names(path: Path) -> DirectoryListing:
+    """
+    Gets the names of the entries of a directory, from the cache if the directory has not been modified since it
+    was scanned.
+    :param path: directory to be listed
+    :return: listing of the directory
+    """
+    global _listings_entries
+
+    try:
+        # Get the modification time before scanning, so changes during the scan are detected in the next call
+        mtime_ns = path.stat().st_mtime_ns
+        key = str(path)
+        with _listings_lock:
+            listing = _listings.get(key)
+        if listing is not None and listing.mtime_ns == mtime_ns:
+            return listing
+
+        listing = DirectoryListing(mtime_ns, *scan_directory(path))
+    except FileNotFoundError:
+        raise HttpResponseNotFound(content="Directory not found")
+    except PermissionError:
+        raise HttpResponseForbidden()
+
+    if len(listing.names) > AUTOINDEX_CACHE_ENTRIES:
+        # It would take the whole cache, so it is scanned again in every request
+        return listing
+    with _listings_lock:
+        previous = _listings.pop(key, None)
+        if previous is not None:
+            _listings_entries -= len(previous.names)
+        _listings[key] = listing
+        _listings_entries += len(listing.names)
+        # Remove the oldest listings if the cache is full
+        while _listings_entries > AUTOINDEX_CACHE_ENTRIES:
+            _listings_entries -= len(_listings.pop(next(iter(_listings))).names)
+    return listing
+
+
+def invalidate_directory(path: Path):
+    """
+    Removes the cached listing of a directory, so it is scanned again in the next request. Used after modifying a
+    directory, as its mtime may not change if it is modified several times within the filesystem time resolution.
+    :param path: modified directory
+    """
+    global _listings_entries
+
+    with _listings_lock:
+        listing = _listings.pop(str(path), None)
+        if listing is not None:
+            _listings_entries -= len(listing.names)
+
+
+def get_listing_page(path: Path, page: int) -> Tuple[List[DirectoryEntry], int]:
+    """
+    Gets one page of the listing of a directory. Only the entries of the page are stat'ed.
+    :param path: directory to be listed
+    :param page: number of the page, starting at 1
+    :return: entries in the page, and total number of pages
+    """
+    listing = get_directory_names(path)
+    pages = max(1, (len(listing.names) + AUTOINDEX_PAGE_SIZE - 1) // AUTOINDEX_PAGE_SIZE)
+    if page < 1 or page > pages:
+        raise HttpResponseNotFound(content="Page {} not found, there are {} pages".format(page, pages))
+    start = (page - 1) * AUTOINDEX_PAGE_SIZE
+    entries = []
+    for i, name in enumerate(listing.names[start:start + AUTOINDEX_PAGE_SIZE], start):
+        try:
+            stat = os.stat(os.path.join(path, name))
+        except OSError:
+            # Removed since the directory was scanned
+            continue
+        entries.append(DirectoryEntry(name, i < listing.directories, stat.st_size, stat.st_mtime))
+    return entries, pages
+
+
+def generate_listing_html(url_path: str, entries: List[DirectoryEntry], page: int, pages: int) -> Iterator[str]:
+    """
+    Generates the HTML listing of a page of a directory, in blocks of entries.
+    :param url_path: path of the directory in the URL, ending with /
+    :param entries: entries in the page
+    :param page: number of the page
+    :param pages: total number of pages
+    :return: iterator of HTML blocks
+    """
+    title = html.escape("Index of {}".format(url_path))
+    yield "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{0}</title></head>\n" \
+          "<body>\n<h1>{0}</h1>\n<table>\n<tr><th>Name</th><th>Size</th><th>Last modified</th></tr>\n".format(title)
+    if url_path != "/":
+        yield "<tr><td><a href=\"{}\">../</a></td><td></td><td></td></tr>\n".format(
+            quote(url_path.rstrip("/").rsplit("/", 1)[0] + "/"))
+
+    for i in range(0, len(entries), LISTING_BLOCK_SIZE):
+        yield "".join("<tr><td><a href=\"{}\">{}</a></td><td>{}</td><td>{}</td></tr>\n".format(
+            quote(url_path + e.name + ("/" if e.is_dir else "")),
+            html.escape(e.name + ("/" if e.is_dir else "")),
+            "-" if e.is_dir else e.size,
+            datetime.datetime.fromtimestamp(e.mtime, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        ) for e in entries[i:i + LISTING_BLOCK_SIZE])
+
+    yield "</table>\n<p>"
+    if page > 1:
+        yield "<a href=\"?page={}\">Previous</a> ".format(page - 1)
+    yield "Page {} of {}".format(page, pages)
+    if page < pages:
+        yield " <a href=\"?page={}\">Next</a>".format(page + 1)
+    yield "</p>\n</body></html>\n"
+
+
+def generate_listing_json(url_path: str, entries: List[DirectoryEntry], page: int, pages: int) -> Iterator[str]:
+    """
+    Generates the JSON listing of a page of a directory, in blocks of entries.
+    :param url_path: path of the directory in the URL, ending with /
+    :param entries: entries in the page
+    :param page: number of the page
+    :param pages: total number of pages
+    :return: iterator of JSON blocks
+    """
+    yield '{{"path": {}, "page": {}, "pages": {}, "entries": ['.format(json.dumps(url_path), page, pages)
+    for i in range(0, len(entries), LISTING_BLOCK_SIZE):
+        yield ("," if i > 0 else "") + ",".join(json.dumps({
+            "name": e.name,
+            "type": "directory" if e.is_dir else "file",
+            "size": e.size,
+            "mtime": e.mtime,
+        }) for e in entries[i:i + LISTING_BLOCK_SIZE])
+    yield "]}"
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Dict, NamedTuple, Tuple
+
+from settings import BLOB_HASH_CACHE_SIZE, BLOB_STORE_DIR, RECV_BUFFER_SIZE
+
+# This file implements the content-addressed store of the uploaded files. The content of every PUT request is hashed
+# (with SHA-256) while it is received, and stored once in BLOB_STORE_DIR, named after its hash. The file of the vhost
+# is then a hard link to it, so identical files uploaded to many paths or vhosts take the disk (and the page cache)
+# only once. The number of links of a stored file is its reference count: the store keeps one, and every vhost file
+# sharing it another, so once a file is deleted and only the one of the store remains, the stored file is removed.
+# The hashes are kept by inode (for the files which are not in the store too, once they are hashed when served), so
+# they can be used as strong ETags without reading the files again. Only the BLOB_HASH_CACHE_SIZE most recently used
+# ones are kept: a file whose hash is not known anymore is hashed again when it is served, or when it is removed while
+# linked to the store (to know which stored file it used). If the filesystem does not support hard links, the uploaded
+# files are just kept as they are.
+
+
+class FileHash(NamedTuple):
+    # Modification time and size of the file when it was hashed, so the hash is not used once it changes
+    mtime_ns: int
+    size: int
+    digest: str
+
+
+# Known hashes, by (device, inode), from the least to the most recently used
+_hashes: Dict[Tuple[int, int], FileHash] = {}
+_hashes_lock = threading.Lock()
+# Serializes the changes of the store, so a stored file is not removed while it is being linked
+_store_lock = threading.Lock()
+
+
+def new_hash():
+    return hashlib.sha256()
+
+
+def get_blob_path(digest: str) -> Path:
+    # Files are spread in subfolders by the first characters of their hash, so no folder gets too large
+    return Path(BLOB_STORE_DIR, digest[:2], digest)
+
+
+def _get_known_hash(st: os.stat_result) -> str | None:
+    """
+    :param st: status of a file
+    :return: hash of the file, if it is known and the file has not changed since it was hashed
+    """
+    key = (st.st_dev, st.st_ino)
+    with _hashes_lock:
+        known = _hashes.pop(key, None)
+        if known is None:
+            return None
+        # Moved to the end, as the most recently used
+        _hashes[key] = known
+    if known.mtime_ns == st.st_mtime_ns and known.size == st.st_size:
+        return known.digest
+    return None
+
+
+def _set_known_hash(st: os.stat_result, digest: str):
+    key = (st.st_dev, st.st_ino)
+    with _hashes_lock:
+        _hashes.pop(key, None)
+        _hashes[key] = FileHash(st.st_mtime_ns, st.st_size, digest)
+        # Remove the least recently used hashes if the cache is full
+        while len(_hashes) > BLOB_HASH_CACHE_SIZE:
+            _hashes.pop(next(iter(_hashes)))
+
+
+def _forget_hash(st: os.stat_result):
+    with _hashes_lock:
+        _hashes.pop((st.st_dev, st.st_ino), None)
+
+
+def get_file_hash(path: Path) -> Tuple[os.stat_result, str | None]:
+    """
+    Gets the hash of a file, if it is known and the file has not changed since it was hashed.
+    :param path: path of the file
+    :return: status of the file (to record its hash later, if unknown), and its hash or None
+    """
+    st = os.stat(path)
+    return st, _get_known_hash(st)
+
+
+def record_file_hash(st: os.stat_result, content: bytes) -> str:
+    """
+    Hashes the content of a file, and keeps its hash for the next requests.
+    :param st: status of the file, taken before reading it
+    :param content: content of the file
+    :return: hash of the content
+    """
+    digest = new_hash()
+    digest.update(content)
+    _set_known_hash(st, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def get_linked_hash(path: Path, st: os.stat_result) -> str | None:
+    """
+    Gets the hash of the stored file a file is linked to, hashing the file if its hash is not known anymore. Used
+    before removing (or replacing) the file, to release the stored file afterwards.
+    :param path: path of the file
+    :param st: status of the file
+    :return: hash of the stored file, or None if the file is not linked to the store
+    """
+    if st.st_nlink <= 1:
+        # No other link, so it cannot be in the store
+        return None
+    digest = _get_known_hash(st)
+    if digest is None:
+        hash_ = new_hash()
+        try:
+            with open(path, mode='rb') as f:
+                for block in iter(lambda: f.read(RECV_BUFFER_SIZE), b""):
+                    hash_.update(block)
+        except OSError:
+            return None
+        digest = hash_.hexdigest()
+        _set_known_hash(st, digest)
+    try:
+        blob_st = os.stat(get_blob_path(digest))
+    except OSError:
+        return None
+    if (blob_st.st_dev, blob_st.st_ino) != (st.st_dev, st.st_ino):
+        return None
+    return digest
+
+
+def link_file(upload_path: Path, path: Path, digest: str):
+    """
+    Adds an uploaded file to the store (unless its content is already stored), and replaces the file of the vhost
+    with a link to the stored one. The uploaded file is left as it is, to be removed by the caller.
+    :param upload_path: uploaded file, which must be in the same filesystem as the store
+    :param path: file of the vhost to be created or replaced
+    :param digest: hash of the content of the uploaded file
+    """
+    blob_path = get_blob_path(digest)
+    link_path = path.with_name(".{}.{}.link".format(path.name, threading.get_ident()))
+    try:
+        previous = os.stat(path)
+        previous_digest = get_linked_hash(path, previous)
+    except OSError:
+        previous, previous_digest = None, None
+
+    with _store_lock:
+        try:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(upload_path, blob_path)
+            except FileExistsError:
+                # Same content already stored, so the uploaded file is discarded
+                pass
+            os.link(blob_path, link_path)
+            os.replace(link_path, path)
+        except OSError:
+            # Hard links are not supported (or the stored file was just removed), so keep the uploaded file
+            os.replace(upload_path, path)
+            return
+        finally:
+            # Left behind if the link could not replace the file, or if the file already was the same link
+            if os.path.lexists(link_path):
+                os.unlink(link_path)
+        _set_known_hash(os.stat(path), digest)
+
+    if previous is not None:
+        # The replaced file may have been the last reference to a stored file
+        release_file(previous, previous_digest)
+
+
+def release_file(st: os.stat_result, digest: str | None):
+    """
+    Given the status of a file which was just removed (or replaced), removes the stored file it was linked to if no
+    other file uses it. Once the last link of the file is gone, its hash is forgotten.
+    :param st: status of the file, taken before removing it
+    :param digest: hash of the stored file it was linked to (see get_linked_hash), or None if it was not linked
+    """
+    with _store_lock:
+        if digest is None:
+            if st.st_nlink <= 1:
+                _forget_hash(st)
+            return
+        blob_path = get_blob_path(digest)
+        try:
+            blob_st = os.stat(blob_path)
+        except OSError:
+            _forget_hash(st)
+            return
+        if (blob_st.st_dev, blob_st.st_ino) != (st.st_dev, st.st_ino) or blob_st.st_nlink > 1:
+            # Stored again since, or still used by other files
+            return
+        try:
+            blob_path.unlink()
+        except OSError:
+            return
+        _forget_hash(st)
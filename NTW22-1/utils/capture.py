@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import struct
+import threading
+from typing import Iterator, NamedTuple
+
+# This file implements the capture of the raw traffic received by the server, so it can be replayed later (see
+# replay.py). A capture file starts with CAPTURE_MAGIC, followed by records with the following format:
+#   timestamp (double) | connection id (unsigned 64 bits) | length (unsigned 32 bits) | data
+# Each record contains the bytes received by a single recv() call. A record without data indicates that the
+# connection was closed.
+
+CAPTURE_MAGIC = b"NTW22CAP1\n"
+RECORD_HEADER = struct.Struct("<dQI")
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    conn_id: int
+    data: bytes
+
+
+class CaptureWriter:
+    """
+    Appends records to a capture file. It can be shared by all the connection threads.
+    """
+    __file = None
+    __lock = None
+
+    def __init__(self, path: str):
+        self.__file = open(path, mode='ab')
+        self.__lock = threading.Lock()
+        # New (empty) files start with the magic value, while existing ones are just appended to
+        if self.__file.tell() == 0:
+            self.__file.write(CAPTURE_MAGIC)
+            self.__file.flush()
+
+    def record(self, timestamp: float, conn_id: int, data: bytes):
+        """
+        Appends a record to the file.
+        :param timestamp: time when the data was received
+        :param conn_id: identifier of the connection where the data was received
+        :param data: received bytes, or empty bytes if the connection was closed
+        """
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.__file.write(RECORD_HEADER.pack(timestamp, conn_id, len(data)) + data)
+            # Flush every record, so the capture is not lost if the server is killed
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """
+    Reads the records of a capture file, in the order they were written.
+    :param path: capture file
+    :return: iterator of records (a truncated last record is ignored)
+    """
+    with open(path, mode='rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, conn_id, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(timestamp, conn_id, data)
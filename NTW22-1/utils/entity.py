@@ -1,16 +1,27 @@
 from __future__ import annotations
 
-import datetime
-import locale
+import time
+from typing import Iterator
 
-from http.enums import HttpVersion, HttpMethod
-from http.header import HttpHeader, HEADER_DATE, HEADER_CONTENT_LENGTH, HEADER_SERVER
+from http.enums import HttpMethod, HttpResponseCode, HttpVersion
+from http.header import HttpHeader, HEADER_DATE, HEADER_CONTENT_LENGTH, HEADER_CONTENT_LOCATION, HEADER_SERVER, \
+    HEADER_TRANSFER_ENCODING, HEADER_TRANSFER_ENCODING_CHUNKED
 from http.request import HttpRequest
-from http.response import HttpResponse
+from http.response import BaseHttpResponse
+from http.stream import encode_chunked
 from settings import HTTP_ENCODING, SERVER_NAME
 
+# English names used by the HTTP date format, independently of the system locale (so no locale has to be set)
+WEEKDAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTH_NAMES = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+# Bodies up to this size are sent in the same block as the head. Larger ones are sent apart, so they are not copied
+COALESCE_BODY_SIZE = 16384
 
-def generate_header_server(response: HttpResponse):
+# Value of the Date header for the current second, as (second, value), so it is not formatted for every response
+_date_cache = (0, "")
+
+
+def generate_header_server(response: BaseHttpResponse):
     """
     Given a response, appends the Server header.
     :param response: response object where the Server header will be added
@@ -19,34 +30,52 @@ def generate_header_server(response: HttpResponse):
     response[HEADER_SERVER] = header
 
 
-def generate_header_date(response: HttpResponse):
+def generate_header_date(response: BaseHttpResponse):
     """
     Given a response, appends the Date header.
     :param response: response object where the Date header will be added
     """
-    # https://stackoverflow.com/a/225106
-    locale.setlocale(locale.LC_TIME, 'en_US')
-    header = HttpHeader(name=HEADER_DATE, value=datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'))
+    global _date_cache
+    second = int(time.time())
+    if _date_cache[0] != second:
+        now = time.gmtime(second)
+        _date_cache = (second, "{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT".format(
+            WEEKDAY_NAMES[now.tm_wday], now.tm_mday, MONTH_NAMES[now.tm_mon - 1], now.tm_year,
+            now.tm_hour, now.tm_min, now.tm_sec))
+    header = HttpHeader(name=HEADER_DATE, value=_date_cache[1])
     response[HEADER_DATE] = header
 
 
-def generate_header_content_length(response: HttpResponse):
+def generate_header_content_length(response: BaseHttpResponse):
     """
     Given a response, appends the Content-Length header if needed
     :param response: response where the Content-Length header will be added
     """
-    if response.get_content() is None:
-        # If no content, we ignore this header
+    if response.is_streamed():
+        # If the content is streamed, we ignore this header, as its size is not known yet
         return
-    # Otherwise, get the size of the contents and append it as header
-    v = response.get_content()
+    if response.get_status_code() == HttpResponseCode.NOT_MODIFIED:
+        # The response has no body, but this header would refer to the size of the file the client already has
+        return
+    # Otherwise, get the size of the contents (if any) and append it as header
+    v = response.get_content() or b''
     if isinstance(response.get_content(), str):
         v = response.get_content().encode(HTTP_ENCODING)
     header = HttpHeader(name=HEADER_CONTENT_LENGTH, value=str(len(v)))
     response[HEADER_CONTENT_LENGTH] = header
 
 
-def generate_auto_headers(request: HttpRequest, response: HttpResponse):
+def generate_header_content_location(request: HttpRequest, response: BaseHttpResponse):
+    """
+    Given a request and a response, appends the Content-Location header pointing to the requested resource.
+    :param request: original request from the client
+    :param response: response where the Content-Location header will be added
+    """
+    header = HttpHeader(name=HEADER_CONTENT_LOCATION, value="/" + request.get_path())
+    response[HEADER_CONTENT_LOCATION] = header
+
+
+def generate_auto_headers(request: HttpRequest, response: BaseHttpResponse):
     """
     Given a request and a response, add to the response object the "automatic" headers.
     :param request: original request from the client
@@ -60,9 +89,9 @@ def generate_auto_headers(request: HttpRequest, response: HttpResponse):
         generate_header_content_length(response)
         # Content-Type is generated at server.py
     elif request.get_method() == HttpMethod.PUT:
-        # We need Content-Location
-        # TODO: Content-Location
-        pass
+        # We need Date and Content-Location
+        generate_header_date(response)
+        generate_header_content_location(request, response)
     elif request.get_method() == HttpMethod.DELETE:
         # We need Date
         generate_header_date(response)
@@ -73,16 +102,68 @@ def generate_auto_headers(request: HttpRequest, response: HttpResponse):
         # Content-Type is generated at server.py
 
 
-def generate_output(request: HttpRequest | None, response: HttpResponse) -> bytes:
+def generate_headers(request: HttpRequest | None, response: BaseHttpResponse):
     """
-    Given a request object and a response, generates the corresponding HTTP responding as a string.
-    :param request: original request from the client
+    Given a request object and a response, adds to the response all the headers generated by the server.
+    :param request: original request from the client (None if it could not be parsed)
     :param response: prepared response from the server
-    :return: valid HTTP response string
     """
+    if response.is_relayed():
+        # The headers of the upstream server are kept as they are (e.g. its Content-Length of a 304 response)
+        return
     if request:
         # If we receive a valid request, then try to generate the needed headers automatically
         generate_auto_headers(request, response)
-    # Generate the response-line and append the response serialization (headers and body) afterwards
-    return "{} {}\r\n".format(HttpVersion.HTTP_10 if not request else request.get_http_version(),
-                              response.get_status_code()).encode(HTTP_ENCODING) + bytes(response)
+    if not response.is_streamed() and not response.has_header(HEADER_CONTENT_LENGTH) \
+            and response.get_status_code() != HttpResponseCode.NOT_MODIFIED:
+        # The body length is always indicated, so the client knows where the response ends in a persistent connection
+        generate_header_content_length(response)
+
+
+def generate_stream(request: HttpRequest | None, response: BaseHttpResponse) -> Iterator[bytes]:
+    """
+    Given a request object and a response, generates the corresponding HTTP response as blocks of bytes. If the
+    response content is streamed, its blocks are generated as soon as they are available: with the chunked
+    transfer coding for HTTP/1.1 clients, or until the connection is closed for HTTP/1.0 ones.
+    :param request: original request from the client
+    :param response: prepared response from the server
+    :return: iterator of blocks of the valid HTTP response
+    """
+    generate_headers(request, response)
+    http_version = HttpVersion.HTTP_10 if not request else request.get_http_version()
+
+    chunked = response.is_streamed() and not response.has_header(HEADER_CONTENT_LENGTH) \
+        and http_version == HttpVersion.HTTP_11
+    if chunked:
+        response[HEADER_TRANSFER_ENCODING] = HttpHeader(HEADER_TRANSFER_ENCODING, HEADER_TRANSFER_ENCODING_CHUNKED)
+
+    # Generate the response-line and the headers, followed by the body afterwards
+    head = "{} {}\r\n{}\r\n".format(http_version, response.get_status_code(),
+                                     response.serialize_headers()).encode(HTTP_ENCODING)
+    if not response.is_streamed():
+        content = response.get_content() or b''
+        if isinstance(content, str):
+            content = content.encode(HTTP_ENCODING)
+        if len(content) <= COALESCE_BODY_SIZE:
+            yield head + content
+        else:
+            yield head
+            yield content
+        return
+
+    yield head
+    if chunked:
+        yield from encode_chunked(response.get_content())
+    else:
+        for block in response.get_content():
+            yield block.encode(HTTP_ENCODING) if isinstance(block, str) else block
+
+
+def generate_output(request: HttpRequest | None, response: BaseHttpResponse) -> bytes:
+    """
+    Given a request object and a response, generates the corresponding HTTP responding as a string.
+    :param request: original request from the client
+    :param response: prepared response from the server
+    :return: valid HTTP response string
+    """
+    return b''.join(generate_stream(request, response))
@@ -1,4 +1,24 @@
+from __future__ import annotations
+
+from pathlib import Path
+
 CUSTOM_MIMETYPES = {
     "woff": "font/woff",
     "woff2": "font/woff2",
 }
+
+
+def guess_type(path: Path) -> str | None:
+    """
+    Given a file path, guesses its MIME type from the extension, falling back to CUSTOM_MIMETYPES.
+    The mimetypes module reads the system MIME databases when first used, so it is only imported once a file is
+    served instead of at startup.
+    :param path: path of the file
+    :return: MIME type, or None if unknown
+    """
+    import mimetypes
+
+    content_type = mimetypes.guess_type(path)[0]
+    if content_type is None:
+        content_type = CUSTOM_MIMETYPES.get(path.suffix[1:])
+    return content_type
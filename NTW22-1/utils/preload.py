@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import os
+import stat
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from settings import PRELOAD_MAX_BYTES, PRELOAD_MAX_FILE_SIZE, PRELOAD_WORKERS
+from utils.capture import CAPTURE_MAGIC, read_capture
+from utils.mime import guess_type
+
+if TYPE_CHECKING:
+    # Only for the annotations, as vhosts.py imports this file
+    from utils.vhosts import Vhost
+
+# This file keeps the files served by the vhosts in memory, so the first requests after a restart do not pay cold
+# disk reads and MIME type lookups. Files are loaded at startup (see preload), either walking the vhost folders or
+# following a manifest of hot paths, and afterwards when they are first served, as long as PRELOAD_MAX_BYTES is not
+# exceeded. Every stored file keeps the mtime and size it was read with, so it is only served while the file on disk
+# has not changed, and it is removed as soon as the server writes or deletes it.
+
+# Values of the PRELOAD_MODE setting: do not preload, preload before accepting connections, or preload while they
+# are already being served
+PRELOAD_OFF = "off"
+PRELOAD_BLOCKING = "blocking"
+PRELOAD_BACKGROUND = "background"
+PRELOAD_MODES = (PRELOAD_OFF, PRELOAD_BLOCKING, PRELOAD_BACKGROUND)
+
+
+class StoredFile(NamedTuple):
+    mtime_ns: int
+    size: int
+    content: bytes
+    content_type: str
+
+
+# Stored files, by path, and the number of bytes they take (including the ones reserved by files being read)
+_files: Dict[str, StoredFile] = {}
+_files_size = 0
+_files_lock = threading.Lock()
+
+
+def get_stored_file(path: Path) -> StoredFile | None:
+    """
+    Gets a file from memory, if it is stored and it has not changed on disk since it was read.
+    :param path: path of the file
+    :return: stored file, or None if it must be read from disk
+    """
+    key = str(path)
+    with _files_lock:
+        stored = _files.get(key)
+    if stored is None:
+        return None
+    try:
+        st = os.stat(key)
+    except OSError:
+        invalidate_file(path)
+        return None
+    if st.st_mtime_ns != stored.mtime_ns or st.st_size != stored.size:
+        invalidate_file(path)
+        return None
+    return stored
+
+
+def store_file(path: Path, max_bytes: int = PRELOAD_MAX_BYTES) -> StoredFile | None:
+    """
+    Reads a file and keeps it in memory, unless it is too large, its MIME type is unknown or the budget is used up.
+    :param path: path of the file
+    :param max_bytes: maximum number of bytes stored in total
+    :return: stored file, or None if it was not stored
+    """
+    global _files_size
+
+    key = str(path)
+    try:
+        # Get the mtime before reading, so any change while reading is detected when the file is served
+        st = os.stat(key)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size > PRELOAD_MAX_FILE_SIZE:
+        return None
+
+    with _files_lock:
+        previous = _files.get(key)
+        if previous is not None and previous.mtime_ns == st.st_mtime_ns and previous.size == st.st_size:
+            return previous
+        if _files_size + st.st_size > max_bytes:
+            return None
+        # Reserve the space while the file is being read, so parallel reads do not exceed the budget
+        _files_size += st.st_size
+
+    stored = None
+    try:
+        content_type = guess_type(path)
+        if content_type is not None:
+            with open(key, mode='rb') as f:
+                content = f.read()
+            # Otherwise, the file changed while it was being read
+            if len(content) == st.st_size:
+                stored = StoredFile(st.st_mtime_ns, st.st_size, content, content_type)
+    except OSError:
+        pass
+
+    with _files_lock:
+        if stored is None:
+            _files_size -= st.st_size
+            return None
+        previous = _files.pop(key, None)
+        if previous is not None:
+            _files_size -= previous.size
+        _files[key] = stored
+    return stored
+
+
+def invalidate_file(path: Path):
+    """
+    Removes a file from memory, so it is read again from disk. Used after writing or deleting a file, as its mtime
+    may not change if it is modified several times within the filesystem time resolution.
+    :param path: modified file
+    """
+    global _files_size
+
+    with _files_lock:
+        stored = _files.pop(str(path), None)
+        if stored is not None:
+            _files_size -= stored.size
+
+
+def get_store_size() -> Tuple[int, int]:
+    """
+    :return: number of stored files, and bytes they take
+    """
+    with _files_lock:
+        return len(_files), _files_size
+
+
+def get_host_paths(hosts: Dict[str, Vhost]) -> Iterator[Path]:
+    """
+    Walks the folders of the vhosts (except the ones forwarded to an upstream server), starting with their index
+    files. Hidden entries are skipped, as in the directory listings.
+    :param hosts: dictionary of hosts
+    :return: iterator of file paths
+    """
+    for vhost in hosts.values():
+        if vhost.get_upstream() is not None:
+            continue
+        root = vhost.get_host_root_path()
+        yield root.joinpath(vhost.get_index_file())
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith("."))
+            for name in sorted(file_names):
+                if not name.startswith("."):
+                    yield Path(dir_path, name)
+
+
+def get_manifest_paths(hosts: Dict[str, Vhost], manifest: str) -> List[Path]:
+    """
+    Reads the hot paths to be preloaded from a manifest, which is either a text file with one "hostname/path" per
+    line (ignoring empty lines and lines starting with #), or a capture file (see the --capture flag of server.py),
+    from which the paths requested with GET are taken, the most requested ones first.
+    :param hosts: dictionary of hosts
+    :param manifest: manifest file
+    :return: list of file paths, by priority
+    """
+    # Imported here, as vhosts.py imports this file
+    from utils.vhosts import Vhost
+
+    with open(manifest, mode='rb') as f:
+        is_capture = f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+    if is_capture:
+        entries = get_capture_paths(hosts, manifest)
+    else:
+        entries = []
+        with open(manifest, mode='r') as f:
+            for line in f:
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                hostname, _, path = line.partition("/")
+                entries.append((hostname.lower(), path))
+
+    paths = []
+    for hostname, path in entries:
+        vhost = hosts.get(hostname)
+        if vhost is None or vhost.get_upstream() is not None or not Vhost.is_secure_path(path):
+            continue
+        file_path = vhost.get_host_root_path().joinpath(path)
+        if file_path.is_dir():
+            # As served by GET requests of the folder
+            file_path = file_path.joinpath(vhost.get_index_file())
+        paths.append(file_path)
+    return paths
+
+
+def get_capture_paths(hosts: Dict[str, Vhost], capture: str) -> List[Tuple[str, str]]:
+    """
+    Finds the paths requested with GET in a capture file, parsing every captured connection as the server does.
+    :param hosts: dictionary of hosts
+    :param capture: capture file
+    :return: list of (hostname, path), the most requested ones first
+    """
+    # Only needed with a capture file as manifest, so not imported at startup
+    from http.enums import HttpMethod
+    from http.request import HttpRequest
+    from http.response import HttpResponseError
+    from http.stream import PREFACE_HEAD, SocketReader
+
+    connections: Dict[int, bytearray] = {}
+    for record in read_capture(capture):
+        connections.setdefault(record.conn_id, bytearray()).extend(record.data)
+
+    hits = Counter()
+    for data in connections.values():
+        reader = SocketReader(data=bytes(data))
+        try:
+            while reader.has_buffered_data():
+                head = reader.read_head()
+                if head == PREFACE_HEAD:
+                    # HTTP/2 connection, whose frames are not parsed
+                    break
+                request = None
+                try:
+                    request = HttpRequest(head)
+                    request.parse_request(hosts, reader)
+                    if request.get_method() == HttpMethod.GET:
+                        hits[(request.get_vhost().get_hostname(), request.get_path())] += 1
+                except HttpResponseError:
+                    pass
+                if not request or not request.is_framed():
+                    # The server closes the connection, as the end of the request is unknown
+                    break
+                body = request.get_body_stream()
+                if body is not None:
+                    # Skip the body, so the next request can be read
+                    body.discard()
+        except HttpResponseError:
+            # Truncated or malformed body: the server would not read past it either
+            continue
+    return [entry for entry, _ in hits.most_common()]
+
+
+def preload(paths: Iterable[Path], workers: int = PRELOAD_WORKERS) -> Tuple[int, int]:
+    """
+    Loads files in memory with several threads, by order of priority, until the budget is used up.
+    :param paths: paths of the files, the most important ones first
+    :param workers: number of threads reading files
+    :return: number of files and bytes loaded
+    """
+    # Remove duplicates, keeping the order
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preload") as executor:
+        loaded = [stored for stored in executor.map(store_file, paths) if stored is not None]
+    return len(loaded), sum(stored.size for stored in loaded)
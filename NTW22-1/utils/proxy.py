@@ -0,0 +1,416 @@
+from __future__ import annotations
+
+import socket
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from http.header import HttpHeader, HEADER_CONNECTION, HEADER_CONNECTION_CLOSE, HEADER_CONTENT_LENGTH, \
+    HEADER_EXPECT, HEADER_HTTP2_SETTINGS, HEADER_TRANSFER_ENCODING, HEADER_TRANSFER_ENCODING_CHUNKED
+from http.request import HttpRequest
+from http.response import HttpResponse, HttpResponseBadGateway, HttpResponseGatewayTimeout, \
+    HttpResponseServiceUnavailable
+from http.stream import SocketReader, FixedLengthBodyStream, ChunkedBodyStream, encode_chunked, is_decimal
+from settings import HTTP_ENCODING, RECV_BUFFER_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_IDLE_TIMEOUT, \
+    UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_FAILURES, UPSTREAM_MAX_IDLE, UPSTREAM_RETRY_INTERVAL, UPSTREAM_TIMEOUT
+
+# This file implements the forwarding of requests for the vhosts with the upstream option. Connections to each
+# upstream server are kept in a pool and reused (keep-alive), so a new TCP connection is not needed per request.
+# Both the request and the response bodies are streamed, without keeping them in memory.
+
+# Headers which only apply to a single connection, so they are not forwarded
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                      "transfer-encoding", "upgrade", HEADER_EXPECT.lower(), HEADER_HTTP2_SETTINGS.lower()}
+
+
+def get_hop_by_hop_headers(headers: List[HttpHeader]) -> Set[str]:
+    """
+    Gets the names of the headers which must not be forwarded: the usual hop-by-hop ones, and the ones listed in
+    the Connection header of the message.
+    :param headers: headers of the message
+    :return: set of lowercase header names
+    """
+    names = set(HOP_BY_HOP_HEADERS)
+    for header in headers:
+        if header.name.lower() == HEADER_CONNECTION.lower():
+            names.update(token.strip().lower() for token in header.value.split(","))
+    return names
+
+
+class UpstreamStatus:
+    """
+    Status of a response from an upstream server, which may not be one of the HttpResponseCode ones. It behaves
+    as a HttpResponseCode when generating the response.
+    """
+    __code = None
+    __reason = None
+
+    def __init__(self, code: int, reason: str):
+        self.__code = code
+        self.__reason = reason
+
+    def get_code(self) -> int:
+        return self.__code
+
+    def get_reason(self) -> str:
+        return self.__reason
+
+    def __str__(self) -> str:
+        return "{} {}".format(self.__code, self.__reason)
+
+
+class UpstreamConnection:
+    """
+    Connection to an upstream server, along with its buffered reader.
+    """
+    sock = None
+    reader = None
+    last_used = None
+    reused = False
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = SocketReader(sock)
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def is_alive(self) -> bool:
+        """
+        Checks, without blocking, that the upstream server did not close the idle connection.
+        :return: True if the connection can be used
+        """
+        try:
+            self.sock.setblocking(False)
+            # An idle connection must not have anything to read: either it was closed (empty) or it is garbage
+            self.sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(UPSTREAM_TIMEOUT)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class UpstreamPool:
+    """
+    Pool of connections to an upstream server. It limits the number of simultaneous connections, keeps some idle
+    connections to be reused, and stops connecting for a while if the server fails repeatedly.
+    """
+    __address = None
+    __idle = None
+    __lock = None
+    __slots = None
+    __failures = 0
+    __down_until = 0
+
+    def __init__(self, address: Tuple[str, int]):
+        self.__address = address
+        # Idle connections, the most recently used at the end
+        self.__idle: List[UpstreamConnection] = []
+        # Guards the idle connections and the count of consecutive failures
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(UPSTREAM_MAX_CONNECTIONS)
+        self.__failures = 0
+        self.__down_until = 0
+
+    def acquire(self) -> UpstreamConnection:
+        """
+        Gets a connection to the upstream server, reusing an idle one if possible.
+        :return: connection, which must be given back with release()
+        """
+        if time.monotonic() < self.__down_until:
+            raise HttpResponseBadGateway(content="Upstream server is down")
+        if not self.__slots.acquire(timeout=UPSTREAM_TIMEOUT):
+            raise HttpResponseServiceUnavailable(content="Too many connections to the upstream server")
+
+        while True:
+            with self.__lock:
+                conn = self.__idle.pop() if self.__idle else None
+            if conn is None:
+                break
+            # Discard connections idle for too long, or closed by the upstream server in the meantime
+            if time.monotonic() - conn.last_used < UPSTREAM_IDLE_TIMEOUT and conn.is_alive():
+                conn.reused = True
+                return conn
+            conn.close()
+
+        try:
+            sock = socket.create_connection(self.__address, timeout=UPSTREAM_CONNECT_TIMEOUT)
+        except OSError:
+            self.__slots.release()
+            self.__record_failure()
+            raise HttpResponseBadGateway(content="Could not connect to the upstream server")
+        with self.__lock:
+            self.__failures = 0
+        sock.settimeout(UPSTREAM_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return UpstreamConnection(sock)
+
+    def release(self, conn: UpstreamConnection, reusable: bool):
+        """
+        Gives back a connection to the pool.
+        :param conn: connection obtained with acquire()
+        :param reusable: whether the connection is ready for another request. If not, it is closed
+        """
+        if reusable:
+            conn.last_used = time.monotonic()
+            with self.__lock:
+                if len(self.__idle) < UPSTREAM_MAX_IDLE:
+                    self.__idle.append(conn)
+                    conn = None
+        if conn is not None:
+            conn.close()
+        self.__slots.release()
+
+    def evict_idle(self):
+        """
+        Closes all the idle connections. Used once a connection fails, as the rest are likely broken too (e.g. the
+        upstream server restarted).
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+    def __record_failure(self):
+        self.evict_idle()
+        # Failures of several handler threads at the same time must all be counted
+        with self.__lock:
+            self.__failures += 1
+            if self.__failures >= UPSTREAM_MAX_FAILURES:
+                self.__down_until = time.monotonic() + UPSTREAM_RETRY_INTERVAL
+
+
+class UpstreamResponse(HttpResponse):
+    """
+    Response from an upstream server, sent to the client with the headers of the upstream server instead of the
+    ones generated for the files served by this one. The headers of the upstream server are kept in a list, in the
+    order they were received, as some of them may be repeated (e.g. Set-Cookie, whose values cannot be merged).
+    Headers added with add_header (e.g. Transfer-Encoding, when the body is sent again with the chunked coding) are
+    sent after them.
+    """
+    __slots__ = ("_relayed",)
+
+    def __init__(self, status: UpstreamStatus, content: Iterable[bytes] | None = None):
+        super(UpstreamResponse, self).__init__(status=status, content=content)
+        self._relayed = []
+
+    def relay_header(self, header: HttpHeader):
+        # Unlike add_header, a header with the same name as a previous one is kept
+        self._relayed.append(header)
+
+    def has_header(self, name: str):
+        return super(UpstreamResponse, self).has_header(name) or any(h.name.lower() == name.lower()
+                                                                    for h in self._relayed)
+
+    __contains__ = has_header
+
+    def get_header(self, name: str) -> HttpHeader | None:
+        header = super(UpstreamResponse, self).get_header(name)
+        if header is None:
+            header = next((h for h in self._relayed if h.name.lower() == name.lower()), None)
+        return header
+
+    __getitem__ = get_header
+
+    def get_headers(self) -> List[HttpHeader]:
+        return self._relayed + super(UpstreamResponse, self).get_headers()
+
+    def is_relayed(self) -> bool:
+        return True
+
+
+class UpstreamResponseBody:
+    """
+    Body of a response from an upstream server, streamed to the client. The connection is given back to the pool
+    once the whole body has been read (or closed, if the body is not completely read).
+    """
+    __pool = None
+    __conn = None
+    __stream = None
+    __reusable = False
+
+    def __init__(self, pool: UpstreamPool, conn: UpstreamConnection, stream: Iterator[bytes], reusable: bool):
+        self.__pool = pool
+        self.__conn = conn
+        self.__stream = stream
+        self.__reusable = reusable
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            for block in self.__stream:
+                yield block
+            self.__release(self.__reusable)
+        finally:
+            self.__release(False)
+
+    def __release(self, reusable: bool):
+        if self.__conn is None:
+            return
+        conn, self.__conn = self.__conn, None
+        self.__pool.release(conn, reusable)
+
+    def __del__(self):
+        # In case the response was never sent
+        self.__release(False)
+
+
+# Pools of connections, by upstream address
+_pools: Dict[Tuple[str, int], UpstreamPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(address: Tuple[str, int]) -> UpstreamPool:
+    """
+    Gets the pool of connections of an upstream server, creating it if needed.
+    :param address: tuple (host, port) of the upstream server
+    :return: pool of connections
+    """
+    with _pools_lock:
+        if address not in _pools:
+            _pools[address] = UpstreamPool(address)
+        return _pools[address]
+
+
+def read_until_close(reader: SocketReader) -> Iterator[bytes]:
+    """
+    Reads a body delimited by the end of the connection.
+    :param reader: reader of the connection
+    :return: iterator of blocks
+    """
+    while True:
+        block = reader.read(RECV_BUFFER_SIZE)
+        if not block:
+            return
+        yield block
+
+
+def send_request(conn: UpstreamConnection, request: HttpRequest):
+    """
+    Sends the request to the upstream server, streaming its body (if any).
+    :param conn: connection to the upstream server
+    :param request: request from the client
+    """
+    body = request.get_body_stream()
+    lines = ["{} {} HTTP/1.1".format(request.get_method(), request.get_target())]
+    hop_by_hop = get_hop_by_hop_headers(request.get_headers())
+    for header in request.get_headers():
+        if header.name.lower() in hop_by_hop or header.name.lower() == HEADER_CONTENT_LENGTH.lower():
+            continue
+        lines.append(str(header))
+    # Bodies without Content-Length (sent chunked, or in HTTP/2 DATA frames without content-length) are forwarded
+    # chunked, as the upstream connection is kept alive after the request
+    chunked = body is not None and not request.has_header(HEADER_CONTENT_LENGTH)
+    if chunked:
+        lines.append(str(HttpHeader(HEADER_TRANSFER_ENCODING, HEADER_TRANSFER_ENCODING_CHUNKED)))
+    elif body is not None:
+        lines.append(str(request.get_header(HEADER_CONTENT_LENGTH)))
+    conn.sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode(HTTP_ENCODING))
+
+    if chunked:
+        for block in encode_chunked(body):
+            conn.sock.sendall(block)
+    elif body is not None:
+        for block in body:
+            conn.sock.sendall(block)
+
+
+def read_response_head(conn: UpstreamConnection) -> Tuple[UpstreamStatus, List[HttpHeader]]:
+    """
+    Reads the head of the response from the upstream server, skipping interim (1xx) responses.
+    :param conn: connection to the upstream server
+    :return: status of the response, and its headers
+    """
+    while True:
+        head = conn.reader.read_head()
+        if not head:
+            raise ConnectionResetError("Upstream server closed the connection")
+        try:
+            lines = head.decode(HTTP_ENCODING).split("\r\n")
+        except UnicodeDecodeError:
+            raise HttpResponseBadGateway(content="Response head from the upstream server is not valid {}".format(
+                HTTP_ENCODING))
+        status_line = lines[0].split(" ", 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/") or not status_line[1].isdigit():
+            raise HttpResponseBadGateway(content="Invalid response from the upstream server")
+        code = int(status_line[1])
+        if 100 <= code < 200:
+            continue
+
+        headers = []
+        for line in lines[1:]:
+            if line == '':
+                break
+            name, sep, value = line.partition(":")
+            if sep == '':
+                raise HttpResponseBadGateway(content="Invalid header from the upstream server")
+            headers.append(HttpHeader(name.strip(), value.strip()))
+        return UpstreamStatus(code, status_line[2] if len(status_line) > 2 else ""), headers
+
+
+def forward_request(request: HttpRequest, address: Tuple[str, int]) -> HttpResponse:
+    """
+    Forwards a request to an upstream server, and generates the response to be sent to the client, whose body is
+    streamed from the upstream server.
+    :param request: request from the client
+    :param address: tuple (host, port) of the upstream server
+    :return: response for the client
+    """
+    pool = get_pool(address)
+    while True:
+        conn = pool.acquire()
+        # A reused connection may have been closed by the upstream server right before being used. The request
+        # can be sent again in a new connection, but only if it has no body to be streamed
+        body = request.get_body_stream()
+        can_retry = conn.reused and (body is None or body.is_finished())
+        # Until the response head is read, the connection goes back to the pool on any error
+        answered = False
+        try:
+            send_request(conn, request)
+            status, headers = read_response_head(conn)
+            answered = True
+            break
+        except socket.timeout:
+            raise HttpResponseGatewayTimeout(content="Upstream server did not answer in time")
+        except OSError:
+            pool.evict_idle()
+            if can_retry:
+                continue
+            raise HttpResponseBadGateway(content="Connection to the upstream server failed")
+        finally:
+            if not answered:
+                pool.release(conn, False)
+
+    values = {h.name.lower(): h.value for h in headers}
+    reusable = values.get(HEADER_CONNECTION.lower(), "").lower() != HEADER_CONNECTION_CLOSE
+    if status.get_code() in (204, 304):
+        body = None
+    elif values.get(HEADER_TRANSFER_ENCODING.lower(), "").lower() == HEADER_TRANSFER_ENCODING_CHUNKED:
+        body = ChunkedBodyStream(conn.reader)
+    elif HEADER_CONTENT_LENGTH.lower() in values:
+        if not is_decimal(values[HEADER_CONTENT_LENGTH.lower()]):
+            pool.release(conn, False)
+            raise HttpResponseBadGateway(content="Invalid Content-Length from the upstream server")
+        body = FixedLengthBodyStream(conn.reader, int(values[HEADER_CONTENT_LENGTH.lower()]))
+    else:
+        # The body ends when the upstream server closes the connection
+        body, reusable = read_until_close(conn.reader), False
+
+    if body is None:
+        pool.release(conn, reusable)
+        response = UpstreamResponse(status=status)
+    else:
+        response = UpstreamResponse(status=status, content=UpstreamResponseBody(pool, conn, body, reusable))
+    hop_by_hop = get_hop_by_hop_headers(headers)
+    for header in headers:
+        # Transfer-Encoding is not copied: the body is sent again with the chunked coding if needed
+        if header.name.lower() not in hop_by_hop:
+            response.relay_header(header)
+    return response
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, TYPE_CHECKING
+
+from settings import HTTP_ENCODING, MAX_ACTIVE_REQUESTS, SCHEDULER_DELAY_SAMPLES, VHOST_RATE_BURST
+
+if TYPE_CHECKING:
+    # Only for the annotations
+    from utils.vhosts import Vhost
+
+# This file shares the request processing between the vhosts. At most MAX_ACTIVE_REQUESTS requests are processed at
+# the same time (from being parsed until their response is completely sent), and each vhost can be limited to fewer
+# with its max_requests option. Requests above the limits wait in a queue per vhost, and whenever a request finishes,
+# the next one is taken with weighted fair queuing: every vhost has a virtual time which advances 1/weight with every
+# request started, and the waiting request of the vhost with the lowest virtual time goes first. So, while several
+# vhosts have requests waiting, each one gets a share of the capacity proportional to its weight option, regardless of
+# how many requests it receives. Additionally, the bandwidth of each vhost can be limited with its max_rate option
+# (bytes per second), shared by all its responses with a token bucket.
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all the responses of a vhost. Tokens are bytes, which are added at the given rate up to
+    the given burst. A consumer can take more tokens than available (leaving the bucket in debt), in which case it
+    waits until the debt is paid, so consumers waiting at the same time are served in order.
+    """
+    __rate = None
+    __burst = None
+    __tokens = None
+    __updated = None
+    __lock = None
+
+    def __init__(self, rate: int, burst: int = VHOST_RATE_BURST):
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def get_burst(self) -> int:
+        return self.__burst
+
+    def consume(self, size: int) -> float:
+        """
+        Takes tokens from the bucket, waiting until they are available.
+        :param size: number of bytes to be sent
+        :return: seconds waited
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= size
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class VhostQueue:
+    """
+    Scheduling state and metrics of a vhost. Only accessed with the lock of the scheduler held, except the bucket.
+    """
+
+    def __init__(self, vhost: Vhost, capacity: int):
+        self.weight = vhost.get_weight()
+        self.max_requests = min(vhost.get_max_requests() or capacity, capacity)
+        max_rate = vhost.get_max_rate()
+        self.bucket = TokenBucket(max_rate) if max_rate else None
+        # Requests being processed, and events of the requests waiting to start
+        self.active = 0
+        self.waiting: Deque[threading.Event] = deque()
+        self.virtual_time = 0.0
+        # Metrics: requests started, requests which had to wait, queueing delays and time waited for the bandwidth
+        self.started = 0
+        self.queued = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.delays: Deque[float] = deque(maxlen=SCHEDULER_DELAY_SAMPLES)
+        self.throttled = 0.0
+
+
+class FairScheduler:
+    """
+    Limits the requests processed at the same time, in total and per vhost, and queues the rest fairly.
+    """
+    __capacity = None
+    __active = 0
+    __queues = None
+    # Virtual time of the last request started, from which vhosts start when they have requests waiting again
+    __virtual_time = 0.0
+    __lock = None
+
+    def __init__(self, capacity: int = MAX_ACTIVE_REQUESTS):
+        self.__capacity = capacity
+        self.__active = 0
+        self.__queues: Dict[str, VhostQueue] = {}
+        self.__virtual_time = 0.0
+        self.__lock = threading.Lock()
+
+    def acquire(self, vhost: Vhost) -> float:
+        """
+        Waits until a request of the vhost can be processed. Must be followed by release once its response is sent.
+        :param vhost: vhost of the request
+        :return: seconds waited in the queue
+        """
+        start = time.monotonic()
+        with self.__lock:
+            queue = self.__get_queue(vhost)
+            if not queue.waiting and queue.active < queue.max_requests and self.__active < self.__capacity:
+                self.__start(queue)
+                event = None
+            else:
+                if not queue.waiting:
+                    # Do not let the vhost use the share it did not use while it had no requests waiting
+                    queue.virtual_time = max(queue.virtual_time, self.__virtual_time)
+                event = threading.Event()
+                queue.waiting.append(event)
+                queue.queued += 1
+        if event is not None:
+            # Started by the release of another request
+            event.wait()
+
+        delay = time.monotonic() - start
+        with self.__lock:
+            queue.delay_total += delay
+            queue.delay_max = max(queue.delay_max, delay)
+            queue.delays.append(delay)
+        return delay
+
+    def release(self, vhost: Vhost):
+        """
+        Marks a request of the vhost as finished, starting the next waiting request(s).
+        :param vhost: vhost of the request
+        """
+        with self.__lock:
+            queue = self.__get_queue(vhost)
+            queue.active -= 1
+            self.__active -= 1
+            self.__dispatch()
+
+    def throttle(self, vhost: Vhost, blocks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Limits the bandwidth used to send blocks, if the vhost has the max_rate option.
+        :param vhost: vhost of the response
+        :param blocks: blocks of the response
+        :return: iterator of the same bytes, in blocks of up to the burst size, generated at the vhost rate
+        """
+        with self.__lock:
+            queue = self.__get_queue(vhost)
+        if queue.bucket is None:
+            yield from blocks
+            return
+        burst = queue.bucket.get_burst()
+        for block in blocks:
+            for i in range(0, len(block), burst):
+                piece = block[i:i + burst]
+                waited = queue.bucket.consume(len(piece))
+                if waited:
+                    with self.__lock:
+                        queue.throttled += waited
+                yield piece
+
+    def schedule_content(self, vhost: Vhost, content: str | bytes | Iterable[str | bytes] | None) -> ScheduledContent:
+        """
+        Wraps the content of a response whose request has the turn of the vhost, so the turn lasts until the content
+        is sent, and its bandwidth is limited. For responses which are not sent right away (e.g. in HTTP/2 streams).
+        :param vhost: vhost of the response
+        :param content: content of the response
+        :return: content to be sent instead, which must be iterated or closed
+        """
+        return ScheduledContent(self, vhost, content)
+
+    def get_metrics(self, vhost: Vhost) -> dict:
+        """
+        Gets the scheduling metrics of a vhost, with the queueing delays (in milliseconds) of its latest requests.
+        :param vhost: vhost to be reported
+        :return: dictionary of metrics
+        """
+        with self.__lock:
+            queue = self.__get_queue(vhost)
+            delays = sorted(queue.delays)
+
+            def percentile(p):
+                return round(delays[min(len(delays) - 1, int(len(delays) * p / 100))] * 1000, 3) if delays else 0.0
+
+            return {
+                "host": vhost.get_hostname(),
+                "weight": queue.weight,
+                "max_requests": queue.max_requests,
+                "max_rate": vhost.get_max_rate(),
+                "active": queue.active,
+                "waiting": len(queue.waiting),
+                "requests": queue.started,
+                "queued": queue.queued,
+                "queue_delay_ms": {
+                    "mean": round(queue.delay_total / queue.started * 1000, 3) if queue.started else 0.0,
+                    "p50": percentile(50),
+                    "p95": percentile(95),
+                    "p99": percentile(99),
+                    "max": round(queue.delay_max * 1000, 3),
+                },
+                "throttled_ms": round(queue.throttled * 1000, 3),
+            }
+
+    def __get_queue(self, vhost: Vhost) -> VhostQueue:
+        queue = self.__queues.get(vhost.get_hostname())
+        if queue is None:
+            queue = VhostQueue(vhost, self.__capacity)
+            self.__queues[vhost.get_hostname()] = queue
+        return queue
+
+    def __start(self, queue: VhostQueue):
+        queue.virtual_time = max(queue.virtual_time, self.__virtual_time) + 1 / queue.weight
+        queue.active += 1
+        queue.started += 1
+        self.__active += 1
+
+    def __dispatch(self):
+        while self.__active < self.__capacity:
+            eligible = [q for q in self.__queues.values() if q.waiting and q.active < q.max_requests]
+            if not eligible:
+                return
+            queue = min(eligible, key=lambda q: q.virtual_time)
+            self.__virtual_time = queue.virtual_time
+            self.__start(queue)
+            queue.waiting.popleft().set()
+
+
+class ScheduledContent:
+    """
+    Content of a response which keeps the turn of its vhost until it is completely iterated or closed.
+    """
+    __scheduler = None
+    __vhost = None
+    __content = None
+    __released = False
+
+    def __init__(self, scheduler: FairScheduler, vhost: Vhost, content: str | bytes | Iterable[str | bytes] | None):
+        self.__scheduler = scheduler
+        self.__vhost = vhost
+        self.__content = content
+        self.__released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            content = self.__content
+            if isinstance(content, str):
+                content = content.encode(HTTP_ENCODING)
+            blocks = [content] if isinstance(content, bytes) else content or []
+            yield from self.__scheduler.throttle(self.__vhost, (
+                block.encode(HTTP_ENCODING) if isinstance(block, str) else block for block in blocks))
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__released:
+            return
+        self.__released = True
+        close = getattr(self.__content, "close", None)
+        if close is not None:
+            # Let the original content release its resources too (e.g. an upstream connection)
+            close()
+        self.__scheduler.release(self.__vhost)
@@ -1,25 +1,43 @@
 from __future__ import annotations
 
+import marshal
+import os
+import threading
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Tuple
 
 from settings import VHOSTS_FILE
-
+from utils.autoindex import invalidate_directory
+from utils.blobs import get_linked_hash, link_file, new_hash, release_file
+from utils.preload import invalidate_file
 
 from http.response import HttpResponseNotFound, HttpResponseForbidden
 
 
+# Option of a vhost line which enables the generation of directory listings
+OPTION_AUTOINDEX = "autoindex"
+# Option of a vhost line which forwards its requests to an upstream server ("upstream=host:port")
+OPTION_UPSTREAM = "upstream"
+# Options of a vhost line which limit its share of the server (see utils/scheduler.py): maximum number of requests
+# processed at the same time ("max_requests=N"), maximum bandwidth in bytes per second ("max_rate=N"), and weight of
+# the vhost when requests of several vhosts are waiting ("weight=N", 1 by default)
+OPTION_MAX_REQUESTS = "max_requests"
+OPTION_MAX_RATE = "max_rate"
+OPTION_WEIGHT = "weight"
+# Version of the snapshot format, to be increased whenever the stored data changes
+SNAPSHOT_VERSION = 2
+
+
 class Vhost:
-    __hostname = None
-    __index = None
-    __name = None
-    __email = None
+    __slots__ = ("__hostname", "__index", "__name", "__email", "__options", "__root")
 
-    def __init__(self, hostname: str, index: str, name: str, email: str):
+    def __init__(self, hostname: str, index: str, name: str, email: str, options: Dict[str, str] | None = None):
         self.__hostname = hostname
         self.__index = index
         self.__name = name
         self.__email = email
+        self.__options = options or {}
+        self.__root = None
 
     @staticmethod
     def parse_file(file: str = VHOSTS_FILE) -> Dict[str, Vhost]:
@@ -33,15 +51,27 @@ class Vhost:
                 line = line.strip()
                 if line == "":
                     continue
-                # Line should have 4 items
+                # Line should have at least 4 items, followed by the optional options
                 splitted = [e.strip() for e in line.split(",")]
-                if len(splitted) != 4:
+                if len(splitted) < 4:
                     continue
                 # If any element is empty, discard
-                hostname, index, name, email = splitted
+                hostname, index, name, email = splitted[:4]
+                options = Vhost.parse_options(splitted[4:])
                 if hostname == "" or index == "" or name == "" or email == "":
                     continue
                 hostname = hostname.lower()
+                # Limits must be positive numbers
+                if any(name in options and Vhost.parse_limit(options[name]) is None
+                       for name in (OPTION_MAX_REQUESTS, OPTION_MAX_RATE, OPTION_WEIGHT)):
+                    continue
+
+                if OPTION_UPSTREAM in options:
+                    # Requests are forwarded, so there is no host folder to check. Just validate the address
+                    if Vhost.parse_address(options[OPTION_UPSTREAM]) is None:
+                        continue
+                    out[hostname] = Vhost(hostname, index, name, email, options)
+                    continue
 
                 # Check if the specified path for the host exists
                 root_host = root_server.joinpath(hostname)
@@ -52,10 +82,125 @@ class Vhost:
                 if not root_file.exists() or not root_file.is_file():
                     continue
                 # Create the Vhost and add it
-                vhost = Vhost(hostname, index, name, email)
+                vhost = Vhost(hostname, index, name, email, options)
                 out[hostname] = vhost
         return out
 
+    @staticmethod
+    def load_file(file: str = VHOSTS_FILE, snapshot_file: str | None = None) -> Dict[str, Vhost]:
+        """
+        Loads the virtual hosts. If a snapshot file is given, they are loaded from it as long as the vhosts file has
+        not changed since the snapshot was written. Otherwise, the vhosts file is parsed (validating every host
+        folder) and the snapshot is written again for the next startup.
+        Note that a snapshot does not check again that the host folders still exist.
+        :param file: vhosts file
+        :param snapshot_file: snapshot file, or None to always parse the vhosts file
+        :return: dictionary of hosts, by hostname
+        """
+        if snapshot_file is None:
+            return Vhost.parse_file(file)
+        hosts = Vhost.load_snapshot(snapshot_file, file)
+        if hosts is None:
+            hosts = Vhost.parse_file(file)
+            Vhost.write_snapshot(hosts, snapshot_file, file)
+        return hosts
+
+    @staticmethod
+    def __get_snapshot_key(file: str) -> tuple:
+        """
+        Generates the values that identify the vhosts file a snapshot was generated from.
+        :param file: vhosts file
+        :return: tuple with the snapshot version, the working directory and the vhosts file path, mtime and size
+        """
+        path = Path().parent.joinpath(file).absolute()
+        stat = path.stat()
+        return SNAPSHOT_VERSION, os.getcwd(), str(path), stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def write_snapshot(hosts: Dict[str, Vhost], snapshot_file: str, file: str = VHOSTS_FILE):
+        """
+        Writes the already validated hosts to a binary snapshot (with marshal, which is the fastest to load).
+        :param hosts: dictionary of hosts, as returned by parse_file
+        :param snapshot_file: snapshot file to be written
+        :param file: vhosts file the hosts were parsed from
+        """
+        entries = [(h.__hostname, h.__index, h.__name, h.__email, h.__options) for h in hosts.values()]
+        data = marshal.dumps((Vhost.__get_snapshot_key(file), entries))
+        # Write it atomically, as several server processes may be starting at the same time
+        tmp_path = "{}.{}.tmp".format(snapshot_file, os.getpid())
+        try:
+            with open(tmp_path, mode='wb') as f:
+                f.write(data)
+            os.replace(tmp_path, snapshot_file)
+        except OSError:
+            # The snapshot is just an optimization, so ignore it if it cannot be written
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def load_snapshot(snapshot_file: str, file: str = VHOSTS_FILE) -> Dict[str, Vhost] | None:
+        """
+        Loads the hosts from a snapshot, if it is valid for the current vhosts file.
+        :param snapshot_file: snapshot file to be read
+        :param file: vhosts file the snapshot must have been generated from
+        :return: dictionary of hosts, or None if the snapshot does not exist or is outdated
+        """
+        try:
+            with open(snapshot_file, mode='rb') as f:
+                key, entries = marshal.loads(f.read())
+            if key != Vhost.__get_snapshot_key(file):
+                return None
+            return {entry[0]: Vhost(*entry) for entry in entries}
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def parse_address(address: str) -> Tuple[str, int] | None:
+        """
+        Given an address with the "host:port" format, splits it.
+        :param address: address to be parsed
+        :return: tuple (host, port), or None if the address is not valid
+        """
+        host, _, port = address.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            return None
+        if host == "" or not 0 < port < 65536:
+            return None
+        return host, port
+
+    @staticmethod
+    def parse_limit(value: str) -> float | None:
+        """
+        Given the value of a limit option, parses it.
+        :param value: value to be parsed
+        :return: positive number, or None if the value is not valid
+        """
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        if not 0 < number < float("inf"):
+            return None
+        return number
+
+    @staticmethod
+    def parse_options(items) -> Dict[str, str]:
+        """
+        Given the extra items of a vhost line, parses them as options. Each option is either "name=value", or just
+        "name" for flags (whose value is then an empty string).
+        :param items: list of extra items of the line
+        :return: dictionary of options
+        """
+        options = {}
+        for item in items:
+            if item == "":
+                continue
+            name, _, value = item.partition("=")
+            options[name.strip().lower()] = value.strip()
+        return options
+
     def get_hostname(self) -> str:
         return self.__hostname
 
@@ -68,8 +213,37 @@ class Vhost:
     def get_server_admin_email(self) -> str:
         return self.__email
 
+    def has_autoindex(self) -> bool:
+        return OPTION_AUTOINDEX in self.__options
+
+    def get_upstream(self) -> Tuple[str, int] | None:
+        # Address of the server where requests are forwarded, or None if files are served from the host folder
+        if OPTION_UPSTREAM not in self.__options:
+            return None
+        return Vhost.parse_address(self.__options[OPTION_UPSTREAM])
+
+    def get_max_requests(self) -> int | None:
+        # Maximum number of requests processed at the same time, or None if only the server limit applies
+        if OPTION_MAX_REQUESTS not in self.__options:
+            return None
+        return max(1, int(Vhost.parse_limit(self.__options[OPTION_MAX_REQUESTS])))
+
+    def get_max_rate(self) -> int | None:
+        # Maximum bandwidth of the responses, in bytes per second, or None if not limited
+        if OPTION_MAX_RATE not in self.__options:
+            return None
+        return max(1, int(Vhost.parse_limit(self.__options[OPTION_MAX_RATE])))
+
+    def get_weight(self) -> float:
+        if OPTION_WEIGHT not in self.__options:
+            return 1.0
+        return Vhost.parse_limit(self.__options[OPTION_WEIGHT])
+
     def get_host_root_path(self) -> Path:
-        return Path().parent.joinpath(self.__hostname).absolute()
+        # Resolved only once, as it is needed for every request (but not at startup)
+        if self.__root is None:
+            self.__root = Path().parent.joinpath(self.__hostname).absolute()
+        return self.__root
 
     @staticmethod
     def is_secure_path(path: str) -> bool:
@@ -112,6 +286,39 @@ class Vhost:
             raise HttpResponseForbidden()
     
     
+    @staticmethod
+    def put_file(path: Path, content: Iterable[bytes] | None) -> str:
+        """
+        Writes the content into the file (creating its folders if needed) while it is being received. It is
+        written into a temporary file, and hashed at the same time, so it is then added to the store of uploaded
+        files and the target is replaced with a link to the stored content (see utils/blobs.py). This way, a partial
+        upload is never served.
+        :return: hash of the content
+        """
+        tmp_path = path.with_name(".{}.{}.tmp".format(path.name, threading.get_ident()))
+        digest = new_hash()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, mode='wb') as f:
+                for block in content or []:
+                    f.write(block)
+                    digest.update(block)
+            link_file(tmp_path, path, digest.hexdigest())
+            return digest.hexdigest()
+        except PermissionError:
+            raise HttpResponseForbidden()
+        except (FileExistsError, NotADirectoryError):
+            # Some folder in the path is actually a file
+            raise HttpResponseForbidden(content="Path contains a file as a folder")
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            # The file kept in memory (if any) is outdated
+            invalidate_file(path)
+            # The parent folders (some of them maybe just created) changed, so their listings are outdated
+            for parent in path.parents:
+                invalidate_directory(parent)
+
     @staticmethod
     def delete_file(path: Path, root: Path) -> str:
         """
@@ -119,15 +326,22 @@ class Vhost:
         and its parents only if they are empty
         """
         try:
+            st = path.stat()
+            digest = get_linked_hash(path, st)
             path.unlink()
+            invalidate_file(path)
+            # The content may be shared with other files, in which case it is kept
+            release_file(st, digest)
             path = path.parent
         except PermissionError:
             raise HttpResponseForbidden()
+        invalidate_directory(path)
 
         while path != root:
             try:
                 path.rmdir()
                 path = path.parent
+                invalidate_directory(path)
             except PermissionError:
                 break
             except OSError:
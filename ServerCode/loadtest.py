@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+#
+# Loopback load test for server.py. Unless a port is given, a server is
+# started in another process on a free port. Then several clients connect
+# to it at the same time, and each one sends its requests in batches of
+# --depth messages without waiting for the replies (pipelining), before
+# reading the replies of the batch. The number of messages per second is
+# reported at the end.
+#
+#   python3 loadtest.py --clients 8 --messages 20000 --size 64 --depth 32
+#
+import argparse
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from server import RECV_SIZE, decode, encode
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, handler, workers):
+    """
+    Starts server.py in another process, and waits until it accepts connections.
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+               str(port), '--quiet']
+    if handler:
+        command += ['--handler', handler]
+    if workers is not None:
+        command += ['--workers', str(workers)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start on port {}'.format(port))
+
+
+def run_client(host, port, messages, size, depth, check, results, index):
+    payload = bytes(i % 256 for i in range(size))
+    batch = encode(payload) * depth
+    buffer = bytearray()
+    received = 0
+    with socket.create_connection((host, port)) as s, selectors.DefaultSelector() as selector:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+        while received < messages:
+            count = min(depth, messages - received)
+            output = memoryview(batch if count == depth else encode(payload) * count)
+            pending = count
+            # Replies are read while the batch is being sent, otherwise both
+            # sides could end up waiting for each other with large batches
+            while pending:
+                if output:
+                    try:
+                        output = output[s.send(output):]
+                    except BlockingIOError:
+                        pass
+                    selector.modify(s, selectors.EVENT_READ | (selectors.EVENT_WRITE if output else 0))
+                for _, mask in selector.select():
+                    if not mask & selectors.EVENT_READ:
+                        continue
+                    try:
+                        data = s.recv(RECV_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        raise ConnectionError('connection closed by the server')
+                    buffer += data
+                    for reply in decode(buffer):
+                        if check and reply != payload:
+                            raise ValueError('unexpected reply of {} bytes'.format(len(reply)))
+                        pending -= 1
+            received += count
+    results[index] = received
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Loopback load test for the request/reply server.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='host of the server (when a port is given)')
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='port of a running server (by default, a new one is started)')
+    parser.add_argument('--handler', default=None,
+                        help='handler of the started server, as module:function (default: echo)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='threads running the handler in the started server (default: the server one)')
+    parser.add_argument('-c', '--clients', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('-n', '--messages', type=int, default=20000,
+                        help='number of messages sent by each client')
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help='size of the payload of each message, in bytes')
+    parser.add_argument('-d', '--depth', type=int, default=32,
+                        help='number of messages sent before waiting for their replies')
+    args = parser.parse_args()
+
+    process = None
+    port = args.port
+    if port is None:
+        port = get_free_port()
+        process = start_server(port, args.handler, args.workers)
+    # Replies can only be checked against the requests with the echo handler
+    check = args.port is None and args.handler is None
+
+    results = [0] * args.clients
+    errors = []
+
+    def client(index):
+        try:
+            run_client(args.host, port, args.messages, args.size, args.depth, check, results, index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    try:
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    total = sum(results)
+    print('{} clients, {} messages of {} bytes each, pipeline depth {}'.format(
+        args.clients, args.messages, args.size, args.depth))
+    print('{} replies in {:.3f} s: {:.0f} messages/s ({:.2f} MB/s each way)'.format(
+        total, elapsed, total / elapsed, total * (args.size + 4) / elapsed / 1e6))
+    for e in errors:
+        print('client error:', e)
+    sys.exit(1 if errors else 0)
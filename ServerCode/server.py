@@ -3,31 +3,294 @@
 # This is a very simple SERVER implementation for a very very simple
 # request/reply protocol.
 #
+# Every message (request or reply) is framed with its length: 4 bytes
+# (unsigned integer, big endian) followed by that many bytes of payload.
+# A client can send many requests over the same connection, without
+# waiting for the replies (pipelining), and replies are sent back in the
+# same order as the requests. Many clients are served at the same time by
+# a single thread, which waits for all the connections with selectors.
+#
+# Replies are generated by a handler function, which receives the payload
+# of a request (bytes) and returns the payload of the reply (bytes). By
+# default requests are echoed back, but any other handler can be given as
+# module:function (the module must be importable, e.g. next to server.py):
+#
+#   python3 server.py 1234 --handler mymodule:answer
+#
+# Handlers run in a pool of --workers threads, so a slow handler does not
+# block the rest of connections (nor the rest of requests of its own
+# connection). Replies are handed back to the selectors thread, which sends
+# them in the order of the requests. With --workers 0, handlers run in the
+# selectors thread itself, which is faster for trivial handlers (e.g. echo).
+#
+import argparse
+import importlib
+import selectors
 import socket
-import sys
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Header of every message: length of the payload
+HEADER = struct.Struct('>I')
+# Larger messages are rejected (and their connection closed)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Maximum number of bytes received at once from a connection
+RECV_SIZE = 65536
+# Once this many bytes of replies are waiting to be sent to a client, no
+# more requests are read from it until it reads its replies
+MAX_PENDING_OUTPUT = 1024 * 1024
+# Likewise, once this many requests of a client are waiting for their reply
+MAX_PENDING_REQUESTS = 1024
+# Default number of threads running the handler
+WORKERS = 8
+# Interval (in seconds) used to check for a shutdown request
+POLL_INTERVAL = 0.5
+
+
+def echo(request):
+    return request
+
+
+def load_handler(name):
+    """
+    Loads a handler given as module:function.
+    """
+    module_name, _, function_name = name.partition(':')
+    if not function_name:
+        raise ValueError('handler must be given as module:function')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def encode(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode(buffer):
+    """
+    Extracts all the complete messages at the beginning of buffer (a
+    bytearray), which are removed from it. Returns their payloads.
+    """
+    messages = []
+    view = memoryview(buffer)
+    offset = 0
+    try:
+        while len(buffer) - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(buffer, offset)
+            if size > MAX_MESSAGE_SIZE:
+                raise ValueError('message of {} bytes is too large'.format(size))
+            if len(buffer) - offset - HEADER.size < size:
+                break
+            offset += HEADER.size
+            messages.append(bytes(view[offset:offset + size]))
+            offset += size
+    finally:
+        view.release()
+    del buffer[:offset]
+    return messages
+
+
+class Connection:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.input = bytearray()
+        self.output = bytearray()
+        # Replies being generated by the workers (futures), in the order of
+        # the requests
+        self.pending = deque()
+        # Set once the client has closed its side, the connection is then
+        # closed as soon as all the replies are sent
+        self.closing = False
+        self.closed = False
+
+
+class Server:
+    def __init__(self, port, handler=echo, host='', verbose=False, workers=WORKERS):
+        self.handler = handler
+        self.verbose = verbose
+        self.running = False
+        self.connections = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        # Connections with finished replies, queued by the workers for the
+        # selectors thread, which is woken up through a socket pair
+        self.finished = deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self.wakeup_recv)
+
+    def get_port(self):
+        return self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        self.running = True
+        try:
+            while self.running:
+                for key, mask in self.selector.select(POLL_INTERVAL):
+                    if key.data is None:
+                        self.accept()
+                    elif key.data is self.wakeup_recv:
+                        self.collect()
+                    else:
+                        self.serve(key.data, mask)
+        finally:
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.data, Connection):
+                    self.close(key.data)
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            self.selector.close()
+            self.sock.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+
+    def shutdown(self):
+        """
+        Stops serve_forever (from any other thread), closing all the connections.
+        """
+        self.running = False
+
+    def accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        if self.verbose:
+            print('Serving a connection from host', addr[0], 'on port', addr[1],
+                  '({} active connections)'.format(self.connections))
+        self.selector.register(conn, selectors.EVENT_READ, Connection(conn, addr))
+
+    def close(self, connection):
+        self.selector.unregister(connection.conn)
+        connection.conn.close()
+        connection.closed = True
+        for future in connection.pending:
+            future.cancel()
+        connection.pending.clear()
+        self.connections -= 1
+        if self.verbose:
+            print('Closed the connection from host', connection.addr[0], 'on port', connection.addr[1],
+                  '({} active connections)'.format(self.connections))
+
+    def serve(self, connection, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                self.read(connection)
+            self.take_replies(connection)
+            if connection.output:
+                self.write(connection)
+        except Exception as e:
+            print('Error on the connection from host', connection.addr[0], 'on port', connection.addr[1], '-', e)
+            self.close(connection)
+            return
+        self.update(connection)
+
+    def update(self, connection):
+        if connection.closing and not connection.output and not connection.pending:
+            self.close(connection)
+            return
+
+        # Wait for the client to read its replies (and for the workers to
+        # generate them) before reading more requests
+        events = 0
+        if not connection.closing and len(connection.output) < MAX_PENDING_OUTPUT \
+                and len(connection.pending) < MAX_PENDING_REQUESTS:
+            events |= selectors.EVENT_READ
+        if connection.output:
+            events |= selectors.EVENT_WRITE
+        if events != self.selector.get_key(connection.conn).events:
+            self.selector.modify(connection.conn, events, connection)
+
+    def read(self, connection):
+        try:
+            data = connection.conn.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            connection.closing = True
+            return
+        connection.input += data
+        if self.executor is None:
+            # Every request received so far is answered, and all the replies
+            # are sent together
+            for request in decode(connection.input):
+                connection.output += encode(self.handler(request))
+            return
+        for request in decode(connection.input):
+            future = self.executor.submit(self.handler, request)
+            connection.pending.append(future)
+            future.add_done_callback(lambda _, c=connection: self.notify(c))
 
-if len(sys.argv) > 1:
-    port_number = int(sys.argv[1])
-else:
-    port_number = 1234
+    def notify(self, connection):
+        """
+        Called by the workers once a reply is generated, to let the
+        selectors thread send it.
+        """
+        self.finished.append(connection)
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # The selectors thread is going to wake up anyway
+            pass
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def collect(self):
+        """
+        Sends the replies generated by the workers since the last call.
+        """
+        try:
+            while self.wakeup_recv.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self.finished:
+            connection = self.finished.popleft()
+            if not connection.closed:
+                self.serve(connection, 0)
 
-s.bind(('', port_number))
-s.listen(1)
+    def take_replies(self, connection):
+        """
+        Moves the finished replies to the output, stopping at the first one
+        still being generated, so they are sent in the order of the requests.
+        """
+        while connection.pending and connection.pending[0].done():
+            connection.output += encode(connection.pending.popleft().result())
 
-def answer(conn, addr):
-    print('Serving a connection from host', addr[0], 'on port', addr[1])
-    request = conn.recv(1024)   # reading data (a request) from the connection
-    print('request:', request.decode('utf-8'))
-    reply = input('reply> ')
-    conn.send(reply.encode('utf-8'))
-    conn.close()
+    def write(self, connection):
+        try:
+            sent = connection.conn.send(connection.output)
+        except BlockingIOError:
+            return
+        del connection.output[:sent]
 
 
-while True:
-    print('Accepting connections')
-    conn, addr = s.accept()
-    thread_create(answer(conn, addr))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Request/reply server with length-prefixed messages.')
+    parser.add_argument('port', nargs='?', type=int, default=1234,
+                        help='port to use to listen connections')
+    parser.add_argument('--handler', default=None,
+                        help='function generating the replies, as module:function (default: echo)')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='threads running the handler (0 to run it in the selectors thread)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the connections being served')
+    args = parser.parse_args()
 
-s.close()
\ No newline at end of file
+    s = Server(args.port, load_handler(args.handler) if args.handler else echo, verbose=not args.quiet,
+               workers=args.workers)
+    print('Accepting connections on port', s.get_port())
+    try:
+        s.serve_forever()
+    except KeyboardInterrupt:
+        pass